@@ -11,13 +11,12 @@ import pandas as pd
 
 try:
     import ccxt
-    from ta.trend import EMAIndicator
-    from ta.momentum import RSIIndicator
-    from ta.volatility import AverageTrueRange
 except Exception as exc:
     print("Missing dependencies. Install: pip install -r requirements.txt", file=sys.stderr)
     raise
 
+from indicators import compute_indicators
+
 
 @dataclass
 class StrategyParams:
@@ -47,17 +46,7 @@ def fetch_ohlcv_df(exchange, symbol: str, timeframe: str, limit: int) -> pd.Data
 
 
 def with_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    close = df["close"].astype(float)
-    high = df["high"].astype(float)
-    low = df["low"].astype(float)
-
-    out = df.copy()
-    out["ema200"] = EMAIndicator(close=close, window=200).ema_indicator()
-    out["ema20"] = EMAIndicator(close=close, window=20).ema_indicator()
-    out["rsi2"] = RSIIndicator(close=close, window=2).rsi()
-    out["atr14"] = AverageTrueRange(high=high, low=low, close=close, window=14).average_true_range()
-    out["roll_high20"] = out["high"].rolling(20, min_periods=20).max()
-    return out
+    return compute_indicators(df)
 
 
 def generate_entries(df: pd.DataFrame, params: StrategyParams) -> pd.Series:
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+r"""
+Benchmark manage_repo.py against synthetic add-on repositories
+
+This tool generates a corpus of add-on git repositories of a configurable
+size, (source files, binary assets, commits and tags), and times
+create_repository over it. Everything is local: the add-ons are built
+either from their folders or from file:// URLs.
+
+Each run is measured in three modes:
+    cold     a new data directory and an empty cache
+    rebuild  the same data directory with --force, so that every add-on
+             is packaged again but the caches are warm
+    warm     the same data directory without --force, so that every
+             add-on is found in the build manifest
+The median of the repeats is reported as wall time, and for the modes
+that package the add-ons, (cold and rebuild), also as add-ons per minute
+and as megabytes of published archives per second. Warm builds package
+nothing, so only their wall time is reported.
+
+The corpus is generated from a fixed seed, so the same options always
+produce the same repositories. It is reused while the options do not
+change. For example:
+
+    ./benchmark_repo.py --addons 20 --commits 200 --tags 20 \
+        --save baseline.json
+    (change manage_repo.py)
+    ./benchmark_repo.py --addons 20 --commits 200 --tags 20 \
+        --compare baseline.json
+"""
+
+__license__ = "GNU GENERAL PUBLIC LICENSE. Version 2, June 1991"
+
+
+import argparse
+import collections
+import git
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import manage_repo
+
+
+Measurement = collections.namedtuple('Measurement',
+                                     ('mode', 'wall_times', 'archive_size'))
+
+CORPUS_CONFIG_BASENAME = 'corpus.json'
+MODES = ('cold', 'rebuild', 'warm')
+# The modes in which every add-on is packaged, so that throughput applies.
+PACKAGING_MODES = ('cold', 'rebuild')
+COMMIT_EPOCH = 1500000000
+
+ADDON_INFO = """<?xml version="1.0" encoding="UTF-8"?>
+<addon id="{id}" name="Benchmark {index}" version="0.0.0"
+       provider-name="benchmark">
+  <requires>
+    <import addon="xbmc.python" version="2.25.0"/>
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py"/>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en_GB">Synthetic add-on {index}</summary>
+    <news></news>
+  </extension>
+</addon>
+"""
+
+
+def get_addon_id(index):
+    return 'plugin.video.benchmark{:04d}'.format(index)
+
+
+def get_source_contents(rng, size):
+    # Python-like text compresses about as well as real add-on sources.
+    line = 'value_{} = {!r}\n'
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(line.format(len(lines), rng.getrandbits(64)))
+        total += len(lines[-1])
+    return ''.join(lines)
+
+
+def commit_all(repo, message, timestamp):
+    date = '{} +0000'.format(timestamp)
+    env = {'GIT_AUTHOR_DATE': date, 'GIT_COMMITTER_DATE': date}
+    repo.git.execute(['git', 'add', '--all'], env=env)
+    repo.git.execute(['git', 'commit', '--quiet', '--message', message],
+                     env=env)
+
+
+def generate_addon(addon_folder, index, config):
+    rng = random.Random('{}-{}'.format(config['seed'], index))
+    os.makedirs(addon_folder)
+    repo = git.Repo.init(addon_folder)
+    try:
+        with repo.config_writer() as writer:
+            writer.set_value('user', 'name', 'Benchmark')
+            writer.set_value('user', 'email', 'benchmark@example.com')
+
+        addon_id = get_addon_id(index)
+        with open(os.path.join(addon_folder, 'addon.xml'), 'w') as info:
+            info.write(ADDON_INFO.format(id=addon_id, index=index))
+        with open(os.path.join(addon_folder, 'default.py'), 'w') as script:
+            script.write('import resources.lib.main\n')
+        lib_folder = os.path.join(addon_folder, 'resources', 'lib')
+        os.makedirs(lib_folder)
+        for file_index in range(config['files']):
+            with open(os.path.join(
+                    lib_folder, 'module{:04d}.py'.format(file_index)),
+                    'w') as source_file:
+                source_file.write(
+                    get_source_contents(rng, config['file_size']))
+        media_folder = os.path.join(addon_folder, 'resources', 'media')
+        os.makedirs(media_folder)
+        # Random bytes stand in for images, which do not compress.
+        for asset_index in range(config['assets']):
+            with open(os.path.join(
+                    media_folder, 'asset{:04d}.png'.format(asset_index)),
+                    'wb') as asset_file:
+                asset_file.write(rng.getrandbits(
+                    8 * config['asset_size']).to_bytes(
+                        config['asset_size'], 'little'))
+        with open(os.path.join(addon_folder, '.gitignore'), 'w') as ignore:
+            ignore.write('*.pyc\n')
+        commit_all(repo, 'Initial version', COMMIT_EPOCH)
+
+        # Spread the tags evenly over the history, with one on the first
+        # commit.
+        tag_interval = max(1, config['commits'] // max(1, config['tags']))
+        repo.create_tag('v1.0.0')
+        for commit_index in range(1, config['commits']):
+            file_index = rng.randrange(max(1, config['files']))
+            with open(os.path.join(
+                    lib_folder, 'module{:04d}.py'.format(file_index)),
+                    'a') as source_file:
+                source_file.write('change_{} = {}\n'.format(
+                    commit_index, rng.getrandbits(32)))
+            commit_all(repo, 'Change {} in module {}'.format(
+                commit_index, file_index), COMMIT_EPOCH + commit_index * 60)
+            tag_count = len(repo.tags)
+            if (commit_index % tag_interval == 0 and
+                    tag_count < config['tags']):
+                repo.create_tag('v1.{}.0'.format(tag_count))
+    finally:
+        repo.git.clear_cache()
+
+
+def generate_corpus(corpus_folder, config):
+    # Reuse the corpus when it was generated with the same options.
+    config_path = os.path.join(corpus_folder, CORPUS_CONFIG_BASENAME)
+    if os.path.isfile(config_path):
+        with open(config_path, 'r') as config_file:
+            if json.load(config_file) == config:
+                return
+    if os.path.isdir(corpus_folder):
+        shutil.rmtree(corpus_folder)
+    for index in range(config['addons']):
+        generate_addon(os.path.join(corpus_folder, get_addon_id(index)),
+                       index, config)
+    with open(config_path, 'w') as config_file:
+        json.dump(config, config_file, indent=2, sort_keys=True)
+
+
+def get_addon_locations(corpus_folder, config, source):
+    folders = [os.path.join(corpus_folder, get_addon_id(index))
+               for index in range(config['addons'])]
+    if source == 'git':
+        return ['file://' + os.path.abspath(folder) for folder in folders]
+    return folders
+
+
+def get_archive_size(data_path):
+    # Total the published archives, but not their blobs.
+    size = 0
+    for (root, dirs, files) in os.walk(data_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.endswith('.zip'):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def run_build(addon_locations, data_path, cache_folder, buildvers, force,
+              jobs):
+    options = manage_repo.BuildOptions(
+        blob_folder=os.path.join(data_path, manage_repo.BLOB_FOLDER_BASENAME),
+        cache_folder=cache_folder)
+    start_time = time.perf_counter()
+    manage_repo.create_repository(addon_locations, data_path, False,
+                                  buildvers, force, jobs, options)
+    return time.perf_counter() - start_time
+
+
+def measure(addon_locations, work_folder, buildvers, repeat, jobs):
+    wall_times = collections.defaultdict(list)
+    archive_size = 0
+    for _ in range(repeat):
+        data_path = tempfile.mkdtemp('-data', dir=work_folder)
+        cache_folder = tempfile.mkdtemp('-cache', dir=work_folder)
+        try:
+            for (mode, force) in zip(MODES, (True, True, False)):
+                wall_times[mode].append(run_build(
+                    addon_locations, data_path, cache_folder, buildvers,
+                    force, jobs))
+            archive_size = get_archive_size(data_path)
+        finally:
+            shutil.rmtree(data_path)
+            shutil.rmtree(cache_folder)
+    return [Measurement(mode, wall_times[mode], archive_size)
+            for mode in MODES]
+
+
+def summarize(measurements, addon_count):
+    summary = collections.OrderedDict()
+    for measurement in measurements:
+        wall_time = statistics.median(measurement.wall_times)
+        result = collections.OrderedDict((('wall_time', wall_time),))
+        if measurement.mode in PACKAGING_MODES:
+            result['addons_per_minute'] = addon_count * 60.0 / wall_time
+            result['megabytes_per_second'] = (
+                measurement.archive_size / 1048576.0 / wall_time)
+        result['wall_times'] = measurement.wall_times
+        summary[measurement.mode] = result
+    return summary
+
+
+def format_summary(summary, baseline=None):
+    row = '{:<8} {:>10} {:>14} {:>10} {:>10}'
+    lines = [row.format('Mode', 'Median s', 'Add-ons/min', 'MB/s', 'Change')]
+    for (mode, result) in summary.items():
+        change = ''
+        if baseline is not None and mode in baseline:
+            # Positive changes are faster than the baseline.
+            change = '{:+.1f}%'.format(
+                (baseline[mode]['wall_time'] / result['wall_time'] - 1) *
+                100)
+        lines.append(row.format(
+            mode, '{:.3f}'.format(result['wall_time']),
+            '{:.1f}'.format(result['addons_per_minute'])
+            if 'addons_per_minute' in result else '-',
+            '{:.2f}'.format(result['megabytes_per_second'])
+            if 'megabytes_per_second' in result else '-', change))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark manage_repo.py with synthetic add-ons')
+    parser.add_argument('--workdir', '-w',
+                        default=os.path.join(
+                            tempfile.gettempdir(), 'kodi-repository-bench'),
+                        help='Path to keep the generated corpus in '
+                             '[$TMPDIR/kodi-repository-bench]')
+    parser.add_argument('--addons', type=int, default=10,
+                        help='Number of add-ons to generate [10]')
+    parser.add_argument('--files', type=int, default=50,
+                        help='Number of source files in each add-on [50]')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='Size of each source file in bytes [4096]')
+    parser.add_argument('--assets', type=int, default=5,
+                        help='Number of binary assets in each add-on [5]')
+    parser.add_argument('--asset-size', type=int, default=262144,
+                        help='Size of each binary asset in bytes [262144]')
+    parser.add_argument('--commits', type=int, default=50,
+                        help='Number of commits in each add-on [50]')
+    parser.add_argument('--tags', type=int, default=10,
+                        help='Number of tags in each add-on [10]')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the generated contents [0]')
+    parser.add_argument('--source', choices=('folder', 'git'),
+                        default='folder',
+                        help='Build from the add-on folders or from file:// '
+                             'git URLs [folder]')
+    parser.add_argument('--buildvers', '-b', nargs='+',
+                        default=['leia', 'matrix'], type=str.lower,
+                        help='Versions of Kodi to build for [leia matrix]')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='Number of times to measure each mode [3]')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='Number of add-ons to package in parallel '
+                             '[number of CPUs]')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare the results with a saved baseline')
+    args = parser.parse_args()
+
+    config = collections.OrderedDict((
+        ('addons', args.addons),
+        ('files', args.files),
+        ('file_size', args.file_size),
+        ('assets', args.assets),
+        ('asset_size', args.asset_size),
+        ('commits', args.commits),
+        ('tags', args.tags),
+        ('seed', args.seed)))
+    work_folder = os.path.expanduser(args.workdir)
+    corpus_folder = os.path.join(work_folder, 'corpus')
+    generate_corpus(corpus_folder, config)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline_report = json.load(baseline_file)
+        if (baseline_report['corpus'] != config or
+                baseline_report['source'] != args.source or
+                baseline_report['buildvers'] != args.buildvers):
+            sys.stderr.write('Warning: the baseline was measured with other '
+                             'options\n')
+        baseline = baseline_report['results']
+
+    measurements = measure(
+        get_addon_locations(corpus_folder, config, args.source), work_folder,
+        args.buildvers, args.repeat, args.jobs)
+    summary = summarize(measurements, args.addons)
+    sys.stdout.write(format_summary(summary, baseline))
+
+    if args.save:
+        report = collections.OrderedDict((
+            ('version', manage_repo.__version__),
+            ('corpus', config),
+            ('source', args.source),
+            ('buildvers', args.buildvers),
+            ('results', summary)))
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
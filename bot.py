@@ -5,6 +5,7 @@ import time
 import json
 import math
 import traceback
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from typing import Dict, Any, List, Optional
 
@@ -16,13 +17,14 @@ from dotenv import load_dotenv
 
 try:
     import ccxt
-    from ta.trend import EMAIndicator
-    from ta.momentum import RSIIndicator
-    from ta.volatility import AverageTrueRange
 except Exception as exc:
     print("Missing dependencies. Install: pip install -r /workspace/requirements.txt", file=sys.stderr)
     raise
 
+from indicators import IndicatorEngine
+from market_data import (AsyncMarketData, LimitsTable, MarketsCache, OHLCV_COLUMNS, OHLCVRing, apply_top_up,
+                         build_async_exchange, build_token_bucket, get_top_up, round_amounts, size_orders)
+
 STATE_PATH = "/workspace/state/positions.json"
 
 
@@ -93,26 +95,38 @@ def fetch_universe(ex, cfg: Dict[str, Any]) -> List[str]:
     return [s for s, _ in candidates[:max_symbols]]
 
 
-def fetch_ohlcv_df(ex, symbol: str, timeframe: str, limit: int) -> pd.DataFrame:
-    raw = ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
-    df = pd.DataFrame(raw, columns=["timestamp", "open", "high", "low", "close", "volume"])
-    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True)
-    df.set_index("timestamp", inplace=True)
-    return df
-
-
-def compute_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    close = df["close"].astype(float)
-    high = df["high"].astype(float)
-    low = df["low"].astype(float)
-
-    out = df.copy()
-    out["ema200"] = EMAIndicator(close=close, window=200).ema_indicator()
-    out["ema20"] = EMAIndicator(close=close, window=20).ema_indicator()
-    out["rsi2"] = RSIIndicator(close=close, window=2).rsi()
-    out["atr14"] = AverageTrueRange(high=high, low=low, close=close, window=14).average_true_range()
-    out["roll_high20"] = out["high"].rolling(20, min_periods=20).max()
-    return out
+def fetch_ohlcv_df(ex, symbol: str, timeframe: str, limit: int, cache: Optional[Dict[str, OHLCVRing]] = None) -> pd.DataFrame:
+    if cache is None:
+        raw = ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
+        df = pd.DataFrame(raw, columns=OHLCV_COLUMNS)
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True)
+        df.set_index("timestamp", inplace=True)
+        return df
+
+    timeframe_ms = ex.parse_timeframe(timeframe) * 1000
+    ring = cache.get(symbol)
+    top_up = get_top_up(ring, limit, timeframe_ms, ex.milliseconds())
+    if top_up is not None:
+        since, top_up_limit = top_up
+        raw = ex.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=top_up_limit)
+        if apply_top_up(ring, raw, since):
+            return ring.to_frame()
+
+    ring = OHLCVRing(limit, timeframe_ms)
+    ring.seed(ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit))
+    cache[symbol] = ring
+    return ring.to_frame()
+
+
+def iter_symbol_ohlcv(ex, market_data: Optional[AsyncMarketData], symbols: List[str], timeframe: str, limit: int,
+                      cache: Dict[str, OHLCVRing]):
+    # (symbol, DataFrame or exception) pairs, in completion order when the
+    # fetches run concurrently
+    if market_data is not None:
+        yield from market_data.iter_ohlcv(symbols, timeframe, limit)
+        return
+    for symbol in symbols:
+        yield symbol, fetch_ohlcv_df(ex, symbol, timeframe, limit, cache)
 
 
 def send_telegram(cfg: Dict[str, Any], text: str) -> None:
@@ -130,19 +144,8 @@ def send_telegram(cfg: Dict[str, Any], text: str) -> None:
         pass
 
 
-def amount_from_budget(ex, market: Dict[str, Any], budget_quote: float, price: float) -> float:
-    amount = budget_quote / price
-    amount = ex.amount_to_precision(market["symbol"], amount)
-    amount = float(amount)
-    # Respect min amount/cost if known
-    limits = market.get("limits", {})
-    min_amount = (limits.get("amount") or {}).get("min")
-    min_cost = (limits.get("cost") or {}).get("min")
-    if min_amount and amount < min_amount:
-        amount = min_amount
-    if min_cost and amount * price < min_cost:
-        amount = min_cost / price
-    return float(ex.amount_to_precision(market["symbol"], amount))
+def amount_from_budget(limits: LimitsTable, symbol: str, budget_quote: float, price: float) -> float:
+    return float(size_orders(limits, [symbol], budget_quote, [price])[0])
 
 
 def place_market_order(ex, symbol: str, side: str, amount: float) -> Optional[Dict[str, Any]]:
@@ -154,6 +157,179 @@ def place_market_order(ex, symbol: str, side: str, amount: float) -> Optional[Di
         return None
 
 
+@dataclass
+class TradingParams:
+    per_order_usd: float = 5.0
+    max_budget_per_symbol: float = 25.0
+    max_open_positions: int = 8
+    dca_steps: List[float] = field(default_factory=lambda: [0.5, 1.0, 1.5])
+    trail_mult: float = 2.0
+    close_if_below_ema200: bool = True
+
+
+class BarClock:
+    # Bar boundaries of a timeframe on the exchange's clock. The offset of the
+    # local clock is measured with fetch_time(), taking the server time to be
+    # halfway through the round trip.
+    def __init__(self, timeframe_ms: int):
+        self.timeframe_ms = timeframe_ms
+        self.offset_ms = 0.0
+        self.synced_at: Optional[float] = None
+
+    def sync(self, ex) -> None:
+        self.synced_at = time.monotonic()
+        if not ex.has.get("fetchTime"):
+            return
+        before = time.time() * 1000
+        server_ms = ex.fetch_time()
+        after = time.time() * 1000
+        self.offset_ms = server_ms - (before + after) / 2
+
+    def now_ms(self) -> float:
+        return time.time() * 1000 + self.offset_ms
+
+    def bar_open(self) -> int:
+        return int(self.now_ms() // self.timeframe_ms * self.timeframe_ms)
+
+    def seconds_until_close(self) -> float:
+        return (self.bar_open() + self.timeframe_ms - self.now_ms()) / 1000
+
+
+def open_position_symbols(state: Dict[str, Any]) -> List[str]:
+    return [s for s, p in state.get("positions", {}).items() if p.get("qty", 0) > 0]
+
+
+def manage_position(ex, cfg: Dict[str, Any], state: Dict[str, Any], params: TradingParams, symbol: str,
+                    limits: LimitsTable, price: float, atr: Optional[float], ema200: Optional[float],
+                    bar_close: bool) -> None:
+    # Exits first, then DCA adds, for an open position. The highest close only
+    # moves on bar closes; between them the price is a ticker last price.
+    pos = state["positions"][symbol]
+
+    # DCA ladder prices based on initial entry price and ATR
+    if atr is not None and pos["ladders_filled"] < len(params.dca_steps):
+        next_step = params.dca_steps[pos["ladders_filled"]]
+        dca_price = pos.get("first_entry_price", pos["avg_price"]) - next_step * atr
+    else:
+        dca_price = None
+
+    # Exits
+    exit_signal = False
+    if atr is not None:
+        if bar_close:
+            pos["highest_close"] = max(pos.get("highest_close", 0.0), price)
+        trail_stop = pos["highest_close"] - params.trail_mult * atr
+        if price <= trail_stop:
+            exit_signal = True
+    if params.close_if_below_ema200 and ema200 is not None and price < ema200:
+        exit_signal = True
+
+    # Execute exits first
+    if exit_signal:
+        amount = float(round_amounts(limits, limits.take([symbol]), [pos["qty"]])[0])
+        if amount > 0:
+            order = place_market_order(ex, symbol, "sell", amount)
+            if order:
+                send_telegram(cfg, f"🔴 Exit {symbol}: sold {amount} at ~{price}")
+                pos.update({"qty": 0.0, "avg_price": 0.0, "budget_used": 0.0, "ladders_filled": 0, "highest_close": 0.0})
+                save_state(state)
+                return
+
+    # DCA adds
+    if dca_price is not None and price <= dca_price and pos["budget_used"] + params.per_order_usd <= params.max_budget_per_symbol:
+        amount = amount_from_budget(limits, symbol, params.per_order_usd, price)
+        if amount > 0:
+            order = place_market_order(ex, symbol, "buy", amount)
+            if order:
+                cost = amount * price
+                prev_qty = pos["qty"]
+                pos["qty"] += amount
+                pos["avg_price"] = (pos["avg_price"] * prev_qty + price * amount) / pos["qty"]
+                pos["budget_used"] += cost
+                pos["ladders_filled"] += 1
+                send_telegram(cfg, f"➕ DCA {symbol}: bought {amount} at ~{price}, ladders {pos['ladders_filled']}/{len(params.dca_steps)}, budget {pos['budget_used']:.2f}/{params.max_budget_per_symbol}")
+                save_state(state)
+
+
+def indicator_levels(values: Dict[str, float]):
+    atr = float(values["atr14"]) if not math.isnan(values.get("atr14", math.nan)) else None
+    ema200 = float(values["ema200"]) if not math.isnan(values.get("ema200", math.nan)) else None
+    return atr, ema200
+
+
+def run_bar_close_pass(ex, cfg: Dict[str, Any], state: Dict[str, Any], params: TradingParams, symbol_ohlcv,
+                       engines: Dict[str, IndicatorEngine], limits: LimitsTable) -> None:
+    # Full evaluation right after a bar closes: entries, exits and DCA.
+    open_positions = open_position_symbols(state)
+
+    for symbol, df in symbol_ohlcv:
+        if isinstance(df, Exception):
+            print(f"OHLCV error {symbol}: {df}")
+            continue
+        # Only the bars closed since the last pass are fed to the
+        # engine; the last (forming) bar is evaluated without state.
+        engine = engines.setdefault(symbol, IndicatorEngine())
+        last = engine.sync(df)
+
+        price = float(df["close"].iloc[-1])  # approximate execution price
+        atr, ema200 = indicator_levels(last)
+        trend_up = ema200 is not None and price > ema200
+
+        pos = state.setdefault("positions", {}).setdefault(symbol, {
+            "qty": 0.0,
+            "avg_price": 0.0,
+            "budget_used": 0.0,
+            "ladders_filled": 0,
+            "highest_close": 0.0,
+        })
+
+        if pos["qty"] > 0:
+            manage_position(ex, cfg, state, params, symbol, limits, price, atr, ema200, bar_close=True)
+            continue
+
+        # Entry signal: uptrend and either pullback or breakout
+        pullback = trend_up and (float(last["rsi2"]) < 5) and (price <= float(last["ema20"]) * 1.01)
+        breakout = trend_up and (price > float(engine.last_closed.get("roll_high20", math.nan)))
+        if not (pullback or breakout):
+            continue
+
+        # Risk: cap number of concurrent positions
+        if len(open_positions) >= params.max_open_positions:
+            continue
+        amount = amount_from_budget(limits, symbol, params.per_order_usd, price)
+        if amount <= 0:
+            continue
+        order = place_market_order(ex, symbol, "buy", amount)
+        if order:
+            cost = amount * price
+            pos["qty"] = pos["qty"] + amount
+            # weighted avg price
+            pos["avg_price"] = (pos["avg_price"] * (pos["qty"] - amount) + price * amount) / pos["qty"]
+            pos["budget_used"] += cost
+            pos["first_entry_price"] = price
+            pos["highest_close"] = price
+            pos["ladders_filled"] = 0
+            send_telegram(cfg, f"🟢 Entry {symbol}: bought {amount} at ~{price}, budget {pos['budget_used']:.2f}/{params.max_budget_per_symbol}")
+            save_state(state)
+            open_positions = open_position_symbols(state)
+
+
+def run_ticker_pass(ex, cfg: Dict[str, Any], state: Dict[str, Any], params: TradingParams,
+                    engines: Dict[str, IndicatorEngine], limits: LimitsTable) -> None:
+    # Between bar closes only open positions are checked, against one
+    # fetch_tickers request and the ATR/EMA of the last closed bar.
+    held = [s for s in open_position_symbols(state) if s in engines and s in limits.rows]
+    if not held:
+        return
+    tickers = ex.fetch_tickers(held)
+    for symbol in held:
+        last_price = (tickers.get(symbol) or {}).get("last")
+        if not last_price:
+            continue
+        atr, ema200 = indicator_levels(engines[symbol].last_closed)
+        manage_position(ex, cfg, state, params, symbol, limits, float(last_price), atr, ema200, bar_close=False)
+
+
 def run_bot(config_path: str):
     load_dotenv()
     ensure_dirs()
@@ -172,124 +348,67 @@ def run_bot(config_path: str):
     lookback = int(cfg.get("lookback_bars", 400))
 
     trading = cfg.get("trading", {})
-    per_order_usd = float(trading.get("per_order_usd", 5))
-    max_budget_per_symbol = float(trading.get("max_budget_per_symbol", 25))
-    max_open_positions = int(trading.get("max_open_positions", 8))
-    dca_steps = list(trading.get("dca_atr_steps", [0.5, 1.0, 1.5]))
-    trail_mult = float(trading.get("trail_atr_mult", 2.0))
-    close_if_below_ema200 = bool(trading.get("close_if_below_ema200", True))
+    params = TradingParams(
+        per_order_usd=float(trading.get("per_order_usd", 5)),
+        max_budget_per_symbol=float(trading.get("max_budget_per_symbol", 25)),
+        max_open_positions=int(trading.get("max_open_positions", 8)),
+        dca_steps=list(trading.get("dca_atr_steps", [0.5, 1.0, 1.5])),
+        trail_mult=float(trading.get("trail_atr_mult", 2.0)),
+        close_if_below_ema200=bool(trading.get("close_if_below_ema200", True)),
+    )
     poll_sec = int(trading.get("poll_interval_sec", 60))
 
+    schedule = cfg.get("schedule", {})
+    close_delay_sec = float(schedule.get("close_delay_sec", 2))
+    time_sync_sec = float(schedule.get("time_sync_sec", 3600))
+
+    # One ring buffer per symbol, topped up by whichever fetch path is used
+    ohlcv_cache: Dict[str, OHLCVRing] = {}
+    market_data_cfg = cfg.get("market_data", {})
+    market_data = None
+    if market_data_cfg.get("async_fetch", True):
+        async_ex = build_async_exchange(exchange_id)
+        market_data = AsyncMarketData(
+            async_ex,
+            build_token_bucket(async_ex, float(market_data_cfg.get("burst_sec", 1.0))),
+            market_data_cfg.get("ohlcv_cost"),
+            ohlcv_cache,
+        )
+
+    # Markets are refreshed in the background instead of on every pass
+    markets = MarketsCache(
+        ex,
+        getattr(ccxt, exchange_id)({"enableRateLimit": True, "options": {"defaultType": "spot"}}),
+        float(market_data_cfg.get("markets_ttl_sec", 3600)),
+    )
+
     state = load_state()
+    engines: Dict[str, IndicatorEngine] = {}
+    clock = BarClock(ex.parse_timeframe(tf) * 1000)
+    evaluated_bar = None
 
     send_telegram(cfg, f"✅ Bot started at {utc_now_str()} with {len(symbols)} symbols on {exchange_id} {tf}")
 
     while True:
         try:
-            ex.load_markets()
-            open_positions = {s: p for s, p in state.get("positions", {}).items() if p.get("qty", 0) > 0}
-
-            for symbol in symbols:
-                market = ex.markets.get(symbol)
-                if not market or not market.get("active"):
-                    continue
-
-                df = fetch_ohlcv_df(ex, symbol, tf, lookback)
-                df = compute_indicators(df)
-                last = df.iloc[-1]
-
-                price = float(last["close"])  # approximate execution price
-                atr = float(last["atr14"]) if not math.isnan(last["atr14"]) else None
-                ema200 = float(last["ema200"]) if not math.isnan(last["ema200"]) else None
-                trend_up = ema200 is not None and price > ema200
-
-                pos = state.setdefault("positions", {}).setdefault(symbol, {
-                    "qty": 0.0,
-                    "avg_price": 0.0,
-                    "budget_used": 0.0,
-                    "ladders_filled": 0,
-                    "highest_close": 0.0,
-                })
-
-                in_pos = pos["qty"] > 0
-
-                # Entry signal: uptrend and either pullback or breakout
-                pullback = trend_up and (float(last["rsi2"]) < 5) and (price <= float(last["ema20"]) * 1.01)
-                breakout = trend_up and (price > float(df["high"].rolling(20, min_periods=20).max().shift(1).iloc[-1]))
-                entry_signal = pullback or breakout
-
-                # DCA ladder prices based on initial entry price and ATR
-                if in_pos and atr is not None and pos["ladders_filled"] < len(dca_steps):
-                    next_step = dca_steps[pos["ladders_filled"]]
-                    dca_price = pos.get("first_entry_price", pos["avg_price"]) - next_step * atr
-                else:
-                    dca_price = None
-
-                # Exits
-                exit_signal = False
-                if in_pos and atr is not None:
-                    pos["highest_close"] = max(pos.get("highest_close", 0.0), price)
-                    trail_stop = pos["highest_close"] - trail_mult * atr
-                    if price <= trail_stop:
-                        exit_signal = True
-                if in_pos and close_if_below_ema200 and ema200 is not None and price < ema200:
-                    exit_signal = True
-
-                # Execute exits first
-                if in_pos and exit_signal:
-                    amount = float(ex.amount_to_precision(symbol, pos["qty"]))
-                    if amount > 0:
-                        order = place_market_order(ex, symbol, "sell", amount)
-                        if order:
-                            send_telegram(cfg, f"🔴 Exit {symbol}: sold {amount} at ~{price}")
-                            pos.update({"qty": 0.0, "avg_price": 0.0, "budget_used": 0.0, "ladders_filled": 0, "highest_close": 0.0})
-                            save_state(state)
-                            continue
-
-                # Entries / Adds
-                if not in_pos and entry_signal:
-                    # Risk: cap number of concurrent positions
-                    if len(open_positions) >= max_open_positions:
-                        continue
-                    amount = amount_from_budget(ex, market, per_order_usd, price)
-                    if amount <= 0:
-                        continue
-                    order = place_market_order(ex, symbol, "buy", amount)
-                    if order:
-                        cost = amount * price
-                        pos["qty"] = pos["qty"] + amount
-                        # weighted avg price
-                        pos["avg_price"] = (pos["avg_price"] * (pos["qty"] - amount) + price * amount) / pos["qty"]
-                        pos["budget_used"] += cost
-                        pos["first_entry_price"] = price
-                        pos["highest_close"] = price
-                        pos["ladders_filled"] = 0
-                        send_telegram(cfg, f"🟢 Entry {symbol}: bought {amount} at ~{price}, budget {pos['budget_used']:.2f}/{max_budget_per_symbol}")
-                        save_state(state)
-                        open_positions = {s: p for s, p in state.get("positions", {}).items() if p.get("qty", 0) > 0}
-                        continue
-
-                # DCA adds
-                if in_pos and dca_price is not None and price <= dca_price and pos["budget_used"] + per_order_usd <= max_budget_per_symbol:
-                    amount = amount_from_budget(ex, market, per_order_usd, price)
-                    if amount > 0:
-                        order = place_market_order(ex, symbol, "buy", amount)
-                        if order:
-                            cost = amount * price
-                            prev_qty = pos["qty"]
-                            pos["qty"] += amount
-                            pos["avg_price"] = (pos["avg_price"] * prev_qty + price * amount) / pos["qty"]
-                            pos["budget_used"] += cost
-                            pos["ladders_filled"] += 1
-                            send_telegram(cfg, f"➕ DCA {symbol}: bought {amount} at ~{price}, ladders {pos['ladders_filled']}/{len(dca_steps)}, budget {pos['budget_used']:.2f}/{max_budget_per_symbol}")
-                            save_state(state)
-                            continue
-
-                # Optional heartbeat per symbol (sparse)
-                # print(f"{symbol} price={price} in_pos={in_pos} entry={entry_signal} dca_price={dca_price}")
-
-            # small sleep between full passes
-            time.sleep(poll_sec)
+            if clock.synced_at is None or time.monotonic() - clock.synced_at >= time_sync_sec:
+                clock.sync(ex)
+
+            # Refreshed markets take effect between passes, never during one
+            markets.apply()
+
+            current_bar = clock.bar_open()
+            if current_bar != evaluated_bar:
+                active_symbols = [s for s in symbols if markets.is_active(s)]
+                symbol_ohlcv = iter_symbol_ohlcv(ex, market_data, active_symbols, tf, lookback, ohlcv_cache)
+                run_bar_close_pass(ex, cfg, state, params, symbol_ohlcv, engines, markets.limits)
+                evaluated_bar = current_bar
+            else:
+                run_ticker_pass(ex, cfg, state, params, engines, markets.limits)
+
+            # Wake up just after the next bar closes, with ticker-only checks
+            # every poll_interval_sec in between
+            time.sleep(max(0.0, min(clock.seconds_until_close() + close_delay_sec, poll_sec)))
         except KeyboardInterrupt:
             print("Stopping by user...")
             send_telegram(cfg, "⏹️ Bot stopped by user")
@@ -300,6 +419,10 @@ def run_bot(config_path: str):
             send_telegram(cfg, f"⚠️ {errmsg[:3500]}")
             time.sleep(5)
 
+    markets.close()
+    if market_data is not None:
+        market_data.close()
+
 
 if __name__ == "__main__":
     config_path = os.environ.get("BOT_CONFIG", "/workspace/config/config.yaml")
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import sys
+from collections import deque
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+NAN = float("nan")
+
+
+# Every indicator keeps the state of the bars that have closed. push() adds a
+# closed bar; peek() returns the value for a bar that is still forming without
+# changing any state. Both are O(1) (amortized for the rolling extremes), so
+# the cost per bar does not depend on the length of the history.
+# The update formulas follow pandas/ta exactly, so the outputs match
+# ta.trend.EMAIndicator, ta.momentum.RSIIndicator and
+# ta.volatility.AverageTrueRange on the same series (see the __main__ harness).
+
+
+class EWM:
+    # pandas .ewm(alpha=..., min_periods=window, adjust=False).mean()
+    def __init__(self, alpha: float, min_periods: int):
+        self.alpha = alpha
+        self.min_periods = min_periods
+        self.count = 0
+        self.mean = NAN
+
+    def _next(self, x: float) -> float:
+        if self.count == 0 or self.mean == x:
+            return x
+        beta = 1.0 - self.alpha
+        return (beta * self.mean + self.alpha * x) / (beta + self.alpha)
+
+    def _output(self, mean: float, count: int) -> float:
+        return mean if count >= self.min_periods else NAN
+
+    def peek(self, x: float) -> float:
+        return self._output(self._next(x), self.count + 1)
+
+    def push(self, x: float) -> float:
+        self.mean = self._next(x)
+        self.count += 1
+        return self._output(self.mean, self.count)
+
+
+class EMA(EWM):
+    # ta.trend.EMAIndicator(window).ema_indicator()
+    def __init__(self, window: int):
+        super().__init__(2.0 / (window + 1), window)
+
+
+class RSI:
+    # ta.momentum.RSIIndicator(window).rsi(): Wilder smoothing of the gains
+    # and losses, where the first bar counts as an observation of zero.
+    def __init__(self, window: int):
+        self.up = EWM(1.0 / window, window)
+        self.down = EWM(1.0 / window, window)
+        self.prev_close: Optional[float] = None
+
+    def _moves(self, close: float):
+        diff = NAN if self.prev_close is None else close - self.prev_close
+        return (diff if diff > 0 else 0.0, -diff if diff < 0 else -0.0)
+
+    @staticmethod
+    def _output(up: float, down: float) -> float:
+        if down == 0:
+            return 100.0
+        return 100 - (100 / (1 + up / down))
+
+    def peek(self, close: float) -> float:
+        up, down = self._moves(close)
+        return self._output(self.up.peek(up), self.down.peek(down))
+
+    def push(self, close: float) -> float:
+        up, down = self._moves(close)
+        self.prev_close = close
+        return self._output(self.up.push(up), self.down.push(down))
+
+
+class ATR:
+    # ta.volatility.AverageTrueRange(window).average_true_range(): zero until
+    # the window is full, then the plain mean, then Wilder smoothing.
+    def __init__(self, window: int):
+        self.window = window
+        self.count = 0
+        self.value = 0.0
+        self.prev_close: Optional[float] = None
+        self.seed: List[float] = []
+
+    def _true_range(self, high: float, low: float) -> float:
+        if self.prev_close is None:
+            return high - low
+        return max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+
+    def _next(self, true_range: float) -> float:
+        count = self.count + 1
+        if count < self.window:
+            return 0.0
+        if count == self.window:
+            return np.asarray(self.seed + [true_range], dtype=np.float64).sum() / self.window
+        return (self.value * (self.window - 1) + true_range) / float(self.window)
+
+    def peek(self, high: float, low: float) -> float:
+        return self._next(self._true_range(high, low))
+
+    def push(self, high: float, low: float, close: float) -> float:
+        true_range = self._true_range(high, low)
+        self.value = self._next(true_range)
+        if self.count < self.window:
+            self.seed.append(true_range)
+        self.count += 1
+        self.prev_close = close
+        return self.value
+
+
+class RollingExtreme:
+    # .rolling(window, min_periods=window).max() (or .min()) with a monotonic
+    # deque of the last window - 1 closed bars; the current bar completes it.
+    def __init__(self, window: int, highest: bool = True):
+        self.window = window
+        self.highest = highest
+        self.count = 0
+        self.candidates: deque = deque()
+
+    def _better(self, a: float, b: float) -> bool:
+        return a >= b if self.highest else a <= b
+
+    def peek(self, x: float) -> float:
+        if self.count + 1 < self.window:
+            return NAN
+        if self.candidates and not self._better(x, self.candidates[0][1]):
+            return self.candidates[0][1]
+        return x
+
+    def push(self, x: float) -> float:
+        value = self.peek(x)
+        while self.candidates and self._better(x, self.candidates[-1][1]):
+            self.candidates.pop()
+        self.candidates.append((self.count, x))
+        self.count += 1
+        while self.candidates[0][0] <= self.count - self.window:
+            self.candidates.popleft()
+        return value
+
+
+class IndicatorEngine:
+    # The indicator set of the screener, backtest and bot for one symbol.
+    def __init__(self):
+        self.ema200 = EMA(200)
+        self.ema20 = EMA(20)
+        self.rsi2 = RSI(2)
+        self.atr14 = ATR(14)
+        self.roll_high20 = RollingExtreme(20, highest=True)
+        self.roll_low20 = RollingExtreme(20, highest=False)
+        self.last_timestamp = None
+        self.last_closed: Dict[str, float] = {}
+
+    def push(self, high: float, low: float, close: float) -> Dict[str, float]:
+        self.last_closed = {
+            "ema200": self.ema200.push(close),
+            "ema20": self.ema20.push(close),
+            "rsi2": self.rsi2.push(close),
+            "atr14": self.atr14.push(high, low, close),
+            "roll_high20": self.roll_high20.push(high),
+            "roll_low20": self.roll_low20.push(low),
+        }
+        return self.last_closed
+
+    def peek(self, high: float, low: float, close: float) -> Dict[str, float]:
+        return {
+            "ema200": self.ema200.peek(close),
+            "ema20": self.ema20.peek(close),
+            "rsi2": self.rsi2.peek(close),
+            "atr14": self.atr14.peek(high, low),
+            "roll_high20": self.roll_high20.peek(high),
+            "roll_low20": self.roll_low20.peek(low),
+        }
+
+    def sync(self, df: pd.DataFrame) -> Dict[str, float]:
+        # Push the bars of df that closed since the last call and return the
+        # values for its last bar, which may still be forming. Only the new
+        # bars are processed, unless df no longer contains the last one seen.
+        timestamps = df.index
+        start = 0
+        if self.last_timestamp is not None:
+            position = timestamps.searchsorted(self.last_timestamp)
+            if position < len(timestamps) and timestamps[position] == self.last_timestamp:
+                start = position + 1
+            else:
+                self.__init__()
+        high = df["high"].to_numpy(dtype=np.float64)
+        low = df["low"].to_numpy(dtype=np.float64)
+        close = df["close"].to_numpy(dtype=np.float64)
+        for i in range(start, len(df) - 1):
+            self.push(high[i], low[i], close[i])
+            self.last_timestamp = timestamps[i]
+        return self.peek(high[-1], low[-1], close[-1])
+
+
+def compute_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    engine = IndicatorEngine()
+    high = df["high"].to_numpy(dtype=np.float64)
+    low = df["low"].to_numpy(dtype=np.float64)
+    close = df["close"].to_numpy(dtype=np.float64)
+    rows = [engine.push(high[i], low[i], close[i]) for i in range(len(df))]
+    out = df.copy()
+    for column in ("ema200", "ema20", "rsi2", "atr14", "roll_high20", "roll_low20"):
+        out[column] = [row[column] for row in rows]
+    return out
+
+
+def compute_indicators_ta(df: pd.DataFrame) -> pd.DataFrame:
+    from ta.trend import EMAIndicator
+    from ta.momentum import RSIIndicator
+    from ta.volatility import AverageTrueRange
+
+    close = df["close"].astype(float)
+    high = df["high"].astype(float)
+    low = df["low"].astype(float)
+
+    out = df.copy()
+    out["ema200"] = EMAIndicator(close=close, window=200).ema_indicator()
+    out["ema20"] = EMAIndicator(close=close, window=20).ema_indicator()
+    out["rsi2"] = RSIIndicator(close=close, window=2).rsi()
+    out["atr14"] = AverageTrueRange(high=high, low=low, close=close, window=14).average_true_range()
+    out["roll_high20"] = df["high"].rolling(20, min_periods=20).max()
+    out["roll_low20"] = df["low"].rolling(20, min_periods=20).min()
+    return out
+
+
+def random_ohlcv(bars: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, bars)))
+    # Repeated closes exercise the zero-move branches of RSI
+    close[rng.random(bars) < 0.05] = np.nan
+    close = pd.Series(close).ffill().bfill().to_numpy()
+    open_ = np.concatenate([[close[0]], close[:-1]])
+    spread = np.abs(rng.normal(0, 0.005, bars)) * close
+    index = pd.date_range("2024-01-01", periods=bars, freq="15min", tz="UTC", name="timestamp")
+    return pd.DataFrame({
+        "open": open_,
+        "high": np.maximum(open_, close) + spread,
+        "low": np.minimum(open_, close) - spread,
+        "close": close,
+        "volume": rng.random(bars) * 1000,
+    }, index=index)
+
+
+def compare(expected: pd.Series, actual: pd.Series, rtol: float) -> float:
+    expected = expected.to_numpy(dtype=np.float64)
+    actual = actual.to_numpy(dtype=np.float64)
+    if not np.array_equal(np.isnan(expected), np.isnan(actual)):
+        return math.inf
+    mask = ~np.isnan(expected)
+    if not mask.any():
+        return 0.0
+    error = np.abs(expected[mask] - actual[mask]) / np.maximum(np.abs(expected[mask]), 1e-12)
+    return float(error.max()) if error.max() > rtol else 0.0
+
+
+def run_harness(args: argparse.Namespace) -> int:
+    # Compare the streaming engine with ta on random series: bar by bar
+    # (replay), and as the last, still-forming bar of every prefix (sync).
+    failures = 0
+    for seed in range(args.seeds):
+        df = random_ohlcv(args.bars, seed)
+        expected = compute_indicators_ta(df)
+        actual = compute_indicators(df)
+        for column in ("ema200", "ema20", "rsi2", "atr14", "roll_high20", "roll_low20"):
+            error = compare(expected[column], actual[column], args.rtol)
+            if error:
+                failures += 1
+                print(f"seed {seed} {column}: max relative error {error:.3g}", file=sys.stderr)
+
+        engine = IndicatorEngine()
+        for end in range(1, len(df) + 1):
+            values = engine.sync(df.iloc[:end])
+            for column, value in values.items():
+                reference = actual[column].iloc[end - 1]
+                if not (value == reference or (math.isnan(value) and math.isnan(reference))):
+                    failures += 1
+                    print(f"seed {seed} bar {end - 1} {column}: sync {value} != replay {reference}", file=sys.stderr)
+    print(f"{args.seeds} series x {args.bars} bars: {'OK' if not failures else f'{failures} mismatches'}")
+    return 1 if failures else 0
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Check the streaming indicators against ta")
+    p.add_argument("--bars", type=int, default=1000, help="Bars per random series")
+    p.add_argument("--seeds", type=int, default=5, help="Number of random series")
+    p.add_argument("--rtol", type=float, default=1e-9, help="Allowed relative difference")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_harness(parse_args(sys.argv[1:])))
@@ -6,7 +6,12 @@ This tool extracts Kodi add-ons from their respective locations and
 copies the appropriate files into a Kodi add-on repository. Each add-on
 is placed in its own directory. Each contains the add-on metadata files
 and a zip archive. In addition, the repository catalog "addons.xml" is
-placed in the repository folder.
+placed in the repository folder, along with a gzip copy when --compressed
+is given. Copies compressed with gzip, zstd or brotli can be added with
+--precompress, (the latter two need the zstandard and brotli modules).
+Every copy gets its own checksum files. Finally "manifest.json" in the
+data directory lists the size and SHA-256 of every published file, so
+that static file servers and mirrors never need to hash them.
 
 Each add-on location is either a local path or a URL. If it is a local
 path, it can be to either an add-on folder or an add-on ZIP archive. If
@@ -42,43 +47,189 @@ Repository:
 /kodi-plugin.program.remote.control.browser.git\
 :plugin.program.remote.control.browser
 
-This script has been tested with Python 2.7.6 and Python 3.4.3. It
-depends on the GitPython module.
+Before anything is published, the imports of every add-on in the new
+catalog are resolved against the same catalog. An import must be present at the
+required version or later, unless it is optional or provided by Kodi,
+(xbmc.* and kodi.*), or by another repository, (see --external). The
+xbmc.python version must also match the Python API of the Kodi version.
+Problems are reported, and with --strict-requires nothing is published:
+add-ons are built into a staging folder, which is only moved into place
+once the check passes. The result is cached by a hash of the current
+catalog and the imports of the fetched add-ons.
+
+Builds are incremental. Each target folder keeps a build manifest that
+records a hash of every add-on's sources, (the git tree of the working
+copy, its tags and the Kodi version transform). An add-on whose hash is
+unchanged since the last run keeps its published archive. Use --force to
+rebuild everything.
+
+Add-on folders are packaged in place. The version, news and changelog
+rewrites happen in memory, so the sources are never copied or modified.
+With --snapshot the files are read from the git index rather than the
+working tree.
+
+Git repositories are kept as bare mirrors in the cache folder, (see
+--cachedir), so later runs only fetch new commits. Add-ons are archived
+straight from the mirror without a checkout.
+
+With --watch the tool keeps running after the first build and rebuilds
+an add-on as soon as its sources or git refs change. Changes are noticed
+through inotify when the inotify_simple module is installed, and by
+polling otherwise. Git URLs are polled every minute.
+
+Old versions pile up in every add-on folder. With --keep N, only the
+newest N versions of each add-on are kept, besides the version in the
+catalog and any version given with --pin ID=VERSION. Their archives,
+checksums and changelogs are removed after the catalog is written,
+along with blobs that nothing links to any more. A pin without the
+Kodi version suffix matches every Kodi version, (e.g. 2.0.5 keeps
+2.0.5_leia), and a pin that matches no published version is reported.
+Add --dry-run to list the files instead. It only affects pruning: the
+add-ons, catalogs, inventory and manifest are still built and written.
+
+To find out where a slow build spends its time, --profile PATH writes
+the wall time, CPU time, bytes read and written and peak memory of every
+build stage, add-on and Kodi version to a JSON report, and prints a
+summary of it. The peak memory is that of the stage itself, which only
+Linux can report.
+
+A published repository can be checked with:
+
+    create_repository.py verify --datadir=~/html/software/kodi
+
+This compares every archive and catalog, including each compressed copy
+of a catalog, with its checksum files, each copy with the catalog, and
+every archive's addon.xml with its folder, its file name and the
+catalog. Any problem is reported and the exit status is non-zero, as it
+is when the data directory has no addons.xml at all.
+
+Every build also records each published archive in ".inventory.sqlite"
+in the data directory: its add-on ID, version, Kodi version, path, size,
+SHA-256, build time and the add-ons that it imports. Archives removed by
+--keep are dropped from it. It can be listed without opening any archive:
+
+    create_repository.py query --datadir=~/html/software/kodi \
+        --required-by=script.module.requests --latest
+
+Archives built from folders are reproducible: members are sorted, carry
+the time of the last commit and have normalized permissions. Identical
+archives and metadata files are hard linked to a content-addressed blob
+store in the ".blobs" folder of the data directory, unless --no-dedupe
+is given.
+
+This script needs Python 3.8 or later. It depends on the GitPython
+module.
 """
 
 __author__ = "Chad Parry"
 __contact__ = "github@chad.parry.org"
 __copyright__ = "Copyright 2016 Chad Parry"
 __license__ = "GNU GENERAL PUBLIC LICENSE. Version 2, June 1991"
-__version__ = "1.3.0"
+__version__ = "1.4.0"
 
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 import fnmatch
+import functools
 import git
 import gzip
 import hashlib
 import io
+import json
+import mmap
 import os
+import pickle
 import re
 import shutil
+import sqlite3
+import stat
+import struct
 import sys
 import tempfile
-import threading
+import time
+import traceback
 import xml.etree.ElementTree
+import xml.parsers.expat
 import zipfile
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Git mirrors are not locked on platforms without flock, (e.g. Windows).
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    # Catalogs cannot be precompressed with zstd.
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    # Catalogs cannot be precompressed with brotli.
+    brotli = None
+
+try:
+    import inotify_simple
+except ImportError:
+    # Watch mode polls the add-on sources instead.
+    inotify_simple = None
 
 
 AddonMetadata = collections.namedtuple('AddonMetadata',
                                        ('id', 'version', 'root'))
+BuildRecord = collections.namedtuple('BuildRecord', ('source', 'key'))
+AddonBuild = collections.namedtuple('AddonBuild',
+                                    ('kodi_version', 'addon_metadata',
+                                     'build_record'))
 WorkerResult = collections.namedtuple('WorkerResult',
-                                      ('addon_metadata', 'exc_info'))
-AddonWorker = collections.namedtuple('AddonWorker',
-                                     ('thread', 'result_slot'))
+                                      ('builds', 'exc_info', 'stages'))
+StageRecord = collections.namedtuple('StageRecord',
+                                     ('addon', 'kodi_version', 'stage',
+                                      'wall_time', 'cpu_time', 'bytes_read',
+                                      'bytes_written', 'peak_rss'))
+SourceFile = collections.namedtuple('SourceFile', ('path', 'mode', 'read'))
+ArchiveMember = collections.namedtuple('ArchiveMember',
+                                       ('name', 'date_time', 'external_attr',
+                                        'compress_type', 'crc', 'file_size',
+                                        'compressed'))
 
 
 INFO_BASENAME = 'addon.xml'
+CATALOG_BASENAME = 'addons.xml'
+CATALOG_HEADER = b"<?xml version='1.0' encoding='UTF-8'?>\n<addons>"
+CATALOG_FOOTER = b'</addons>'
+CATALOG_ENCODINGS = ('gz', 'zst', 'br')
+CATALOG_ZSTD_LEVEL = 19
+CATALOG_BROTLI_QUALITY = 11
+PUBLISH_MANIFEST_BASENAME = 'manifest.json'
+INVENTORY_BASENAME = '.inventory.sqlite'
+INVENTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    kodi_version TEXT NOT NULL,
+    addon_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    built REAL NOT NULL,
+    PRIMARY KEY (kodi_version, addon_id, version));
+CREATE INDEX IF NOT EXISTS archives_path ON archives (path);
+CREATE TABLE IF NOT EXISTS requires (
+    kodi_version TEXT NOT NULL,
+    addon_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    import_id TEXT NOT NULL,
+    import_version TEXT,
+    optional INTEGER NOT NULL,
+    PRIMARY KEY (kodi_version, addon_id, version, import_id));
+CREATE INDEX IF NOT EXISTS requires_import_id ON requires (import_id);
+'''
 METADATA_BASENAMES = (
     INFO_BASENAME,
     'icon.png',
@@ -92,6 +243,181 @@ BUILD_VERSIONS = {
     'leia':
         {'python-api': None} #  do not alter
 }
+BUILD_MANIFEST_BASENAME = '.build-manifest.json'
+BLOB_FOLDER_BASENAME = '.blobs'
+STAGING_FOLDER_BASENAME = '.staging'
+DIGEST_CACHE_FOLDER_BASENAME = 'digests'
+REQUIRES_CACHE_FOLDER_BASENAME = 'requires'
+MIRROR_FOLDER_BASENAME = 'mirrors'
+
+DEFAULT_DIGESTS = ('md5',)
+# The shake algorithms have no fixed digest length, so hexdigest() cannot
+# be called without one.
+DIGEST_ALGORITHMS = tuple(sorted(
+    algorithm for algorithm in hashlib.algorithms_guaranteed
+    if not algorithm.startswith('shake_')))
+COPY_BUFFER_SIZE = 1024 * 1024
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.zip', '.gz', '.mp3',
+                     '.mp4')
+# These are provided by Kodi itself rather than by any repository.
+KODI_ADDON_PATTERNS = ('xbmc.*', 'kodi.*')
+IGNORE_PATTERNS = ('*.pyc', '*.pyo', '*.swp', '*.zip', '.gitignore',
+                   '.gitattributes', '.travis.yml', 'requirements.txt',
+                   '__pycache__', 'tox.ini', '.tox')
+FICLONE = 0x40049409
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP_VERSION = 20
+ZIP_SYSTEM_UNIX = 3
+ZIP_MAX_SIZE = 0xffffffff
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+WATCH_INTERVAL = 1.0
+WATCH_SETTLE_TIME = 0.2
+REMOTE_WATCH_INTERVAL = 60.0
+
+PROFILE_ROW = '{:<48.48} {:>5} {:>9} {:>9} {:>9} {:>9} {:>9}'
+
+BuildOptions = collections.namedtuple('BuildOptions',
+                                      ('snapshot', 'digests',
+                                       'compression_level', 'blob_folder',
+                                       'cache_folder', 'catalog_encodings',
+                                       'external_addons', 'strict_requires',
+                                       'compression_threads'),
+                                      defaults=(False, DEFAULT_DIGESTS,
+                                                zlib.Z_DEFAULT_COMPRESSION,
+                                                None, None, (), (), False,
+                                                None))
+RetentionPolicy = collections.namedtuple('RetentionPolicy',
+                                         ('keep', 'pinned', 'dry_run'),
+                                         defaults=((), False))
+
+
+# The stages timed so far in this process, (see profile_stage).
+stage_records = []
+# The peak RSS of each stage that is still running in this process, from the
+# outermost to the innermost.
+open_stage_peaks = []
+
+
+def get_resource_usage():
+    # Return the CPU time and the bytes read and written by this process,
+    # where the platform reports them. The CPU time includes finished child
+    # processes, such as git.
+    times = os.times()
+    cpu_time = (times.user + times.system + times.children_user +
+                times.children_system)
+    bytes_read = bytes_written = None
+    try:
+        with open('/proc/self/io', 'rb') as io_file:
+            counters = dict(
+                line.split(b': ', 1) for line in io_file.read().splitlines())
+        bytes_read = int(counters[b'rchar'])
+        bytes_written = int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return (cpu_time, bytes_read, bytes_written)
+
+
+def get_peak_rss():
+    # Return the peak RSS of this process since the last reset_peak_rss().
+    try:
+        with open('/proc/self/status', 'rb') as status_file:
+            for line in status_file:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Start a new peak RSS measurement, which Linux supports since 4.0.
+    # Elsewhere the peak is not reported, since the lifetime peak of a pool
+    # worker would include every stage that ran in it before.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def profile_stage(addon, stage, kodi_version=None):
+    # Stages can be nested, so the peak RSS of the enclosing stage so far is
+    # saved before the measurement is reset, and it is passed on at the end.
+    if open_stage_peaks and open_stage_peaks[-1] is not None:
+        open_stage_peaks[-1] = max(
+            open_stage_peaks[-1], get_peak_rss() or 0)
+    open_stage_peaks.append(0 if reset_peak_rss() else None)
+    start_time = time.perf_counter()
+    start_usage = get_resource_usage()
+    try:
+        yield
+    finally:
+        end_usage = get_resource_usage()
+        (bytes_read, bytes_written) = (
+            None if start is None or end is None else end - start
+            for (start, end) in zip(start_usage[1:], end_usage[1:]))
+        peak_rss = open_stage_peaks.pop()
+        if peak_rss is not None:
+            peak_rss = max(peak_rss, get_peak_rss() or 0) or None
+        if open_stage_peaks and open_stage_peaks[-1] is not None:
+            open_stage_peaks[-1] = max(open_stage_peaks[-1], peak_rss or 0)
+        stage_records.append(StageRecord(
+            addon, kodi_version, stage, time.perf_counter() - start_time,
+            end_usage[0] - start_usage[0], bytes_read, bytes_written,
+            peak_rss))
+
+
+def format_profile_summary(records):
+    # Total the records by stage and by add-on.
+    def megabytes(size):
+        return '-' if size is None else '{:.1f}'.format(size / 1048576.0)
+
+    def add_rows(lines, title, key):
+        totals = collections.OrderedDict()
+        for record in records:
+            total = totals.setdefault(key(record), [0, 0.0, 0.0, None, None,
+                                                    None])
+            total[0] += 1
+            total[1] += record.wall_time
+            total[2] += record.cpu_time
+            for (index, value) in ((3, record.bytes_read),
+                                   (4, record.bytes_written)):
+                if value is not None:
+                    total[index] = (total[index] or 0) + value
+            if record.peak_rss is not None:
+                total[5] = max(total[5] or 0, record.peak_rss)
+        lines.append(PROFILE_ROW.format(
+            title, 'Runs', 'Wall s', 'CPU s', 'Read MiB', 'Write MiB',
+            'RSS MiB'))
+        for (name, total) in totals.items():
+            lines.append(PROFILE_ROW.format(
+                name, total[0], '{:.3f}'.format(total[1]),
+                '{:.3f}'.format(total[2]), megabytes(total[3]),
+                megabytes(total[4]), megabytes(total[5])))
+        lines.append('')
+
+    lines = []
+    add_rows(lines, 'Stage', lambda record: record.stage)
+    add_rows(lines, 'Add-on', lambda record: '{} ({})'.format(
+        record.addon, record.kodi_version or 'all')
+        if record.addon is not None else '(repository)')
+    return '\n'.join(lines)
+
+
+def write_profile_report(profile_path, records):
+    report = {
+        'version': __version__,
+        'time': time.time(),
+        'stages': [record._asdict() for record in records]}
+    with atomic_write(profile_path) as report_file:
+        report_file.write(json.dumps(report, indent=2).encode('utf-8'))
+    sys.stderr.write(format_profile_summary(records))
 
 
 def get_archive_basename(addon_metadata):
@@ -105,6 +431,12 @@ def get_metadata_basenames(addon_metadata):
                 'changelog-{}.txt'.format(addon_metadata.version))])
 
 
+def get_default_cache_folder():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'kodi-repository')
+
+
 def is_url(addon_location):
     return bool(re.match('[A-Za-z0-9+.-]+://.', addon_location))
 
@@ -123,34 +455,324 @@ def parse_metadata(metadata_file):
     return addon_metadata
 
 
-def generate_checksum(archive_path):
-    checksum_path = '{}.md5'.format(archive_path)
-    checksum = hashlib.md5()
-    with open(archive_path, 'rb') as archive_contents:
-        for chunk in iter(lambda: archive_contents.read(4096), b''):
-            checksum.update(chunk)
-    with open(checksum_path, 'w') as sig:
-        sig.write(checksum.hexdigest())
+class HashingWriter(object):
+    """File wrapper that digests everything written through it."""
 
+    def __init__(self, target_file, algorithms):
+        self.target_file = target_file
+        self.checksums = collections.OrderedDict(
+            (algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
 
-def get_commit_names(repo, tag1, tag2):
-    rev = '{0}...{1}'.format(tag1, tag2)
-    clist = repo.iter_commits(rev=rev)
-    commits = [c.message.splitlines()[0] for c in clist]
+    def write(self, data):
+        for checksum in self.checksums.values():
+            checksum.update(data)
+        return self.target_file.write(data)
+
+    def flush(self):
+        self.target_file.flush()
+
+    def hexdigests(self):
+        return collections.OrderedDict(
+            (algorithm, checksum.hexdigest())
+            for (algorithm, checksum) in self.checksums.items())
+
+
+class BrotliWriter(object):
+    """File wrapper that compresses everything written through it."""
+
+    def __init__(self, target_file, quality=CATALOG_BROTLI_QUALITY):
+        self.target_file = target_file
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def write(self, data):
+        self.target_file.write(self.compressor.process(data))
+
+    def close(self):
+        self.target_file.write(self.compressor.finish())
+
+
+def get_checksum_paths(archive_path, algorithms):
+    return ['{}.{}'.format(archive_path, algorithm)
+            for algorithm in algorithms]
+
+
+def get_digest_algorithms(options):
+    # The blob store is addressed by SHA-256.
+    algorithms = list(options.digests)
+    if options.blob_folder is not None and 'sha256' not in algorithms:
+        algorithms.append('sha256')
+    return algorithms
+
+
+def publish_archive(archive_path, write_contents, options):
+    # Write an archive and its checksum files, then share its inode with
+    # any identical archive already in the blob store.
+    algorithms = get_digest_algorithms(options)
+    with atomic_write(archive_path) as archive:
+        archive_writer = HashingWriter(archive, algorithms)
+        write_contents(archive_writer)
+    hexdigests = archive_writer.hexdigests()
+    write_checksums(archive_path, collections.OrderedDict(
+        (algorithm, hexdigests[algorithm]) for algorithm in options.digests))
+    if options.blob_folder is not None:
+        store_blob(archive_path, hexdigests['sha256'], options.blob_folder)
+
+
+def write_checksums(archive_path, hexdigests):
+    for (algorithm, hexdigest) in hexdigests.items():
+        with atomic_write('{}.{}'.format(archive_path, algorithm)) as sig:
+            sig.write(hexdigest.encode('ascii'))
+
+
+def hash_file(path, algorithms):
+    checksums = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(path, 'rb') as source_file:
+        if os.fstat(source_file.fileno()).st_size:
+            with mmap.mmap(source_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as contents:
+                view = memoryview(contents)
+                for offset in range(0, len(view), COPY_BUFFER_SIZE):
+                    chunk = view[offset:offset + COPY_BUFFER_SIZE]
+                    for checksum in checksums:
+                        checksum.update(chunk)
+                    chunk.release()
+                view.release()
+    return collections.OrderedDict(
+        (algorithm, checksum.hexdigest())
+        for (algorithm, checksum) in zip(algorithms, checksums))
+
+
+def generate_checksum(archive_path, algorithms=DEFAULT_DIGESTS):
+    write_checksums(archive_path, hash_file(archive_path, algorithms))
+
+
+def get_digest_cache_path(cache_folder, path):
+    return os.path.join(
+        cache_folder, DIGEST_CACHE_FOLDER_BASENAME, '{}.json'.format(
+            hash_build_inputs(os.path.abspath(path))))
+
+
+def get_file_digests(path, algorithms, cache_folder=None):
+    # Hash a file once for as long as it is unchanged. The digests are
+    # cached per path, along with the inode, size and modification time
+    # that they were computed for.
+    if cache_folder is None:
+        return hash_file(path, algorithms)
+    path_stat = os.stat(path)
+    file_key = [path_stat.st_dev, path_stat.st_ino, path_stat.st_size,
+                path_stat.st_mtime_ns]
+    cache_path = get_digest_cache_path(cache_folder, path)
+    hexdigests = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            record = json.loads(cache_file.read().decode('utf-8'))
+        if record.get('key') == file_key:
+            hexdigests = record['digests']
+    missing = [algorithm for algorithm in algorithms
+               if algorithm not in hexdigests]
+    if missing:
+        hexdigests.update(hash_file(path, missing))
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with atomic_write(cache_path) as cache_file:
+            cache_file.write(json.dumps(
+                {'path': os.path.abspath(path), 'key': file_key,
+                 'digests': hexdigests}, sort_keys=True).encode('utf-8'))
+    return collections.OrderedDict(
+        (algorithm, hexdigests[algorithm]) for algorithm in algorithms)
+
+
+def prune_digest_cache(cache_folder):
+    # Drop the cached digests of files that no longer exist, so that the
+    # cache stays as large as the set of files that are hashed.
+    digest_folder = os.path.join(cache_folder, DIGEST_CACHE_FOLDER_BASENAME)
+    if not os.path.isdir(digest_folder):
+        return
+    for basename in os.listdir(digest_folder):
+        cache_path = os.path.join(digest_folder, basename)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                record = json.loads(cache_file.read().decode('utf-8'))
+        except (OSError, ValueError):
+            continue
+        # Entries of the older format, which were keyed by inode, have no
+        # path and are dropped as well.
+        path = record.get('path')
+        if path is None or not os.path.isfile(path):
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+
+
+def clone_file(source_path, target_path):
+    # Copy a file without passing its contents through Python. Prefer a
+    # reflink, which shares the data on copy-on-write filesystems, and then
+    # copy_file_range, which copies inside the kernel.
+    with open(source_path, 'rb') as source_file, atomic_write(
+            target_path) as target_file:
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE,
+                            source_file.fileno())
+                return
+            except OSError:
+                pass
+        try:
+            remaining = os.fstat(source_file.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    source_file.fileno(), target_file.fileno(), remaining)
+                if not copied:
+                    break
+                remaining -= copied
+            if remaining <= 0:
+                return
+        except (AttributeError, OSError):
+            pass
+        # Start over with a plain copy.
+        source_file.seek(0)
+        target_file.seek(0)
+        target_file.truncate()
+        shutil.copyfileobj(source_file, target_file, COPY_BUFFER_SIZE)
+
+
+@contextlib.contextmanager
+def atomic_write(target_path):
+    # Published files may be hard links into the blob store, so they are
+    # always replaced rather than overwritten in place.
+    tmp_path = '{}.{}.tmp'.format(target_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as target_file:
+            yield target_file
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_blob_path(blob_folder, hexdigest):
+    return os.path.join(blob_folder, hexdigest[:2], hexdigest)
+
+
+def link_blob(blob_path, target_path):
+    if os.path.exists(target_path) and os.path.samefile(
+            blob_path, target_path):
+        return
+    link_path = '{}.{}.link'.format(target_path, os.getpid())
+    os.link(blob_path, link_path)
+    os.replace(link_path, target_path)
+
+
+def store_blob(path, hexdigest, blob_folder):
+    # Make every published file with the same contents share one inode.
+    if blob_folder is None:
+        return
+    blob_path = get_blob_path(blob_folder, hexdigest)
+    try:
+        if os.path.isfile(blob_path):
+            link_blob(blob_path, path)
+        else:
+            if not os.path.isdir(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.link(path, blob_path)
+    except FileExistsError:
+        # Another worker stored the same contents first.
+        link_blob(blob_path, path)
+    except OSError:
+        # Hard links are not supported here, so keep the plain copy.
+        pass
+
+
+def write_file(target_path, contents, blob_folder=None):
+    hexdigest = hashlib.sha256(contents).hexdigest()
+    if blob_folder is not None and os.path.isfile(
+            get_blob_path(blob_folder, hexdigest)):
+        # Unchanged output costs a hash and a link rather than a write.
+        try:
+            link_blob(get_blob_path(blob_folder, hexdigest), target_path)
+            return
+        except OSError:
+            pass
+    with atomic_write(target_path) as target_file:
+        target_file.write(contents)
+    store_blob(target_path, hexdigest, blob_folder)
+
+
+def get_tag_commits(repo):
+    # List the tags in the same order as repo.tags, with the commit that
+    # each one points to.
+    tags = []
+    for line in repo.git.for_each_ref(
+            '--format=%(refname:strip=2) %(objectname) %(*objectname)',
+            'refs/tags').splitlines():
+        fields = line.split()
+        tags.append((fields[0], fields[-1]))
+    return tags
+
+
+def get_commit_log(repo):
+    # Read the whole history reachable from HEAD and the tags in one walk.
+    commits = collections.OrderedDict()
+    log = repo.git.log('-z', '--topo-order', '--format=%H %P%n%B', 'HEAD',
+                       '--tags')
+    for record in log.split('\0'):
+        if not record:
+            continue
+        (header, _, message) = record.partition('\n')
+        (sha, parents) = (header.split()[0], header.split()[1:])
+        commits[sha] = (parents, next(iter(message.splitlines()), ''))
     return commits
 
 
-def generate_changelog(repo):
-    tags = [t.name for t in repo.tags]
+def bucket_commits(commits, tips):
+    # The tips are ordered from the newest to the oldest. Each commit goes
+    # to the bucket of the oldest tip that contains it.
+    owners = {}
+    for (index, tip) in reversed(list(enumerate(tips))):
+        pending = [tip]
+        while pending:
+            sha = pending.pop()
+            if sha in owners or sha not in commits:
+                continue
+            owners[sha] = index
+            pending.extend(commits[sha][0])
+    buckets = [[] for tip in tips]
+    for (sha, (parents, subject)) in commits.items():
+        if sha in owners:
+            buckets[owners[sha]].append(subject)
+    return buckets
+
+
+def generate_changelog(repo, cache_folder=None):
+    tag_commits = get_tag_commits(repo)
     ver = get_version(repo)
-    tags.append('v' + ver)
-    tags.reverse()
+    head = repo.head.commit.hexsha
+
+    # The changelog only depends on HEAD and the tags.
+    cache_path = None
+    if cache_folder is not None:
+        cache_path = os.path.join(cache_folder, 'changelog', '{}.txt'.format(
+            hash_build_inputs(__version__, head, ver, tag_commits)))
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'rb') as cache_file:
+                return cache_file.read().decode('utf-8').split('\n')
+
+    # Order the tags from the newest to the oldest by their place in the
+    # history rather than by name, which would put v2.0.10 before v2.0.9.
+    commits = get_commit_log(repo)
+    positions = dict((sha, index) for (index, sha) in enumerate(commits))
+    tag_commits.reverse()
+    tag_commits.sort(key=lambda tag: positions.get(tag[1], len(positions)))
+    tag_commits.insert(0, ('v' + ver, head))
+    tags = [tag for (tag, sha) in tag_commits]
+    buckets = bucket_commits(commits, [sha for (tag, sha) in tag_commits])
     lines = []
     for i, tag in enumerate(tags):
         if i == len(tags)-1:
             commits = ['Initial version']
         else:
-            commits = get_commit_names(repo, tag, tags[i+1])
+            commits = buckets[i]
         if commits:
             lines.append("[B]Version {0}[/B]".format(tag))
             for commit in commits:
@@ -167,22 +789,19 @@ def generate_changelog(repo):
                     continue
                 lines.append(l)
             lines.append('')
-    return lines
-
-def write_changelog_file(addon_location, changelog):
-    changelog_file = os.path.join(addon_location, 'changelog.txt')
-    with open(changelog_file, 'w') as f:
-        f.writelines('\n'.join(changelog))
 
+    if cache_path is not None:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with atomic_write(cache_path) as cache_file:
+            cache_file.write('\n'.join(lines).encode('utf-8'))
+    return lines
 
 def get_version(repo):
     return repo.git.describe(tags=True).lstrip('v')
 
 
-def update_news(metadata_path, changelog):
-    tree = xml.etree.ElementTree.ElementTree(file=metadata_path)
-    root = tree.getroot()
-
+def update_news(root, changelog):
     metadata = root.find('extension[@point="xbmc.addon.metadata"]')
 
     news_tags = metadata.findall('news')
@@ -192,17 +811,8 @@ def update_news(metadata_path, changelog):
     news = xml.etree.ElementTree.SubElement(metadata, 'news')
     news.text = '\n'.join(changelog)
 
-    with open(metadata_path, 'wb') as info_file:
-        tree.write(info_file, encoding='UTF-8', xml_declaration=True)
-
 
-def update_version(metadata_path, version, kodi_version=None):
-    try:
-        tree = xml.etree.ElementTree.ElementTree(file=metadata_path)
-    except:
-        print(metadata_path)
-        raise
-    root = tree.getroot()
+def update_version(root, version, kodi_version=None):
     ver = version.replace('-','~').replace('~', '-', 1)
     if kodi_version:
         api_ver = BUILD_VERSIONS.get(kodi_version, {}).get('python-api')
@@ -213,141 +823,555 @@ def update_version(metadata_path, version, kodi_version=None):
         ver += '_{vers}'.format(vers=kodi_version)
     root.set('version', ver)
 
-    with io.BytesIO() as info_file:
-        tree.write(info_file, encoding='UTF-8', xml_declaration=True)
-        info_contents = info_file.getvalue()
-
-    with open(metadata_path, 'wb') as info_file:
-        info_file.write(info_contents)
-
-
-
-def copy_metadata_files(source_folder, addon_target_folder, addon_metadata):
-    for (source_basename, target_basename) in get_metadata_basenames(
-            addon_metadata):
-        source_path = os.path.join(source_folder, source_basename)
-        if os.path.isfile(source_path):
-            shutil.copyfile(source_path, os.path.join(addon_target_folder,
-                                                      target_basename))
 
+def render_addon_info(info_contents, version, kodi_version, changelog):
+    # Rewrite a pristine copy of addon.xml for one Kodi version.
+    tree = xml.etree.ElementTree.ElementTree(
+        xml.etree.ElementTree.fromstring(info_contents))
+    root = tree.getroot()
+    update_version(root, version, kodi_version)
+    update_news(root, changelog)
 
-def fetch_addon_from_git(addon_location, target_folder):
+    with io.BytesIO() as info_file:
+        tree.write(info_file, encoding='UTF-8', xml_declaration=True)
+        return info_file.getvalue()
+
+
+def get_zip_date_time(timestamp):
+    date_time = time.gmtime(timestamp)[:6]
+    if date_time[0] < 1980:
+        return ZIP_EPOCH
+    return date_time
+
+
+def get_zip_mode(mode):
+    # Only the executable bit survives, as in git.
+    if mode & 0o111:
+        return 0o755
+    return 0o644
+
+
+def compress_member(name, contents, date_time, mode=0o644,
+                    level=zlib.Z_DEFAULT_COMPRESSION):
+    crc = zlib.crc32(contents) & 0xffffffff
+    compress_type = zipfile.ZIP_STORED
+    compressed = contents
+    # Images and archives are already compressed, so just store them.
+    if level != 0 and not name.lower().endswith(STORED_EXTENSIONS):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(contents) + compressor.flush()
+        if len(deflated) < len(contents):
+            compress_type = zipfile.ZIP_DEFLATED
+            compressed = deflated
+    return ArchiveMember(name, date_time, (stat.S_IFREG | mode) << 16,
+                         compress_type, crc, len(contents), compressed)
+
+
+def compress_members(sources, level=zlib.Z_DEFAULT_COMPRESSION,
+                     max_workers=None):
+    # Deflate the members on a thread pool, since zlib releases the GIL
+    # while it compresses. The members keep the order of their sources.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda source: source and compress_member(*source, level=level),
+            sources))
+
+
+def write_archive(archive_file, members):
+    # Assemble a zip archive from members that are already compressed, so
+    # that the same members can be shared by several archives.
+    central_directory = []
+    offset = 0
+    for member in members:
+        name = member.name.encode('utf-8')
+        flag_bits = 0 if len(name) == len(member.name) else 0x800
+        (year, month, day, hour, minute, second) = member.date_time
+        dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        dos_date = ((year - 1980) << 9) | (month << 5) | day
+        if (max(offset, member.file_size, len(member.compressed)) >
+                ZIP_MAX_SIZE):
+            raise RuntimeError('Archive too large: ' + member.name)
+        header = (ZIP_VERSION, 0, flag_bits, member.compress_type,
+                  dos_time, dos_date, member.crc, len(member.compressed),
+                  member.file_size, len(name))
+        archive_file.write(ZIP_LOCAL_HEADER.pack(
+            b'PK\x03\x04', *(header + (0,))))
+        archive_file.write(name)
+        archive_file.write(member.compressed)
+        central_directory.append(ZIP_CENTRAL_HEADER.pack(
+            b'PK\x01\x02', ZIP_VERSION, ZIP_SYSTEM_UNIX,
+            *(header + (0, 0, 0, 0, member.external_attr, offset))) + name)
+        offset += (ZIP_LOCAL_HEADER.size + len(name) +
+                   len(member.compressed))
+    if len(central_directory) > 0xffff or offset > ZIP_MAX_SIZE:
+        raise RuntimeError('Archive has too many members')
+    directory_size = sum(len(header) for header in central_directory)
+    for header in central_directory:
+        archive_file.write(header)
+    archive_file.write(ZIP_END_RECORD.pack(
+        b'PK\x05\x06', 0, 0, len(central_directory), len(central_directory),
+        directory_size, offset, 0))
+
+
+def parse_git_location(addon_location):
     # Parse the format "REPOSITORY_URL#BRANCH:PATH". The colon is a delimiter
     # unless it looks more like a scheme, (e.g., "http://").
     match = re.match(
         '((?:[A-Za-z0-9+.-]+://)?.*?)(?:#([^#]*?))?(?::([^:]*))?$',
         addon_location)
-    (clone_repo, clone_branch, clone_path) = match.group(1, 2, 3)
+    return match.group(1, 2, 3)
+
+
+def get_source_name(addon_location):
+    if is_url(addon_location):
+        return addon_location
+    return os.path.abspath(os.path.expanduser(addon_location))
+
+
+def hash_build_inputs(*inputs):
+    key = hashlib.sha1()
+    for value in inputs:
+        key.update(json.dumps(value, sort_keys=True).encode('utf-8'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+def get_worktree_hash(repo):
+    # Stage the working tree copies of the tracked files into a scratch copy
+    # of the index, so that uncommitted changes to them are part of the hash.
+    # Untracked files are never packaged, so they are left out. The blobs
+    # and trees that this creates go to a scratch object folder, with the
+    # repository's objects as an alternate, so neither the real index nor
+    # the object database of the repository is written to. The copy keeps
+    # the modification time of the index, which git compares with those of
+    # the files to tell whether a file that changed without changing size
+    # must be hashed again.
+    with tempfile.TemporaryDirectory() as scratch_folder:
+        index_path = os.path.join(scratch_folder, 'index')
+        if os.path.isfile(repo.index.path):
+            shutil.copy2(repo.index.path, index_path)
+        object_folder = os.path.join(scratch_folder, 'objects')
+        os.mkdir(object_folder)
+        env = {
+            'GIT_INDEX_FILE': index_path,
+            'GIT_OBJECT_DIRECTORY': object_folder,
+            'GIT_ALTERNATE_OBJECT_DIRECTORIES': os.path.join(
+                repo.common_dir, 'objects')}
+        repo.git.execute(['git', 'add', '--update'], env=env)
+        return repo.git.execute(['git', 'write-tree'], env=env)
+
+
+def get_folder_source_key(addon_location, snapshot=False):
+    repo = git.Repo(os.path.expanduser(addon_location))
+    try:
+        return hash_build_inputs(
+            __version__,
+            snapshot,
+            repo.git.write_tree() if snapshot else get_worktree_hash(repo),
+            repo.head.commit.hexsha,
+            [(tag.name, tag.commit.hexsha) for tag in repo.tags],
+            get_version(repo))
+    finally:
+        repo.git.clear_cache()
 
-    # Create a temporary folder for the git clone.
-    clone_folder = tempfile.mkdtemp('repo-')
+
+def get_git_source_key(addon_location):
+    (clone_repo, clone_branch, clone_path) = parse_git_location(
+        addon_location)
+    refs = git.cmd.Git().ls_remote(clone_repo, clone_branch or 'HEAD')
+    commits = [line.split('\t') for line in refs.splitlines()]
+    if not commits:
+        raise RuntimeError('Branch not found: ' + str(clone_branch))
+    # Prefer the peeled commit of an annotated tag.
+    peeled = [sha for (sha, ref) in commits if ref.endswith('^{}')]
+    commit = (peeled or [commits[0][0]])[0]
+    return hash_build_inputs(
+        __version__, clone_repo, clone_branch, clone_path or '.', commit)
+
+
+def get_zip_source_key(addon_location, options):
+    # Digest the archive with every algorithm that publishing needs, so
+    # that it is read at most once.
+    algorithms = get_digest_algorithms(options)
+    if 'sha256' not in algorithms:
+        algorithms.append('sha256')
+    hexdigests = get_file_digests(
+        os.path.expanduser(addon_location), algorithms, options.cache_folder)
+    return hash_build_inputs(__version__, hexdigests['sha256'])
+
+
+def get_source_key(addon_location, options):
+    if is_url(addon_location):
+        return get_git_source_key(addon_location)
+    elif os.path.isdir(addon_location):
+        return get_folder_source_key(addon_location, options.snapshot)
+    elif os.path.isfile(addon_location):
+        return get_zip_source_key(addon_location, options)
+    return None
+
+
+def get_build_key(source_key, kodi_version, options):
+    return hash_build_inputs(
+        source_key, kodi_version, BUILD_VERSIONS.get(kodi_version),
+        options.compression_level)
+
+
+def load_build_manifest(target_folder):
+    manifest_path = os.path.join(target_folder, BUILD_MANIFEST_BASENAME)
+    if not os.path.isfile(manifest_path):
+        return {}
     try:
-        # Check out the sources.
-        cloned = git.Repo.clone_from(clone_repo, clone_folder)
-        if clone_branch is not None:
-            cloned.git.checkout(clone_branch)
-        clone_source_folder = os.path.join(clone_folder, clone_path or '.')
-
-        metadata_path = os.path.join(clone_source_folder, INFO_BASENAME)
-        addon_metadata = parse_metadata(metadata_path)
-        addon_target_folder = os.path.join(target_folder, addon_metadata.id)
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+    except ValueError:
+        # A corrupt manifest only costs a full rebuild.
+        return {}
+
+
+def save_build_manifest(target_folder, manifest):
+    manifest_path = os.path.join(target_folder, BUILD_MANIFEST_BASENAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_cached_build(manifest, build_record, target_folder, options):
+    entry = manifest.get(build_record.source)
+    if not entry or entry.get('key') != build_record.key:
+        return None
+    addon_target_folder = os.path.join(target_folder, entry['id'])
+    archive_path = os.path.join(addon_target_folder, entry['archive'])
+    metadata_path = os.path.join(addon_target_folder, INFO_BASENAME)
+    if not all(os.path.isfile(path) for path in [archive_path, metadata_path] +
+               get_checksum_paths(archive_path, options.digests)):
+        return None
+    addon_metadata = parse_metadata(metadata_path)
+    if get_archive_basename(addon_metadata) != entry['archive']:
+        return None
+    return addon_metadata
 
-        # Create the compressed add-on archive.
-        if not os.path.isdir(addon_target_folder):
-            os.mkdir(addon_target_folder)
-        archive_path = os.path.join(
-            addon_target_folder, get_archive_basename(addon_metadata))
-        with open(archive_path, 'wb') as archive:
-            cloned.archive(
-                archive,
-                treeish='HEAD:{}'.format(clone_path),
-                prefix='{}/'.format(addon_metadata.id),
-                format='zip')
-        generate_checksum(archive_path)
-
-        copy_metadata_files(
-            clone_source_folder, addon_target_folder, addon_metadata)
+
+@contextlib.contextmanager
+def locked_file(lock_path, exclusive=True):
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(),
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_mirror_path(mirror_folder, clone_repo):
+    return os.path.join(mirror_folder, '{}.git'.format(
+        hashlib.sha1(clone_repo.encode('utf-8')).hexdigest()))
+
+
+def update_mirror(clone_repo, mirror_path):
+    # Bring a bare mirror of the repository up to date, cloning it on first
+    # use. The caller must hold the mirror's lock.
+    if os.path.isdir(mirror_path):
+        mirror = git.Repo(mirror_path)
+        mirror.git.fetch('--prune', '--quiet', 'origin')
+        return mirror
+    # Clone next to the mirror so that an interrupted clone is never
+    # mistaken for a complete one.
+    tmp_path = '{}.{}.tmp'.format(mirror_path, os.getpid())
+    try:
+        git.Repo.clone_from(clone_repo, tmp_path, mirror=True)
+        os.rename(tmp_path, mirror_path)
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return git.Repo(mirror_path)
+
+
+def fetch_addon_from_mirror(addon_location, mirror_path, lock_path,
+                            clone_repo, clone_branch, clone_path,
+                            target_folder, options):
+    kodi_version = os.path.basename(target_folder)
+    with locked_file(lock_path), profile_stage(
+            addon_location, 'git fetch', kodi_version):
+        mirror = update_mirror(clone_repo, mirror_path)
+        commit = mirror.commit(clone_branch or 'HEAD')
+    try:
+        # Other workers may fetch into the mirror meanwhile, but the commit
+        # that was resolved above stays intact.
+        with locked_file(lock_path, exclusive=False):
+            source_tree = commit.tree
+            if clone_path and os.path.normpath(clone_path) != '.':
+                source_tree = source_tree / clone_path.strip('/')
+            blobs = dict((blob.name, blob) for blob in source_tree.blobs)
+            addon_metadata = parse_metadata(io.BytesIO(
+                read_blob(mirror, blobs[INFO_BASENAME].binsha)))
+            contents = dict(
+                (basename, read_blob(mirror, blobs[basename].binsha))
+                for (basename, target_basename)
+                in get_metadata_basenames(addon_metadata)
+                if basename in blobs)
+            addon_target_folder = os.path.join(
+                target_folder, addon_metadata.id)
+
+            # Create the compressed add-on archive straight from the
+            # mirror, without checking anything out.
+            if not os.path.isdir(addon_target_folder):
+                os.mkdir(addon_target_folder)
+            archive_path = os.path.join(
+                addon_target_folder, get_archive_basename(addon_metadata))
+            level_flag = {}
+            if options.compression_level != zlib.Z_DEFAULT_COMPRESSION:
+                level_flag[str(options.compression_level)] = True
+            with profile_stage(addon_location, 'archive', kodi_version):
+                publish_archive(archive_path, lambda archive: mirror.archive(
+                    archive,
+                    treeish=source_tree.hexsha,
+                    prefix='{}/'.format(addon_metadata.id),
+                    format='zip',
+                    **level_flag), options)
+
+        with profile_stage(addon_location, 'metadata', kodi_version):
+            write_metadata_files(addon_target_folder, addon_metadata,
+                                 contents, options.blob_folder)
 
         return addon_metadata
     finally:
-        shutil.rmtree(clone_folder, ignore_errors=False)
+        mirror.git.clear_cache()
 
 
-def fetch_addon_from_folder(raw_addon_location, target_folder, kodi_version):
-    addon_location = os.path.expanduser(raw_addon_location)
-    metadata_path = os.path.join(addon_location, INFO_BASENAME)
+def fetch_addon_from_git(addon_location, target_folder, options):
+    (clone_repo, clone_branch, clone_path) = parse_git_location(
+        addon_location)
 
+    if options.cache_folder is None:
+        # Without a cache, the mirror only lives for this build.
+        mirror_folder = tempfile.mkdtemp('repo-')
+    else:
+        mirror_folder = os.path.join(
+            options.cache_folder, MIRROR_FOLDER_BASENAME)
+        if not os.path.isdir(mirror_folder):
+            os.makedirs(mirror_folder, exist_ok=True)
+    mirror_path = get_mirror_path(mirror_folder, clone_repo)
     try:
-        repo = git.Repo(addon_location)
-        version = get_version(repo)
-
-        # Update addon metadata
-        update_version(metadata_path, version, kodi_version)
-        changelog = generate_changelog(repo)
-        write_changelog_file(addon_location, changelog)
-        update_news(metadata_path, changelog)
-
-        addon_metadata = parse_metadata(metadata_path)
-        addon_target_folder = os.path.join(target_folder, addon_metadata.id)
+        return fetch_addon_from_mirror(
+            addon_location, mirror_path, '{}.lock'.format(mirror_path),
+            clone_repo, clone_branch, clone_path, target_folder, options)
+    finally:
+        if options.cache_folder is None:
+            shutil.rmtree(mirror_folder, ignore_errors=False)
+
+
+def compile_ignore_patterns(patterns):
+    # Match hidden and test folders anywhere in the path, or a file name
+    # matching any of the shell patterns, with a single regular expression.
+    names = '|'.join(
+        re.escape(pattern).replace(r'\*', '[^/]*').replace(r'\?', '[^/]')
+        for pattern in patterns)
+    return re.compile(
+        r'(?:[^/]*/)*?(?:(?:\.[^/]*|tests)/|(?:{})$)'.format(names))
+
+
+IGNORE_MATCHER = compile_ignore_patterns(IGNORE_PATTERNS)
+
+
+def is_ignored_path(relative_path):
+    return IGNORE_MATCHER.match(relative_path) is not None
+
+
+def get_export_ignored_paths(repo, paths, cached=False):
+    # Honor export-ignore in .gitattributes, as git archive would.
+    if not paths:
+        return set()
+    args = ['git', 'check-attr', '-z', '--stdin']
+    if cached:
+        args.append('--cached')
+    args.append('export-ignore')
+    with tempfile.TemporaryFile() as path_list:
+        path_list.write(b''.join(
+            path.encode('utf-8') + b'\0' for path in paths))
+        path_list.seek(0)
+        fields = repo.git.execute(args, istream=path_list).split('\0')
+    # The output is a sequence of path, attribute and value fields.
+    return set(
+        fields[index] for index in range(0, len(fields) - 2, 3)
+        if fields[index + 2] == 'set')
+
+
+def read_file(path):
+    with open(path, 'rb') as source_file:
+        return source_file.read()
+
+
+def read_blob(repo, binsha):
+    return repo.odb.stream(binsha).read()
+
+
+def list_worktree_files(repo, addon_location):
+    # List the working tree copies of the files in the index, which are the
+    # same files that the source key covers. Untracked files are never
+    # packaged, even when .gitignore does not exclude them.
+    output = repo.git.ls_files('-z', '--cached')
+    paths = sorted(set(
+        path for path in output.split('\0')
+        if path and not is_ignored_path(path)))
+    export_ignored = get_export_ignored_paths(repo, paths)
+    for path in paths:
+        if path in export_ignored:
+            continue
+        full_path = os.path.join(addon_location, path)
+        # Skip deleted files and submodules.
+        if not os.path.isfile(full_path):
+            continue
+        yield SourceFile(path, stat.S_IMODE(os.stat(full_path).st_mode),
+                         functools.partial(read_file, full_path))
+
+
+def list_index_files(repo):
+    # List the files of the tree that the index would commit, which is the
+    # tree that the source key hashes. Like git write-tree, this leaves out
+    # the files that were only added with --intent-to-add.
+    entries = []
+    for line in repo.git.ls_tree(
+            '-r', '-z', '--full-tree', repo.git.write_tree()).split('\0'):
+        if not line:
+            continue
+        (info, path) = line.split('\t', 1)
+        (mode, object_type, hexsha) = info.split()
+        # Skip submodules.
+        if object_type != 'blob' or is_ignored_path(path):
+            continue
+        entries.append((path, int(mode, 8), hexsha))
+    export_ignored = get_export_ignored_paths(
+        repo, [path for (path, mode, hexsha) in entries], cached=True)
+    for (path, mode, hexsha) in entries:
+        if path in export_ignored:
+            continue
+        yield SourceFile(path, stat.S_IMODE(mode), functools.partial(
+            read_blob, repo, bytes.fromhex(hexsha)))
+
+
+def write_metadata_files(addon_target_folder, addon_metadata, contents,
+                         blob_folder=None):
+    for (source_basename, target_basename) in get_metadata_basenames(
+            addon_metadata):
+        if source_basename in contents:
+            write_file(os.path.join(addon_target_folder, target_basename),
+                       contents[source_basename], blob_folder)
 
-        ignore = ['*.pyc', '*.pyo', '*.swp', '*.zip', '.gitignore', '.travis.yml',
-                  'requirements.txt', '__pycache__', 'tox.ini', '.tox']
 
-        # Create the compressed add-on archive.
-        if not os.path.isdir(addon_target_folder):
-            os.mkdir(addon_target_folder)
-        archive_path = os.path.join(
-            addon_target_folder, get_archive_basename(addon_metadata))
-
-        with zipfile.ZipFile(archive_path, 'w',
-                             compression=zipfile.ZIP_DEFLATED) as archive:
-            for (root, dirs, files) in os.walk(addon_location):
-                # Filter ignored files
-                files = (n for n in files
-                         if not any(fnmatch.fnmatch(n, i) for i in ignore))
-                # Skip hidden dirs
-                dirs[:] = [d for d in dirs if not any([d[0] == '.', d == 'tests'])]
-
-                relative_root = os.path.join(
-                    addon_metadata.id, os.path.relpath(root, addon_location))
-                for relative_path in files:
-                    archive.write(
-                        os.path.join(root, relative_path),
-                        os.path.join(relative_root, relative_path))
-        generate_checksum(archive_path)
-
-        if not os.stat(addon_location) == os.stat(addon_target_folder):
-            copy_metadata_files(
-                addon_location, addon_target_folder, addon_metadata)
+def fetch_addon_from_folder(raw_addon_location, data_path, buildvers,
+                            options, staging_path=None):
+    # The outputs go to staging_path, when given, to be moved into data_path
+    # once the build is known to be good.
+    addon_location = os.path.expanduser(raw_addon_location)
+    builds = {}
 
+    repo = git.Repo(addon_location)
+    try:
+        version = get_version(repo)
+        # The changelog is the same for every Kodi version.
+        with profile_stage(raw_addon_location, 'changelog'):
+            changelog = generate_changelog(repo, options.cache_folder)
+        changelog_contents = '\n'.join(changelog).encode('utf-8')
+
+        # Read the sources in place, either from the working tree or from
+        # the git index, so that nothing is copied to disk.
+        if options.snapshot:
+            source_files = list_index_files(repo)
+        else:
+            source_files = list_worktree_files(repo, addon_location)
+
+        # Compress the files shared by all the Kodi versions once. Only the
+        # addon.xml member differs, so its slot is filled in per version.
+        contents = {}
+        with profile_stage(raw_addon_location, 'read sources'):
+            for source_file in source_files:
+                contents[source_file.path] = (
+                    source_file.read(), get_zip_mode(source_file.mode))
+        # The generated changelog replaces the stored one.
+        contents['changelog.txt'] = (changelog_contents, 0o644)
+        if INFO_BASENAME not in contents:
+            raise RuntimeError('Addon metadata not found: ' + addon_location)
+        metadata_contents = dict(
+            (path, contents[path][0]) for path in contents
+            if path in METADATA_BASENAMES or path == 'changelog.txt')
+        info_contents = metadata_contents[INFO_BASENAME]
+        addon_id = parse_metadata(io.BytesIO(info_contents)).id
+
+        # Keep archives reproducible: members are sorted and stamped with
+        # the time of the last commit rather than the file times.
+        date_time = get_zip_date_time(repo.head.commit.committed_date)
+        sources = [
+            ('{}/{}'.format(addon_id, path), contents[path][0], date_time,
+             contents[path][1]) if path != INFO_BASENAME else None
+            for path in sorted(contents)]
+        info_index = sorted(contents).index(INFO_BASENAME)
+        with profile_stage(raw_addon_location, 'compress'):
+            members = compress_members(sources, options.compression_level,
+                                       options.compression_threads)
+
+        for kodi_version in buildvers:
+            info_variant = render_addon_info(
+                info_contents, version, kodi_version, changelog)
+            addon_metadata = parse_metadata(io.BytesIO(info_variant))
+            addon_target_folder = os.path.join(
+                staging_path or data_path, kodi_version, addon_metadata.id)
+            published_folder = os.path.join(
+                data_path, kodi_version, addon_metadata.id)
+
+            # Create the compressed add-on archive.
+            if not os.path.isdir(addon_target_folder):
+                os.mkdir(addon_target_folder)
+            archive_path = os.path.join(
+                addon_target_folder, get_archive_basename(addon_metadata))
+            with profile_stage(raw_addon_location, 'archive', kodi_version):
+                members[info_index] = compress_member(
+                    '{}/{}'.format(addon_id, INFO_BASENAME), info_variant,
+                    date_time, contents[INFO_BASENAME][1],
+                    options.compression_level)
+                publish_archive(archive_path, lambda archive: write_archive(
+                    archive, members), options)
+
+            if not (os.path.isdir(published_folder) and
+                    os.stat(addon_location) == os.stat(published_folder)):
+                # Publish this version's addon.xml rather than the source one.
+                variant_contents = dict(metadata_contents)
+                variant_contents[INFO_BASENAME] = info_variant
+                with profile_stage(
+                        raw_addon_location, 'metadata', kodi_version):
+                    write_metadata_files(
+                        addon_target_folder, addon_metadata,
+                        variant_contents, options.blob_folder)
+            builds[kodi_version] = addon_metadata
+    finally:
         repo.git.clear_cache()
         repo.__del__()
-    finally:
-        import stat
-        for root, dirs, files in os.walk(addon_location):
-            for dir in dirs:
-                os.chmod(os.path.join(root, dir), stat.S_IRWXU)
-            for file in files:
-                os.chmod(os.path.join(root, file), stat.S_IRWXU)
-    return addon_metadata
+    return builds
 
 
-def fetch_addon_from_zip(raw_addon_location, target_folder):
+def fetch_addon_from_zip(raw_addon_location, target_folder, options,
+                         published_folder=None):
+    # The outputs go to target_folder, which may be a staging copy of
+    # published_folder.
     addon_location = os.path.expanduser(raw_addon_location)
-    with zipfile.ZipFile(
-            addon_location, compression=zipfile.ZIP_DEFLATED) as archive:
+    # Opening the archive only reads its central directory. Of the members,
+    # only the metadata files are read.
+    with zipfile.ZipFile(addon_location) as archive:
         # Find out the name of the archive's root folder.
         roots = frozenset(
-            next(iter(path.split(os.path.sep)), '')
-            for path in archive.namelist())
+            path.split('/', 1)[0] for path in archive.namelist())
         if len(roots) != 1:
             raise RuntimeError('Archive should contain one directory')
         root = next(iter(roots))
         if not root:
             raise RuntimeError('Archive should contain a directory')
 
-        metadata_file = archive.open(os.path.join(root, INFO_BASENAME))
-        addon_metadata = parse_metadata(metadata_file)
+        with archive.open(
+                '{}/{}'.format(root, INFO_BASENAME)) as metadata_file:
+            addon_metadata = parse_metadata(metadata_file)
         addon_target_folder = os.path.join(target_folder, addon_metadata.id)
 
         # Copy the metadata files.
@@ -356,139 +1380,1241 @@ def fetch_addon_from_zip(raw_addon_location, target_folder):
         for (source_basename, target_basename) in get_metadata_basenames(
                 addon_metadata):
             try:
-                source_file = archive.open(os.path.join(root, source_basename))
+                source_file = archive.open(
+                    '{}/{}'.format(root, source_basename))
             except KeyError:
                 continue
-            with open(
+            with source_file:
+                write_file(
                     os.path.join(addon_target_folder, target_basename),
-                    'wb') as target_file:
-                shutil.copyfileobj(source_file, target_file)
+                    source_file.read(), options.blob_folder)
 
     # Copy the archive.
     archive_basename = get_archive_basename(addon_metadata)
     archive_path = os.path.join(addon_target_folder, archive_basename)
-    if (not os.path.samefile(
-            os.path.dirname(addon_location), addon_target_folder) or
-            os.path.basename(addon_location) != archive_basename):
-        shutil.copyfile(addon_location, archive_path)
-    generate_checksum(archive_path)
+    with profile_stage(raw_addon_location, 'archive',
+                       os.path.basename(target_folder)):
+        # The digests are cached, so an unchanged archive is not read again.
+        hexdigests = get_file_digests(
+            addon_location, get_digest_algorithms(options),
+            options.cache_folder)
+        published_addon_folder = os.path.join(
+            published_folder or target_folder, addon_metadata.id)
+        if (not os.path.isdir(published_addon_folder) or
+                not os.path.samefile(os.path.dirname(addon_location),
+                                     published_addon_folder) or
+                os.path.basename(addon_location) != archive_basename):
+            ingest_archive(addon_location, archive_path, hexdigests, options)
+        write_checksums(archive_path, collections.OrderedDict(
+            (algorithm, hexdigests[algorithm])
+            for algorithm in options.digests))
 
     return addon_metadata
 
 
-def fetch_addon(addon_location, target_folder, result_slot, kodi_version):
-    tf = False
-    temp_folder = None
+def ingest_archive(addon_location, archive_path, hexdigests, options):
+    # The source is never hard linked itself, since rewriting it in place
+    # would change the published archive behind its checksum. An archive
+    # that is already in the blob store is linked from there instead.
+    if options.blob_folder is not None:
+        blob_path = get_blob_path(options.blob_folder, hexdigests['sha256'])
+        if os.path.isfile(blob_path):
+            try:
+                link_blob(blob_path, archive_path)
+                return
+            except OSError:
+                pass
+    clone_file(addon_location, archive_path)
+    if options.blob_folder is not None:
+        store_blob(archive_path, hexdigests['sha256'], options.blob_folder)
+
+
+def build_addon(addon_location, data_path, buildvers, options,
+                staging_path=None):
+    output_path = staging_path or data_path
+    builds = {}
+    if is_url(addon_location):
+        for kodi_version in buildvers:
+            builds[kodi_version] = fetch_addon_from_git(
+                addon_location, os.path.join(output_path, kodi_version),
+                options)
+    elif os.path.isdir(addon_location):
+        builds = fetch_addon_from_folder(
+            addon_location, data_path, buildvers, options, staging_path)
+    elif os.path.isfile(addon_location):
+        for kodi_version in buildvers:
+            builds[kodi_version] = fetch_addon_from_zip(
+                addon_location, os.path.join(output_path, kodi_version),
+                options, os.path.join(data_path, kodi_version))
+    else:
+        raise RuntimeError('Path not found: ' + addon_location)
+    return builds
+
+
+def fetch_addon(addon_location, data_path, buildvers, manifests, options,
+                staging_path=None):
+    # Worker processes are reused, so only send back this add-on's stages.
+    del stage_records[:]
     try:
-        if is_url(addon_location):
-            addon_metadata = fetch_addon_from_git(
-                addon_location, target_folder)
-        elif os.path.isdir(addon_location):
-            #  create separate folders for each version
-            temp_folder = os.path.join(addon_location, '.{vers}'.format(vers=kodi_version))
-            tf = True
-            shutil.copytree(addon_location, temp_folder, ignore=(shutil.ignore_patterns('.*')))
-            shutil.copytree(os.path.join(addon_location, '.git'), os.path.join(temp_folder, '.git'))
-            addon_metadata = fetch_addon_from_folder(
-                temp_folder, target_folder, kodi_version)
-        elif os.path.isfile(addon_location):
-            addon_metadata = fetch_addon_from_zip(
-                addon_location, target_folder)
-        else:
-            raise RuntimeError('Path not found: ' + addon_location)
-        result_slot.append(WorkerResult(addon_metadata, None))
+        with profile_stage(addon_location, 'source key'):
+            source_key = get_source_key(addon_location, options)
+        builds = []
+        for kodi_version in buildvers:
+            build_record = None
+            addon_metadata = None
+            if source_key is not None:
+                build_record = BuildRecord(
+                    get_source_name(addon_location),
+                    get_build_key(source_key, kodi_version, options))
+                # Reuse the published archive if its inputs have not changed.
+                addon_metadata = get_cached_build(
+                    manifests[kodi_version], build_record,
+                    os.path.join(data_path, kodi_version), options)
+            builds.append(
+                AddonBuild(kodi_version, addon_metadata, build_record))
+
+        stale = [build.kodi_version for build in builds
+                 if build.addon_metadata is None]
+        if stale:
+            built = build_addon(addon_location, data_path, stale, options,
+                                staging_path)
+            builds = [
+                build._replace(addon_metadata=built[build.kodi_version])
+                if build.kodi_version in built else build
+                for build in builds]
+        return WorkerResult(builds, None, list(stage_records))
     except Exception:
-        result_slot.append(WorkerResult(None, sys.exc_info()))
+        # Tracebacks cannot cross the process boundary, so send it as text.
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        try:
+            pickle.loads(pickle.dumps(exc_value))
+        except Exception:
+            exc_value = RuntimeError('{}: {}'.format(
+                exc_type.__name__, exc_value))
+        return WorkerResult(None, (
+            exc_type, exc_value,
+            ''.join(traceback.format_tb(exc_traceback))),
+            list(stage_records))
+
+
+def open_catalog(catalog_path):
+    if catalog_path.endswith('.gz'):
+        return gzip.open(catalog_path, 'rb')
+    return open(catalog_path, 'rb')
+
+
+def read_catalog_layout(catalog_path):
+    # Return the raw bytes that come before the first entry of a catalog,
+    # (the XML declaration, anything else in the prolog, the root start tag
+    # and the text after it), and those from the root end tag onwards, so
+    # that a merge which changes no entry rewrites the same bytes.
+    header = CATALOG_HEADER
+    footer = CATALOG_FOOTER
+    if catalog_path is None:
+        return (header, footer)
+    with open_catalog(catalog_path) as catalog_file:
+        parser = xml.parsers.expat.ParserCreate()
+        positions = []
+        depth = [0]
+
+        def start_element(name, attributes):
+            if depth[0] == 1 and not positions:
+                positions.append(parser.CurrentByteIndex)
+            depth[0] += 1
+
+        def end_element(name):
+            depth[0] -= 1
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        for chunk in iter(functools.partial(
+                catalog_file.read, COPY_BUFFER_SIZE), b''):
+            parser.Parse(chunk, False)
+            if positions:
+                break
+        if not positions:
+            return (header, footer)
+        catalog_file.seek(0)
+        header = catalog_file.read(positions[0])
+
+        # Catalogs end with the root end tag and maybe some whitespace, so
+        # the end of the file is enough to find the footer. Anything else
+        # there is replaced with the default footer.
+        try:
+            catalog_file.seek(-COPY_BUFFER_SIZE, io.SEEK_END)
+        except (OSError, ValueError):
+            # Either the catalog is shorter or it is compressed.
+            pass
+        tail = b''
+        for chunk in iter(functools.partial(
+                catalog_file.read, COPY_BUFFER_SIZE), b''):
+            tail = (tail + chunk)[-COPY_BUFFER_SIZE:]
+        content = tail.rstrip()
+        if content.endswith(CATALOG_FOOTER):
+            footer = CATALOG_FOOTER + tail[len(content):]
+    return (header, footer)
+
+
+def iter_catalog_entries(catalog_path):
+    # Stream the top-level elements of an existing catalog, discarding each
+    # one after it is consumed so that memory stays bounded.
+    with open_catalog(catalog_path) as catalog_file:
+        root = None
+        pending = None
+        depth = 0
+        for (event, element) in xml.etree.ElementTree.iterparse(
+                catalog_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                elif depth == 1 and pending is not None:
+                    # The previous entry's tail is only complete now.
+                    yield pending
+                    pending = None
+                    root.clear()
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                pending = element
+            elif depth == 0 and pending is not None:
+                yield pending
+
+
+def merge_catalog_entries(catalog_path, metadata):
+    # Each fetched add-on replaces the first catalog entry with the same
+    # id, in place. Any other entries with that id are dropped and add-ons
+    # that are new to the catalog are appended.
+    updates = collections.OrderedDict(
+        (addon_metadata.id, addon_metadata.root)
+        for addon_metadata in metadata)
+    merged = set()
+    if catalog_path is not None:
+        for entry in iter_catalog_entries(catalog_path):
+            addon_id = entry.get('id')
+            if addon_id not in updates:
+                yield entry
+            elif addon_id not in merged:
+                merged.add(addon_id)
+                # Keep the layout of the catalog around the new entry.
+                updates[addon_id].tail = entry.tail
+                yield updates[addon_id]
+    for (addon_id, root) in updates.items():
+        if addon_id not in merged:
+            yield root
+
+
+def is_version_satisfied(version, required_version):
+    return (required_version is None or
+            get_version_sort_key(version) >=
+            get_version_sort_key(required_version))
+
+
+def find_unresolved_requirements(kodi_version, entries, external_addons=()):
+    # Each entry is an (id, version, requirements) tuple. Every import
+    # should be in the same catalog, at the required version or later,
+    # unless it is optional or comes from Kodi or another repository. The
+    # unresolved imports of an add-on are reported together, as one line.
+    provided = dict((addon_id, version)
+                    for (addon_id, version, requirements) in entries)
+    api_version = BUILD_VERSIONS.get(kodi_version, {}).get('python-api')
+    external_patterns = KODI_ADDON_PATTERNS + tuple(external_addons)
+    problems = []
+    for (addon_id, version, requirements) in entries:
+        unresolved = []
+        missing = []
+        for (import_id, import_version, optional) in requirements:
+            if import_id == 'xbmc.python' and api_version and import_version:
+                # Kodi only runs add-ons written for its own major version
+                # of the Python API.
+                if (import_version.split('.')[0] !=
+                        api_version.split('.')[0] or
+                        not is_version_satisfied(api_version,
+                                                 import_version)):
+                    unresolved.append(
+                        'xbmc.python {}, but Kodi {} provides {}'.format(
+                            import_version, kodi_version, api_version))
+            elif import_id in provided:
+                if not is_version_satisfied(provided[import_id],
+                                            import_version):
+                    unresolved.append(
+                        '{} {}, but the catalog has {}'.format(
+                            import_id, import_version, provided[import_id]))
+            elif not optional and not any(
+                    fnmatch.fnmatchcase(import_id, pattern)
+                    for pattern in external_patterns):
+                missing.append(import_id)
+        if missing:
+            unresolved.append('{}, which {} not in the catalog'.format(
+                ', '.join(sorted(missing)),
+                'is' if len(missing) == 1 else 'are'))
+        if unresolved:
+            problems.append('{} {} requires {}'.format(
+                addon_id, version, '; '.join(unresolved)))
+    return problems
+
+
+# The results of find_unresolved_requirements by catalog hash, so that a
+# watch session only resolves a changed catalog.
+requirement_checks = {}
+
+
+def check_requirements(target_folder, kodi_version, metadata,
+                       options=BuildOptions()):
+    # Resolve the imports of the catalog that merge_catalog is about to
+    # write. The hash covers the bytes of the current catalog and the
+    # imports of the fetched add-ons, so the result is reused both in
+    # memory and from the cache folder for as long as none of them change,
+    # and the catalog is only parsed when it has to be resolved.
+    catalog_path = os.path.join(target_folder, CATALOG_BASENAME)
+    if not os.path.isfile(catalog_path):
+        catalog_path = None
+    catalog_hash = hash_build_inputs(
+        __version__, kodi_version, BUILD_VERSIONS.get(kodi_version),
+        sorted(options.external_addons),
+        catalog_path and get_file_digests(
+            catalog_path, ['sha256'], options.cache_folder)['sha256'],
+        [(addon_metadata.id, addon_metadata.version,
+          get_requirements(addon_metadata.root))
+         for addon_metadata in metadata])
+    if catalog_hash in requirement_checks:
+        return requirement_checks[catalog_hash]
+
+    cache_path = None
+    if options.cache_folder is not None:
+        cache_path = os.path.join(
+            options.cache_folder, REQUIRES_CACHE_FOLDER_BASENAME,
+            '{}.json'.format(catalog_hash))
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            problems = json.loads(cache_file.read().decode('utf-8'))
+    else:
+        entries = [
+            (root.get('id'), root.get('version'), get_requirements(root))
+            for root in merge_catalog_entries(catalog_path, metadata)]
+        problems = find_unresolved_requirements(
+            kodi_version, entries, options.external_addons)
+        if cache_path is not None:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with atomic_write(cache_path) as cache_file:
+                cache_file.write(json.dumps(problems).encode('utf-8'))
+    problems = ['{}: {}'.format(
+        os.path.join(target_folder, CATALOG_BASENAME), problem)
+        for problem in problems]
+    requirement_checks[catalog_hash] = problems
+    return problems
+
+
+def open_catalog_encoder(encoding, target_file):
+    if encoding == 'gz':
+        return gzip.GzipFile(
+            CATALOG_BASENAME, 'wb', fileobj=target_file, mtime=0)
+    elif encoding == 'zst':
+        return zstandard.ZstdCompressor(
+            level=CATALOG_ZSTD_LEVEL).stream_writer(target_file, closefd=False)
+    elif encoding == 'br':
+        return BrotliWriter(target_file)
+    raise RuntimeError('Unknown catalog encoding: ' + encoding)
+
+
+def merge_catalog(target_folder, metadata, encodings=(),
+                  algorithms=DEFAULT_DIGESTS):
+    # Write addons.xml, its precompressed copies and all their checksum
+    # files in a single pass over the merged entries. Kodi always reads
+    # addons.xml.md5, so that one is written regardless of the algorithms.
+    catalog_path = os.path.join(target_folder, CATALOG_BASENAME)
+    previous_path = None
+    for path in (catalog_path, catalog_path + '.gz'):
+        if os.path.isfile(path):
+            previous_path = path
+            break
+    algorithms = list(algorithms)
+    if 'md5' not in algorithms:
+        algorithms.insert(0, 'md5')
+
+    writers = collections.OrderedDict()
+    with contextlib.ExitStack() as stack:
+        writers[catalog_path] = HashingWriter(
+            stack.enter_context(atomic_write(catalog_path)), algorithms)
+        catalog_files = [writers[catalog_path]]
+        for encoding in encodings:
+            path = '{}.{}'.format(catalog_path, encoding)
+            writers[path] = HashingWriter(
+                stack.enter_context(atomic_write(path)), algorithms)
+            catalog_file = open_catalog_encoder(encoding, writers[path])
+            # The encoder has to finish before its file is renamed.
+            stack.callback(catalog_file.close)
+            catalog_files.append(catalog_file)
+
+        def write(data):
+            for catalog_file in catalog_files:
+                catalog_file.write(data)
+
+        (header, footer) = read_catalog_layout(previous_path)
+        write(header)
+        for entry in merge_catalog_entries(previous_path, metadata):
+            write(xml.etree.ElementTree.tostring(entry, encoding='UTF-8'))
+        write(footer)
+
+    for (path, writer) in writers.items():
+        write_checksums(path, writer.hexdigests())
+
+    # Remove copies and checksum files that are no longer wanted, rather
+    # than leave them out of date.
+    stale_paths = []
+    for path in [catalog_path] + [
+            '{}.{}'.format(catalog_path, encoding)
+            for encoding in CATALOG_ENCODINGS]:
+        if path not in writers:
+            stale_paths.append(path)
+        stale_paths.extend(get_checksum_paths(path, [
+            algorithm for algorithm in DIGEST_ALGORITHMS
+            if path not in writers or algorithm not in algorithms]))
+    for path in stale_paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def write_publish_manifest(data_path, options):
+    # List every published file with its size and SHA-256, so that a server
+    # can answer conditional requests and a mirror can fetch only what
+    # changed, without hashing anything again.
+    files = collections.OrderedDict()
+    for kodi_version in get_published_versions(data_path):
+        target_folder = os.path.join(data_path, kodi_version)
+        for (root, dirs, names) in os.walk(target_folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(names):
+                if name.startswith('.') or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, data_path).replace(
+                    os.sep, '/')] = collections.OrderedDict((
+                        ('size', os.path.getsize(path)),
+                        ('sha256', get_file_digests(
+                            path, ['sha256'],
+                            options.cache_folder)['sha256'])))
+    with atomic_write(
+            os.path.join(data_path, PUBLISH_MANIFEST_BASENAME)) as manifest:
+        manifest.write(json.dumps(
+            {'files': files}, indent=1).encode('utf-8'))
+
+
+def get_requirements(root):
+    # The add-ons that an add-on imports, as (id, version, optional) tuples.
+    requires = root.find('requires')
+    if requires is None:
+        return []
+    return [(element.get('addon'), element.get('version'),
+             element.get('optional') == 'true')
+            for element in requires.findall('import')]
+
+
+@contextlib.contextmanager
+def open_inventory(data_path, read_only=False):
+    inventory_path = os.path.join(data_path, INVENTORY_BASENAME)
+    if read_only:
+        connection = sqlite3.connect(
+            'file:{}?mode=ro'.format(inventory_path), uri=True)
+    else:
+        connection = sqlite3.connect(inventory_path)
+    try:
+        if not read_only:
+            with connection:
+                connection.executescript(INVENTORY_SCHEMA)
+        yield connection
     finally:
-        if tf and temp_folder:
-            shutil.rmtree(temp_folder, ignore_errors=False)
-
-
-def get_addon_worker(addon_location, target_folder, kodi_version):
-    result_slot = []
-    thread = threading.Thread(target=lambda: fetch_addon(
-        addon_location, target_folder, result_slot, kodi_version))
-    return AddonWorker(thread, result_slot)
+        connection.close()
+
+
+def record_archive(connection, data_path, kodi_version, addon_metadata,
+                   built, cache_folder=None):
+    archive_path = os.path.join(data_path, kodi_version, addon_metadata.id,
+                                get_archive_basename(addon_metadata))
+    if not os.path.isfile(archive_path):
+        return
+    key = (kodi_version, addon_metadata.id, addon_metadata.version)
+    # An unchanged archive keeps the time that it was first built.
+    connection.execute(
+        'INSERT INTO archives VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (kodi_version, addon_id, version) DO UPDATE SET '
+        'path = excluded.path, size = excluded.size, '
+        'built = CASE WHEN sha256 = excluded.sha256 THEN built '
+        'ELSE excluded.built END, sha256 = excluded.sha256',
+        key + (os.path.relpath(archive_path, data_path).replace(os.sep, '/'),
+               os.path.getsize(archive_path),
+               get_file_digests(archive_path, ['sha256'],
+                                cache_folder)['sha256'],
+               built))
+    connection.execute(
+        'DELETE FROM requires '
+        'WHERE kodi_version = ? AND addon_id = ? AND version = ?', key)
+    connection.executemany(
+        'INSERT OR REPLACE INTO requires VALUES (?, ?, ?, ?, ?, ?)',
+        [key + requirement
+         for requirement in get_requirements(addon_metadata.root)])
+
+
+def index_published_archives(connection, data_path, kodi_version,
+                             cache_folder=None):
+    # Fill the inventory from the archives already on disk. This happens
+    # only once per Kodi version, when it has no rows yet.
+    target_folder = os.path.join(data_path, kodi_version)
+    for addon_id in sorted(os.listdir(target_folder)):
+        addon_folder = os.path.join(target_folder, addon_id)
+        if addon_id.startswith('.') or not os.path.isdir(addon_folder):
+            continue
+        for basename in sorted(os.listdir(addon_folder)):
+            archive_path = os.path.join(addon_folder, basename)
+            if not basename.endswith('.zip'):
+                continue
+            try:
+                addon_metadata = read_archive_metadata(archive_path)
+            except (zipfile.BadZipFile, xml.etree.ElementTree.ParseError,
+                    RuntimeError):
+                continue
+            if (addon_metadata.id != addon_id or
+                    basename != get_archive_basename(addon_metadata)):
+                continue
+            record_archive(connection, data_path, kodi_version,
+                           addon_metadata, os.path.getmtime(archive_path),
+                           cache_folder)
+
+
+def update_inventory(data_path, buildvers, metadata, removed_paths,
+                     options):
+    built = time.time()
+    with open_inventory(data_path) as connection, connection:
+        for kodi_version in buildvers:
+            if connection.execute(
+                    'SELECT 1 FROM archives WHERE kodi_version = ? LIMIT 1',
+                    (kodi_version,)).fetchone() is None:
+                index_published_archives(connection, data_path, kodi_version,
+                                         options.cache_folder)
+            for addon_metadata in metadata[kodi_version]:
+                record_archive(connection, data_path, kodi_version,
+                               addon_metadata, built, options.cache_folder)
+        for path in removed_paths:
+            relative_path = os.path.relpath(path, data_path).replace(
+                os.sep, '/')
+            connection.execute(
+                'DELETE FROM requires '
+                'WHERE (kodi_version, addon_id, version) IN ('
+                'SELECT kodi_version, addon_id, version FROM archives '
+                'WHERE path = ?)', (relative_path,))
+            connection.execute(
+                'DELETE FROM archives WHERE path = ?', (relative_path,))
+
+
+def get_version_sort_key(version):
+    # Compare the numeric parts of a version as numbers, so that 2.0.10
+    # sorts after 2.0.9 and 1.8.5-44~g5e47ff4 after 1.8.5.
+    return [int(part) if index % 2 else part
+            for (index, part) in enumerate(re.split(r'(\d+)', version))]
+
+
+def get_versioned_files(addon_folder, addon_id):
+    # Group the archives, their checksum files and the changelogs in an
+    # add-on folder by the version that they belong to.
+    pattern = re.compile(
+        r'(?:{}-(.+)\.zip(?:\.\w+)?|changelog-(.+)\.txt)$'.format(
+            re.escape(addon_id)))
+    versioned_files = collections.defaultdict(list)
+    for basename in sorted(os.listdir(addon_folder)):
+        match = pattern.match(basename)
+        if match:
+            version = match.group(1) or match.group(2)
+            versioned_files[version].append(
+                os.path.join(addon_folder, basename))
+    return versioned_files
+
+
+def get_matching_pins(addon_id, version, kodi_version, pinned):
+    # A pin matches the published version either exactly or without the
+    # suffix of its Kodi version, (e.g. 2.0.5 pins 2.0.5_leia).
+    suffix = '_' + kodi_version
+    base_version = version[:-len(suffix)] if version.endswith(
+        suffix) else version
+    return [(pinned_id, pinned_version)
+            for (pinned_id, pinned_version) in pinned
+            if pinned_id == addon_id and
+            pinned_version in (version, base_version)]
+
+
+def get_expired_files(target_folder, retention, matched_pins=None):
+    # Keep the newest versions of every add-on, the pinned ones and always
+    # the one in the catalog, so that addons.xml never points at a removed
+    # archive. The pins that match a published version are added to
+    # matched_pins.
+    kodi_version = os.path.basename(target_folder)
+    catalog_path = os.path.join(target_folder, CATALOG_BASENAME)
+    catalog = {}
+    if os.path.isfile(catalog_path):
+        catalog = dict(
+            (entry.get('id'), entry.get('version'))
+            for entry in iter_catalog_entries(catalog_path))
+    expired_files = []
+    for addon_id in sorted(os.listdir(target_folder)):
+        addon_folder = os.path.join(target_folder, addon_id)
+        if addon_id.startswith('.') or not os.path.isdir(addon_folder):
+            continue
+        versioned_files = get_versioned_files(addon_folder, addon_id)
+        versions = sorted(versioned_files, key=get_version_sort_key,
+                          reverse=True)
+        retained = set(versions[:retention.keep])
+        retained.add(catalog.get(addon_id))
+        for version in versions:
+            pins = get_matching_pins(
+                addon_id, version, kodi_version, retention.pinned)
+            if pins:
+                retained.add(version)
+                if matched_pins is not None:
+                    matched_pins.update(pins)
+            if version not in retained:
+                expired_files.extend(versioned_files[version])
+    return expired_files
+
+
+def get_orphaned_blobs(blob_folder, removed_paths):
+    # A blob is orphaned once the store holds its only remaining link.
+    removed_links = collections.Counter()
+    for path in removed_paths:
+        path_stat = os.stat(path)
+        removed_links[(path_stat.st_dev, path_stat.st_ino)] += 1
+    orphaned_blobs = []
+    if blob_folder is None or not os.path.isdir(blob_folder):
+        return orphaned_blobs
+    for (root, dirs, files) in os.walk(blob_folder):
+        for name in sorted(files):
+            blob_path = os.path.join(root, name)
+            blob_stat = os.stat(blob_path)
+            if blob_stat.st_nlink - removed_links[
+                    (blob_stat.st_dev, blob_stat.st_ino)] <= 1:
+                orphaned_blobs.append(blob_path)
+    return orphaned_blobs
+
+
+def prune_repository(data_path, buildvers, retention, blob_folder=None):
+    expired_files = []
+    matched_pins = set()
+    for kodi_version in buildvers:
+        expired_files.extend(get_expired_files(
+            os.path.join(data_path, kodi_version), retention, matched_pins))
+    # A pin that matches nothing is most likely a typo, which would leave
+    # the version that it meant to keep unprotected.
+    for (addon_id, version) in retention.pinned:
+        if (addon_id, version) not in matched_pins:
+            sys.stderr.write(
+                'Warning: --pin {}={} matches no published version\n'.format(
+                    addon_id, version))
+    orphaned_blobs = get_orphaned_blobs(blob_folder, expired_files)
+
+    if retention.dry_run:
+        for path in expired_files + orphaned_blobs:
+            print('Would remove ' + path)
+        return []
+    for path in expired_files + orphaned_blobs:
+        os.remove(path)
+    return expired_files
+
+
+def promote_staged_files(staging_path, data_path):
+    # Move the staged outputs to the same paths under data_path. A rename
+    # keeps the inode, so the links into the blob store are kept as well.
+    for (root, dirs, files) in os.walk(staging_path):
+        target_root = os.path.normpath(os.path.join(
+            data_path, os.path.relpath(root, staging_path)))
+        if not os.path.isdir(target_root):
+            os.mkdir(target_root)
+        for basename in files:
+            os.replace(os.path.join(root, basename),
+                       os.path.join(target_root, basename))
+
+
+def create_repository(addon_locations, data_path, is_compressed, buildvers,
+                      force=False, jobs=None, options=BuildOptions(),
+                      retention=None, profile_path=None):
+    del stage_records[:]
+
+    manifests = {}
+    for kodi_version in buildvers:
+        target_folder = os.path.join(data_path, kodi_version)
+        # Create the target folder.
+        if not os.path.isdir(target_folder):
+            os.mkdir(target_folder)
+        manifests[kodi_version] = (
+            {} if force else load_build_manifest(target_folder))
+
+    # Fetch all the add-on sources in parallel. Each worker builds its
+    # add-on for every Kodi version. Packaging is CPU-bound, so the workers
+    # are processes rather than threads. The CPUs are shared between the
+    # compression threads of the workers that run at the same time.
+    cpu_count = os.cpu_count() or 1
+    if options.compression_threads is None:
+        concurrent_addons = min(jobs or cpu_count,
+                                max(1, len(addon_locations)))
+        options = options._replace(
+            compression_threads=max(1, cpu_count // concurrent_addons))
+    # The workers build into a staging folder, whose outputs are only moved
+    # into the served tree once the requirements have been checked.
+    staging_path = tempfile.mkdtemp(
+        prefix=STAGING_FOLDER_BASENAME + '-', dir=data_path)
+    try:
+        for kodi_version in buildvers:
+            os.mkdir(os.path.join(staging_path, kodi_version))
+        with profile_stage(None, 'fetch'), \
+                concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs) as executor:
+            workers = [
+                executor.submit(fetch_addon, addon_location, data_path,
+                                buildvers, manifests, options, staging_path)
+                for addon_location in addon_locations]
+            results = [worker.result() for worker in workers]
+
+        # Collect the results from all the workers.
+        metadata = collections.defaultdict(list)
+        for result in results:
+            stage_records.extend(result.stages)
+            if result.exc_info is not None:
+                sys.stderr.write(result.exc_info[2])
+                raise result.exc_info[1]
+            for build in result.builds:
+                metadata[build.kodi_version].append(build.addon_metadata)
+                if build.build_record is not None:
+                    manifests[build.kodi_version][
+                        build.build_record.source] = {
+                            'key': build.build_record.key,
+                            'id': build.addon_metadata.id,
+                            'archive': get_archive_basename(
+                                build.addon_metadata)}
+
+        problems = []
+        for kodi_version in buildvers:
+            with profile_stage(None, 'requires', kodi_version):
+                problems.extend(check_requirements(
+                    os.path.join(data_path, kodi_version), kodi_version,
+                    metadata[kodi_version], options))
+
+        # In --strict-requires mode, an unresolved import publishes nothing,
+        # neither the archives nor the catalogs.
+        for problem in problems:
+            sys.stderr.write(problem + '\n')
+        if problems and options.strict_requires:
+            raise RuntimeError('Unresolved add-on requirements')
+
+        with profile_stage(None, 'promote'):
+            promote_staged_files(staging_path, data_path)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
 
+    # The --compressed flag predates the other catalog encodings.
+    encodings = [encoding for encoding in CATALOG_ENCODINGS
+                 if encoding in options.catalog_encodings or
+                 (encoding == 'gz' and is_compressed)]
+    for kodi_version in buildvers:
+        save_build_manifest(
+            os.path.join(data_path, kodi_version), manifests[kodi_version])
 
-def create_repository(addon_locations, data_path, is_compressed, buildvers):
+    for kodi_version in buildvers:
+        target_folder = os.path.join(data_path, kodi_version)
+        with profile_stage(None, 'catalog', kodi_version):
+            merge_catalog(target_folder, metadata[kodi_version], encodings,
+                          options.digests)
+
+    # Prune old versions only once the catalogs point at the new ones.
+    removed_paths = []
+    if retention is not None:
+        with profile_stage(None, 'prune'):
+            removed_paths = prune_repository(
+                data_path, buildvers, retention, options.blob_folder)
+
+    with profile_stage(None, 'inventory'):
+        update_inventory(
+            data_path, buildvers, metadata, removed_paths, options)
+
+    with profile_stage(None, 'manifest'):
+        write_publish_manifest(data_path, options)
+
+    if options.cache_folder is not None:
+        prune_digest_cache(options.cache_folder)
+
+    if profile_path is not None:
+        write_profile_report(profile_path, stage_records)
+
+
+def get_watched_folders(addon_location):
+    if is_url(addon_location):
+        return []
+    if os.path.isfile(addon_location):
+        return [os.path.dirname(os.path.abspath(addon_location))]
+    folders = []
+    git_folder = os.path.join(addon_location, '.git')
+    for (root, dirs, files) in os.walk(addon_location):
+        if root == git_folder:
+            # HEAD and the index live here, but below it only the refs
+            # matter, (not the objects or the logs).
+            dirs[:] = [d for d in dirs if d == 'refs']
+        folders.append(root)
+    return folders
+
+
+def get_source_fingerprint(addon_location):
+    # A cheap stand-in for the source key that notices when an add-on
+    # might have changed. The build manifest decides whether it really did.
+    if is_url(addon_location):
+        return get_git_source_key(addon_location)
+    if os.path.isfile(addon_location):
+        paths = [addon_location]
+    else:
+        paths = []
+        for folder in get_watched_folders(addon_location):
+            try:
+                paths.extend(entry.path for entry in os.scandir(folder)
+                             if entry.is_file(follow_symlinks=False))
+            except OSError:
+                continue
+    fingerprint = []
+    for path in sorted(paths):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            # The file went away since it was listed.
+            continue
+        fingerprint.append((path, path_stat.st_mtime_ns, path_stat.st_size))
+    return fingerprint
+
+
+def add_watches(watcher, watches, addon_location):
+    # Watch every folder of the add-on, including any created since the
+    # last time. Watching a folder again just returns its descriptor.
+    mask = (inotify_simple.flags.CREATE | inotify_simple.flags.DELETE |
+            inotify_simple.flags.MODIFY | inotify_simple.flags.ATTRIB |
+            inotify_simple.flags.CLOSE_WRITE |
+            inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MOVED_TO)
+    for folder in get_watched_folders(addon_location):
+        try:
+            watches[watcher.add_watch(folder, mask)] = addon_location
+        except OSError:
+            continue
+
+
+def wait_for_changes(watcher, watches, interval):
+    # Return the add-on locations with filesystem events, or None if every
+    # local location should be checked.
+    if watcher is None:
+        time.sleep(interval)
+        return None
+    events = watcher.read(timeout=int(interval * 1000),
+                          read_delay=int(WATCH_SETTLE_TIME * 1000))
+    if any(event.mask & inotify_simple.flags.Q_OVERFLOW for event in events):
+        return None
+    return set(watches[event.wd] for event in events if event.wd in watches)
+
+
+def watch_repository(addon_locations, data_path, is_compressed, buildvers,
+                     force=False, jobs=None, options=BuildOptions(),
+                     retention=None, profile_path=None):
+    watcher = None
+    if inotify_simple is not None:
+        watcher = inotify_simple.INotify()
+    watches = {}
+    remote_locations = set(filter(is_url, addon_locations))
+    local_locations = set(addon_locations) - remote_locations
+
+    # Take the fingerprints before the first build, so that nothing that
+    # changes during it is missed.
+    fingerprints = {}
+    for addon_location in addon_locations:
+        fingerprints[addon_location] = get_source_fingerprint(addon_location)
+        if watcher is not None:
+            add_watches(watcher, watches, addon_location)
+    create_repository(addon_locations, data_path, is_compressed, buildvers,
+                      force, jobs, options, retention, profile_path)
+
+    next_remote_check = time.time() + REMOTE_WATCH_INTERVAL
+    while True:
+        candidates = wait_for_changes(watcher, watches, WATCH_INTERVAL)
+        if candidates is None:
+            candidates = set(local_locations)
+        if remote_locations and time.time() >= next_remote_check:
+            candidates.update(remote_locations)
+            next_remote_check = time.time() + REMOTE_WATCH_INTERVAL
+
+        try:
+            changed = []
+            for addon_location in addon_locations:
+                if addon_location not in candidates:
+                    continue
+                if watcher is not None:
+                    add_watches(watcher, watches, addon_location)
+                fingerprint = get_source_fingerprint(addon_location)
+                if fingerprint != fingerprints[addon_location]:
+                    fingerprints[addon_location] = fingerprint
+                    changed.append(addon_location)
+            if changed:
+                # Only the changed add-ons are fetched. Their catalog
+                # entries are merged into the existing addons.xml.
+                create_repository(changed, data_path, is_compressed,
+                                  buildvers, jobs=jobs, options=options,
+                                  retention=retention,
+                                  profile_path=profile_path)
+        except Exception:
+            # Keep watching. The next change gets another try.
+            traceback.print_exc()
+
+
+def read_checksum(checksum_path):
+    with open(checksum_path, 'r') as sig:
+        # Tolerate the "DIGEST  FILENAME" format of md5sum and friends.
+        return (sig.read().split() or [''])[0].lower()
+
+
+def read_archive_metadata(archive_path):
+    with zipfile.ZipFile(archive_path) as archive:
+        info_names = [
+            name for name in archive.namelist()
+            if name.count('/') == 1 and name.endswith('/' + INFO_BASENAME)]
+        if len(info_names) != 1:
+            raise RuntimeError('Addon metadata not found')
+        with archive.open(info_names[0]) as info_file:
+            return parse_metadata(info_file)
+
+
+def verify_checksums(path, required=True):
+    # Check a published file against each of its checksum files.
+    algorithms = [
+        algorithm for algorithm in DIGEST_ALGORITHMS
+        if os.path.isfile('{}.{}'.format(path, algorithm))]
+    if required and not algorithms:
+        return ['No checksum file found']
+    return [
+        'Checksum mismatch: ' + algorithm
+        for (algorithm, hexdigest) in hash_file(path, algorithms).items()
+        if read_checksum('{}.{}'.format(path, algorithm)) != hexdigest]
+
+
+def verify_archive(archive_path, is_current=True):
+    # Check one published archive against its checksum files and read the
+    # metadata that is embedded in it. Only the archive that the catalog
+    # points at must have a checksum file.
+    problems = verify_checksums(archive_path, is_current)
 
-    if is_compressed:
-        info_basename = 'addons.xml.gz'
+    try:
+        addon_metadata = read_archive_metadata(archive_path)
+    except (zipfile.BadZipFile, xml.etree.ElementTree.ParseError,
+            RuntimeError) as e:
+        problems.append(str(e))
+        return (None, problems)
+    return (addon_metadata, problems)
+
+
+def iter_catalog_decoder(encoding, catalog_file):
+    # Yield the decompressed contents of a catalog copy.
+    if encoding == 'gz':
+        decoder = gzip.GzipFile(fileobj=catalog_file, mode='rb')
+    elif encoding == 'zst':
+        decoder = zstandard.ZstdDecompressor().stream_reader(
+            catalog_file, closefd=False)
     else:
-        info_basename = 'addons.xml'
+        decompressor = brotli.Decompressor()
+        for chunk in iter(
+                functools.partial(catalog_file.read, COPY_BUFFER_SIZE), b''):
+            yield decompressor.process(chunk)
+        return
+    with decoder:
+        for chunk in iter(
+                functools.partial(decoder.read, COPY_BUFFER_SIZE), b''):
+            yield chunk
+
+
+def verify_catalog(target_folder):
+    catalog_path = os.path.join(target_folder, CATALOG_BASENAME)
+    problems = []
+    entries = {}
+    if not os.path.isfile(catalog_path):
+        return (entries, ['{}: Catalog not found'.format(catalog_path)])
+
+    # Kodi reads addons.xml.md5, so that checksum file is required.
+    if not os.path.isfile(catalog_path + '.md5'):
+        problems.append('{}: No checksum file found: md5'.format(
+            catalog_path))
+    problems.extend(
+        '{}: {}'.format(catalog_path, problem)
+        for problem in verify_checksums(catalog_path, required=False))
+    hexdigest = hash_file(catalog_path, ['md5'])['md5']
+    decode_errors = (OSError, EOFError, zlib.error)
+    if zstandard is not None:
+        decode_errors += (zstandard.ZstdError,)
+    if brotli is not None:
+        decode_errors += (brotli.error,)
+    for encoding in CATALOG_ENCODINGS:
+        path = '{}.{}'.format(catalog_path, encoding)
+        if not os.path.isfile(path):
+            continue
+        problems.extend(
+            '{}: {}'.format(path, problem)
+            for problem in verify_checksums(path))
+        # The contents of a copy can only be compared if its module is
+        # installed.
+        if ((encoding == 'zst' and zstandard is None) or
+                (encoding == 'br' and brotli is None)):
+            continue
+        checksum = hashlib.md5()
+        try:
+            with open(path, 'rb') as catalog_file:
+                for chunk in iter_catalog_decoder(encoding, catalog_file):
+                    checksum.update(chunk)
+        except decode_errors as e:
+            problems.append('{}: {}'.format(path, e))
+            continue
+        if checksum.hexdigest() != hexdigest:
+            problems.append('{}: Contents differ from {}'.format(
+                path, CATALOG_BASENAME))
 
+    try:
+        for entry in iter_catalog_entries(catalog_path):
+            entries[entry.get('id')] = entry.get('version')
+    except xml.etree.ElementTree.ParseError as e:
+        problems.append('{}: {}'.format(catalog_path, e))
+    return (entries, problems)
+
+
+def verify_repository(data_path, buildvers, jobs=None):
+    # Return a description of every problem in the published tree.
+    problems = []
+    catalogs = {}
+    archives = []
     for kodi_version in buildvers:
         target_folder = os.path.join(data_path, kodi_version)
-        # Create the target folder.
+        (catalogs[kodi_version], catalog_problems) = verify_catalog(
+            target_folder)
+        problems.extend(catalog_problems)
         if not os.path.isdir(target_folder):
-            os.mkdir(target_folder)
-
-        info_path = os.path.join(target_folder, info_basename)
-        # Fetch all the add-on sources in parallel.
-        workers = [
-            get_addon_worker(addon_location, target_folder, kodi_version)
-            for addon_location in addon_locations]
-
-        for worker in workers:
-            worker.thread.start()
-        for worker in workers:
-            worker.thread.join()
+            continue
+        for addon_id in sorted(os.listdir(target_folder)):
+            addon_folder = os.path.join(target_folder, addon_id)
+            if not os.path.isdir(addon_folder):
+                continue
+            current_basename = '{}-{}.zip'.format(
+                addon_id, catalogs[kodi_version].get(addon_id))
+            archives.extend(
+                (kodi_version, addon_id, os.path.join(addon_folder, basename),
+                 basename == current_basename)
+                for basename in sorted(os.listdir(addon_folder))
+                if basename.endswith('.zip'))
+
+    # Hashing releases the GIL and the archives are mapped into memory, so
+    # threads are enough to keep every CPU busy.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            verify_archive, [archive[2] for archive in archives],
+            [archive[3] for archive in archives])
+        published = collections.defaultdict(set)
+        for ((kodi_version, addon_id, archive_path, is_current),
+             (addon_metadata, archive_problems)) in zip(archives, results):
+            problems.extend(
+                '{}: {}'.format(archive_path, problem)
+                for problem in archive_problems)
+            if addon_metadata is None:
+                continue
+            if addon_metadata.id != addon_id:
+                problems.append('{}: Addon ID {} does not match its '
+                                'folder'.format(archive_path,
+                                                addon_metadata.id))
+            elif (os.path.basename(archive_path) !=
+                    get_archive_basename(addon_metadata)):
+                problems.append('{}: Addon version {} does not match the '
+                                'archive name'.format(archive_path,
+                                                      addon_metadata.version))
+            published[kodi_version].add(
+                (addon_metadata.id, addon_metadata.version))
 
-        # Collect the results from all the threads.
-        metadata = []
-        for worker in workers:
-            try:
-                result = next(iter(worker.result_slot))
-            except StopIteration:
-                raise RuntimeError('Addon worker did not report result')
-            if result.exc_info is not None:
-                import traceback
-                traceback.print_tb(result.exc_info[2])
-                raise result.exc_info[1]
-            metadata.append(result.addon_metadata)
+    for kodi_version in buildvers:
+        catalog_path = os.path.join(
+            data_path, kodi_version, CATALOG_BASENAME)
+        for (addon_id, version) in sorted(catalogs[kodi_version].items()):
+            if (addon_id, version) not in published[kodi_version]:
+                problems.append('{}: No archive found for {} {}'.format(
+                    catalog_path, addon_id, version))
+
+    if os.path.isfile(os.path.join(data_path, INVENTORY_BASENAME)):
+        problems.extend(verify_inventory(data_path, buildvers))
+    return problems
+
+
+def verify_inventory(data_path, buildvers):
+    # Every archive in the inventory should still be on disk, unchanged.
+    # The checksums are compared by verify_archive, so the size is enough.
+    problems = []
+    inventory_path = os.path.join(data_path, INVENTORY_BASENAME)
+    with open_inventory(data_path, read_only=True) as connection:
+        for kodi_version in buildvers:
+            for (path, size) in connection.execute(
+                    'SELECT path, size FROM archives WHERE kodi_version = ? '
+                    'ORDER BY path', (kodi_version,)):
+                archive_path = os.path.join(data_path, *path.split('/'))
+                if not os.path.isfile(archive_path):
+                    problems.append('{}: Archive {} not found'.format(
+                        inventory_path, path))
+                elif os.path.getsize(archive_path) != size:
+                    problems.append('{}: Size of archive {} does not '
+                                    'match'.format(inventory_path, path))
+    return problems
+
+
+def get_published_versions(data_path):
+    return sorted(
+        kodi_version for kodi_version in os.listdir(data_path)
+        if os.path.isfile(
+            os.path.join(data_path, kodi_version, CATALOG_BASENAME)))
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'must be a positive integer: ' + value)
+    return number
+
+
+def verify_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='{} verify'.format(os.path.basename(sys.argv[0])),
+        description='Check a published Kodi add-on repository against its '
+                    'checksums and catalogs')
+    parser.add_argument('--datadir', '-d', default='.',
+                        help='Path of the add-ons [current directory]')
+    parser.add_argument('--buildvers', '-b', action='store',
+                        nargs='*', default=None, type=str.lower,
+                        help='Versions of Kodi to check [every folder with '
+                             'an addons.xml]')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=None,
+                        help='Number of archives to hash in parallel '
+                             '[number of CPUs]')
+    args = parser.parse_args(argv)
 
-        # If addons.xml already exists, read it
-        if os.path.isfile(info_path):
-            tree = xml.etree.ElementTree.ElementTree(file=info_path)
-            root = tree.getroot()
-        else:
-            # Generate the addons.xml file.
-            root = xml.etree.ElementTree.Element('addons')
-
-        for addon_metadata in metadata:
-            # Remove existing addon from doc
-            for addon in root[:]:  # use copy to avoid iteration errors
-                if addon.attrib.get('id') == addon_metadata.id:
-                    root.remove(addon)
-        for addon_metadata in metadata:
-            tree = root.append(addon_metadata.root)
-
-        tree = xml.etree.ElementTree.ElementTree(root)
-        with io.BytesIO() as info_file:
-            tree.write(info_file, encoding='UTF-8', xml_declaration=True)
-            info_contents = info_file.getvalue()
-
-        if is_compressed:
-            info_file = gzip.open(info_path, 'wb')
-        else:
-            info_file = open(info_path, 'wb')
-        with info_file:
-            info_file.write(info_contents)
+    data_path = os.path.expanduser(args.datadir)
+    if not os.path.isdir(data_path):
+        parser.error('Data directory not found: ' + data_path)
+    buildvers = args.buildvers or get_published_versions(data_path)
+    if not buildvers:
+        # Nothing to check is most likely a mistyped path, which must not
+        # pass as a verified repository.
+        sys.stderr.write('{}: No {} found\n'.format(
+            data_path, CATALOG_BASENAME))
+        sys.exit(1)
+    problems = verify_repository(data_path, buildvers, args.jobs)
+    for problem in problems:
+        sys.stderr.write(problem + '\n')
+    if problems:
+        sys.exit(1)
+
+
+def query_inventory(data_path, buildvers, pattern='*', required_by=None,
+                    latest=False):
+    # Return the archives in the inventory as dictionaries, each with the
+    # list of add-ons that it imports.
+    query = ('SELECT kodi_version, addon_id, version, path, size, sha256, '
+             'built FROM archives WHERE addon_id GLOB ?')
+    parameters = [pattern]
+    if buildvers:
+        query += ' AND kodi_version IN ({})'.format(
+            ', '.join('?' * len(buildvers)))
+        parameters.extend(buildvers)
+    if required_by is not None:
+        query += (' AND (kodi_version, addon_id, version) IN ('
+                  'SELECT kodi_version, addon_id, version FROM requires '
+                  'WHERE import_id = ?)')
+        parameters.append(required_by)
+    with open_inventory(data_path, read_only=True) as connection:
+        rows = [
+            collections.OrderedDict(zip(
+                ('kodi_version', 'id', 'version', 'path', 'size', 'sha256',
+                 'built'), row))
+            for row in connection.execute(query, parameters)]
+        for row in rows:
+            row['requires'] = [
+                collections.OrderedDict(zip(
+                    ('id', 'version', 'optional'),
+                    (import_id, import_version, bool(optional))))
+                for (import_id, import_version, optional)
+                in connection.execute(
+                    'SELECT import_id, import_version, optional '
+                    'FROM requires WHERE kodi_version = ? AND addon_id = ? '
+                    'AND version = ? ORDER BY import_id',
+                    (row['kodi_version'], row['id'], row['version']))]
+    rows.sort(key=lambda row: (row['kodi_version'], row['id'],
+                               get_version_sort_key(row['version'])))
+    if latest:
+        newest = collections.OrderedDict()
+        for row in rows:
+            newest[(row['kodi_version'], row['id'])] = row
+        rows = list(newest.values())
+    return rows
+
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='{} query'.format(os.path.basename(sys.argv[0])),
+        description='List the add-on versions in the inventory of a '
+                    'published Kodi add-on repository')
+    parser.add_argument('pattern', nargs='?', default='*', metavar='ID',
+                        help='Add-on ID, which may contain shell-style '
+                             'wildcards [every add-on]')
+    parser.add_argument('--datadir', '-d', default='.',
+                        help='Path of the add-ons [current directory]')
+    parser.add_argument('--buildvers', '-b', action='store',
+                        nargs='*', default=None, type=str.lower,
+                        help='Versions of Kodi to list [all]')
+    parser.add_argument('--required-by', metavar='ID', default=None,
+                        help='Only list the add-ons that import this one')
+    parser.add_argument('--latest', action='store_true',
+                        help='Only list the newest version of each add-on')
+    parser.add_argument('--requires', action='store_true',
+                        help='Also list the imports of each add-on')
+    parser.add_argument('--json', action='store_true',
+                        help='Write the results as JSON')
+    args = parser.parse_args(argv)
 
-        # Calculate the signature.
-        digest = hashlib.md5(info_contents).hexdigest()
-        with open(os.path.join(target_folder, 'addons.xml.md5'), 'w') as sig:
-            sig.write(digest)
+    data_path = os.path.expanduser(args.datadir)
+    if not os.path.isfile(os.path.join(data_path, INVENTORY_BASENAME)):
+        parser.error('Inventory not found in data directory: ' + data_path)
+    rows = query_inventory(data_path, args.buildvers, args.pattern,
+                           args.required_by, args.latest)
+    if args.json:
+        sys.stdout.write(json.dumps(rows, indent=1) + '\n')
+        return
+    for row in rows:
+        print('{:<8} {:<32} {:<24} {:>10} {} {}'.format(
+            row['kodi_version'], row['id'], row['version'], row['size'],
+            row['sha256'][:12], time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(row['built']))))
+        if args.requires:
+            for requirement in row['requires']:
+                print('    requires {} {}{}'.format(
+                    requirement['id'], requirement['version'] or '',
+                    ' (optional)' if requirement['optional'] else ''))
 
 
 def main():
+    if sys.argv[1:2] == ['verify']:
+        verify_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['query']:
+        query_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         description='Create a Kodi add-on repository from add-on sources')
     parser.add_argument('--datadir', '-d', default='.',
                         help='Path to place the add-ons [current directory]')
     parser.add_argument('--compressed', '-z', action='store_true',
-                        help='Compress addons.xml with gzip')
+                        help='Also write a gzip copy of addons.xml')
+    parser.add_argument('--precompress', nargs='+', default=[],
+                        choices=CATALOG_ENCODINGS, metavar='ENCODING',
+                        help='Also write copies of addons.xml compressed '
+                             'with gzip (gz), zstd (zst) or brotli (br)')
     parser.add_argument('addon', nargs='*', metavar='ADDON',
                         help='Location of the add-on: either a path to a '
                              'local folder or to a zip archive or a URL for '
@@ -498,11 +2624,100 @@ def main():
                         nargs='*', default=['leia'], type=str.lower,
                         help='Versions of Kodi to build for e.g Leia, '
                              'Matrix etc.')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='Rebuild add-ons even if their sources are '
+                             'unchanged since the last build')
+    parser.add_argument('--snapshot', '-s', action='store_true',
+                        help='Package add-on folders from the files staged '
+                             'in the git index instead of the working tree')
+    parser.add_argument('--digests', nargs='+', metavar='ALGORITHM',
+                        default=list(DEFAULT_DIGESTS),
+                        choices=DIGEST_ALGORITHMS,
+                        help='Checksum files to write next to each archive '
+                             '[md5]')
+    parser.add_argument('--compression-level', type=int,
+                        default=zlib.Z_DEFAULT_COMPRESSION,
+                        choices=range(0, 10), metavar='{0-9}',
+                        help='Deflate level for add-on archives, where 0 '
+                             'stores files uncompressed [zlib default]')
+    parser.add_argument('--no-dedupe', dest='dedupe', action='store_false',
+                        help='Do not hard link identical archives and '
+                             'metadata files to a shared blob store')
+    parser.add_argument('--cachedir', default=get_default_cache_folder(),
+                        help='Path to keep build caches in '
+                             '[$XDG_CACHE_HOME/kodi-repository]')
+    parser.add_argument('--external', action='append', default=[],
+                        metavar='ID',
+                        help='Add-on that is provided by another '
+                             'repository, so that imports of it need not '
+                             'be in the catalog. Shell-style wildcards are '
+                             'allowed and the option can be repeated')
+    parser.add_argument('--strict-requires', action='store_true',
+                        help='Fail without publishing any archive or '
+                             'catalog if any add-on import does not '
+                             'resolve')
+    parser.add_argument('--keep', type=int, default=None, metavar='N',
+                        help='Remove all but the newest N versions of each '
+                             'add-on, besides the one in the catalog and any '
+                             'pinned ones [keep everything]')
+    parser.add_argument('--pin', action='append', default=[],
+                        metavar='ID=VERSION',
+                        help='Keep this add-on version regardless of --keep')
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='List the files that --keep would remove '
+                             'instead of removing them. Everything else '
+                             'is still built and published')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write the time and resources spent in each '
+                             'build stage to a JSON report and print a '
+                             'summary')
+    parser.add_argument('--watch', '-w', action='store_true',
+                        help='Keep running and rebuild add-ons whenever '
+                             'their sources change')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=None,
+                        help='Number of add-ons to package in parallel '
+                             '[number of CPUs]')
     args = parser.parse_args()
 
     data_path = os.path.expanduser(args.datadir)
 
-    create_repository(args.addon, data_path, args.compressed, args.buildvers)
+    blob_folder = None
+    if args.dedupe:
+        blob_folder = os.path.join(data_path, BLOB_FOLDER_BASENAME)
+    for (encoding, module_name, module) in (('zst', 'zstandard', zstandard),
+                                            ('br', 'brotli', brotli)):
+        if encoding in args.precompress and module is None:
+            parser.error('--precompress {} needs the {} module'.format(
+                encoding, module_name))
+    options = BuildOptions(args.snapshot, tuple(args.digests),
+                           args.compression_level, blob_folder,
+                           os.path.expanduser(args.cachedir),
+                           tuple(args.precompress), tuple(args.external),
+                           args.strict_requires)
+    retention = None
+    if args.dry_run and args.keep is None:
+        parser.error('--dry-run only applies to --keep')
+    if args.keep is not None:
+        if args.keep < 0:
+            parser.error('--keep must not be negative')
+        pinned = []
+        for pin in args.pin:
+            (addon_id, sep, version) = pin.partition('=')
+            if not sep:
+                parser.error('--pin expects ID=VERSION: ' + pin)
+            pinned.append((addon_id, version))
+        retention = RetentionPolicy(args.keep, tuple(pinned), args.dry_run)
+    if args.watch:
+        try:
+            watch_repository(args.addon, data_path, args.compressed,
+                             args.buildvers, args.force, args.jobs, options,
+                             retention, args.profile)
+        except KeyboardInterrupt:
+            pass
+    else:
+        create_repository(args.addon, data_path, args.compressed,
+                          args.buildvers, args.force, args.jobs, options,
+                          retention, args.profile)
 
 
 if __name__ == "__main__":
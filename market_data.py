@@ -0,0 +1,442 @@
+import asyncio
+import queue
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import ccxt.async_support as ccxt_async
+    from ccxt.base.decimal_to_precision import DECIMAL_PLACES, SIGNIFICANT_DIGITS, TICK_SIZE
+except Exception:
+    ccxt_async = None
+    DECIMAL_PLACES, SIGNIFICANT_DIGITS, TICK_SIZE = 2, 3, 4
+
+# Spot API and endpoint behind fetch_ohlcv, used to look up its request
+# weight in the exchange's ccxt API description.
+OHLCV_ENDPOINTS = {
+    "bybit": ("public", "v5/market/kline"),
+    "binance": ("public", "klines"),
+    "kraken": ("public", "OHLC"),
+    "okx": ("public", "market/candles"),
+}
+
+
+OHLCV_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+
+
+class OHLCVRing:
+    # Fixed-capacity buffer of the latest bars of one symbol, one row per bar
+    # in OHLCV_COLUMNS order. When full, the oldest bar is overwritten.
+    def __init__(self, capacity: int, timeframe_ms: int):
+        self.capacity = capacity
+        self.timeframe_ms = timeframe_ms
+        self.data = np.empty((capacity, len(OHLCV_COLUMNS)), dtype=np.float64)
+        self.start = 0
+        self.size = 0
+
+    def _slot(self, offset: int) -> int:
+        return (self.start + offset) % self.capacity
+
+    @property
+    def last_timestamp(self) -> Optional[int]:
+        if not self.size:
+            return None
+        return int(self.data[self._slot(self.size - 1), 0])
+
+    def append(self, row: np.ndarray) -> None:
+        if self.size < self.capacity:
+            self.data[self._slot(self.size)] = row
+            self.size += 1
+        else:
+            self.data[self.start] = row
+            self.start = self._slot(1)
+
+    def seed(self, raw: List[List[float]]) -> None:
+        rows = np.asarray(raw, dtype=np.float64).reshape(-1, len(OHLCV_COLUMNS))[-self.capacity:]
+        self.data[:len(rows)] = rows
+        self.start = 0
+        self.size = len(rows)
+
+    def merge(self, raw: List[List[float]]) -> bool:
+        # Apply bars from fetch_ohlcv. The still-forming last bar is replaced
+        # in place each time it is re-fetched. Returns False if the bars do not
+        # continue the buffer (missed bars), so that it has to be re-seeded.
+        rows = np.asarray(raw, dtype=np.float64).reshape(-1, len(OHLCV_COLUMNS))
+        for row in rows:
+            last = self.last_timestamp
+            ts = int(row[0])
+            if last is None or ts == last + self.timeframe_ms:
+                self.append(row)
+            elif ts == last:
+                self.data[self._slot(self.size - 1)] = row
+            elif ts < last:
+                # An earlier bar that changed after we stored it
+                offset = self.size - 1 - (last - ts) // self.timeframe_ms
+                if offset >= 0 and int(self.data[self._slot(offset), 0]) == ts:
+                    self.data[self._slot(offset)] = row
+            else:
+                return False
+        return True
+
+    def to_frame(self) -> pd.DataFrame:
+        rows = self.data[self._slot(np.arange(self.size))]
+        index = pd.to_datetime(rows[:, 0].astype(np.int64), unit="ms", utc=True)
+        df = pd.DataFrame(rows[:, 1:], columns=OHLCV_COLUMNS[1:], index=index)
+        df.index.name = "timestamp"
+        return df
+
+
+def get_top_up(ring: Optional[OHLCVRing], limit: int, timeframe_ms: int, now_ms: int) -> Optional[Tuple[int, int]]:
+    # (since, limit) to top up the cached bars from the last (possibly still
+    # forming) one onwards, or None when a full fetch is needed: on first
+    # use or after a pause too long for a top-up.
+    if ring is None or not ring.size or ring.capacity != limit:
+        return None
+    since = ring.last_timestamp
+    missing = (now_ms - since) // timeframe_ms + 2
+    if missing >= limit:
+        return None
+    return since, int(missing)
+
+
+def apply_top_up(ring: OHLCVRing, raw: List[List[float]], since: int) -> bool:
+    # False when the reply does not connect to the cached bars (a gap)
+    return bool(raw) and int(raw[0][0]) <= since and ring.merge(raw)
+
+
+def get_endpoint_cost(ex, endpoint: str, limit: Optional[int] = None, api: Optional[str] = None,
+                      default: float = 1.0) -> float:
+    # Weight of an endpoint in the ccxt API description of the exchange,
+    # e.g. {"public": {"get": {"v5/market/kline": {"cost": 5}}}}, looked up
+    # under `api` only when given. As in ccxt's calculate_rate_limiter_cost,
+    # the first "byLimit" tier that covers `limit` takes precedence, e.g.
+    # {"cost": 1, "byLimit": [[99, 1], [499, 2], [1000, 5]]}.
+    root = getattr(ex, "api", None) or {}
+    if api is not None:
+        root = root.get(api) or {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for key, value in node.items():
+            if key == endpoint:
+                if isinstance(value, dict):
+                    if limit is not None:
+                        for max_limit, cost in value.get("byLimit") or []:
+                            if limit <= max_limit:
+                                return float(cost)
+                    return float(value.get("cost", default))
+                if isinstance(value, (int, float)):
+                    return float(value)
+                return default
+            if isinstance(value, dict):
+                stack.append(value)
+    return default
+
+
+class TokenBucket:
+    # Holds at most `capacity` tokens and refills `rate` tokens per second.
+    # A request waits until the bucket has tokens for its weight. The clock
+    # and the (async) sleep can be replaced, e.g. by a fake clock in tests.
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1.0) -> None:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        cost = min(cost, self.capacity)
+        # Requests are served in order, so a heavy one is not starved
+        async with self.lock:
+            self._refill()
+            # Allow for rounding, or a refill can fall an ulp short forever
+            while self.tokens < cost - 1e-9:
+                await self.sleep((cost - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= cost
+
+
+def build_async_exchange(name: str, api_key: Optional[str] = None, secret: Optional[str] = None):
+    if ccxt_async is None:
+        raise RuntimeError("ccxt.async_support is not available")
+    klass = getattr(ccxt_async, name)
+    # Requests are paced by our TokenBucket instead of ccxt's limiter
+    return klass({
+        "enableRateLimit": False,
+        "apiKey": api_key,
+        "secret": secret,
+        "options": {"defaultType": "spot"},
+    })
+
+
+def build_token_bucket(ex, burst_sec: float = 1.0) -> TokenBucket:
+    # ccxt's rateLimit is the milliseconds per unit of weight
+    rate = 1000.0 / float(getattr(ex, "rateLimit", 1000) or 1000)
+    return TokenBucket(rate, max(1.0, rate * burst_sec))
+
+
+async def fetch_ohlcv_async(ex, bucket: TokenBucket, cost: Callable[[int], float], symbol: str, timeframe: str,
+                            limit: int, cache: Dict[str, OHLCVRing]) -> pd.DataFrame:
+    # cost(limit) is the request weight of a fetch of `limit` bars
+    timeframe_ms = ex.parse_timeframe(timeframe) * 1000
+    ring = cache.get(symbol)
+    top_up = get_top_up(ring, limit, timeframe_ms, ex.milliseconds())
+    if top_up is not None:
+        since, top_up_limit = top_up
+        await bucket.acquire(cost(top_up_limit))
+        raw = await ex.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=top_up_limit)
+        if apply_top_up(ring, raw, since):
+            return ring.to_frame()
+
+    await bucket.acquire(cost(limit))
+    raw = await ex.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
+    ring = OHLCVRing(limit, timeframe_ms)
+    ring.seed(raw)
+    cache[symbol] = ring
+    return ring.to_frame()
+
+
+class AsyncMarketData:
+    # Fetches the candles of the whole universe concurrently on an asyncio
+    # loop in a background thread. Results are handed to the (synchronous)
+    # decision logic as they arrive, while the remaining fetches go on.
+    # Any object with ccxt's async fetch_ohlcv/parse_timeframe/milliseconds/
+    # close can stand in for the exchange, e.g. a local fake in tests.
+    # Bars are kept in `cache` (symbol -> OHLCVRing), which can be shared with
+    # the synchronous fetch path; only one of them runs at a time.
+    def __init__(self, ex, bucket: Optional[TokenBucket] = None, ohlcv_cost: Optional[float] = None,
+                 cache: Optional[Dict[str, OHLCVRing]] = None):
+        self.ex = ex
+        self.bucket = bucket or build_token_bucket(ex)
+        # A fixed weight per request, or None to look it up per request size
+        self.fixed_ohlcv_cost = ohlcv_cost
+        self.ohlcv_endpoint = OHLCV_ENDPOINTS.get(getattr(ex, "id", None))
+        self.cache: Dict[str, OHLCVRing] = {} if cache is None else cache
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="market-data", daemon=True)
+        self.thread.start()
+
+    def ohlcv_cost(self, limit: int) -> float:
+        if self.fixed_ohlcv_cost is not None:
+            return float(self.fixed_ohlcv_cost)
+        if self.ohlcv_endpoint is None:
+            return 1.0
+        api, endpoint = self.ohlcv_endpoint
+        return get_endpoint_cost(self.ex, endpoint, limit, api)
+
+    async def _fetch_one(self, symbol: str, timeframe: str, limit: int, results: queue.Queue) -> None:
+        try:
+            df: Any = await fetch_ohlcv_async(self.ex, self.bucket, self.ohlcv_cost, symbol, timeframe, limit, self.cache)
+        except Exception as exc:
+            df = exc
+        results.put((symbol, df))
+
+    async def _fetch_all(self, symbols: List[str], timeframe: str, limit: int, results: queue.Queue) -> None:
+        await asyncio.gather(*(self._fetch_one(s, timeframe, limit, results) for s in symbols))
+
+    def iter_ohlcv(self, symbols: List[str], timeframe: str, limit: int) -> Iterator[Tuple[str, Any]]:
+        # Yields (symbol, DataFrame) in completion order, or (symbol, exception)
+        # when a fetch failed.
+        results: queue.Queue = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._fetch_all(symbols, timeframe, limit, results), self.loop)
+        for _ in symbols:
+            yield results.get()
+        future.result()
+
+    def close(self) -> None:
+        if hasattr(self.ex, "close"):
+            asyncio.run_coroutine_threadsafe(self.ex.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def get_step_units(step) -> Tuple[np.ndarray, np.ndarray]:
+    # A lot step as an integer number of units of its last decimal digit, and
+    # that power of ten: 0.25 -> (25, 100), 10 -> (10, 1). Steps of 0 (unknown)
+    # become (1, 1).
+    step = np.asarray(step, dtype=np.float64)
+    step = np.where(step > 0, step, 1.0)
+    decimals = np.clip(np.ceil(-np.log10(step) - 1e-9), 0, None)
+    for _ in range(4):
+        # Steps such as 0.25 need more decimals than their order of magnitude
+        inexact = np.abs(step * 10 ** decimals - np.round(step * 10 ** decimals)) > 1e-9
+        decimals = np.where(inexact, decimals + 1, decimals)
+    scale = 10 ** decimals
+    return np.round(step * scale), scale
+
+
+def floor_to_units(amount, step_units, scale):
+    # Truncate to a multiple of the lot step like ccxt's amount_to_precision,
+    # in float arithmetic: the largest k for which the float nearest to the
+    # decimal k * step is not above the amount. The decimal is an integer
+    # over a power of ten, which is exact in float and divides with correct
+    # rounding.
+    amount = np.asarray(amount, dtype=np.float64)
+    # The estimate is off by at most one step either way
+    k = np.floor(amount * scale / step_units) + 1
+    for _ in range(3):
+        k = np.where(k * step_units / scale > amount, k - 1, k)
+    return k * step_units / scale
+
+
+def get_significant_step(amount, digits) -> np.ndarray:
+    # The lot step that truncates each amount to `digits` significant digits,
+    # e.g. 1234.5 to 3 digits has a step of 10.
+    amount = np.abs(np.asarray(amount, dtype=np.float64))
+    exponent = np.floor(np.log10(np.where(amount > 0, amount, 1.0)))
+    # log10 may be off by one next to a power of ten
+    exponent = np.where(10.0 ** (exponent + 1) <= amount, exponent + 1, exponent)
+    exponent = np.where(10.0 ** exponent > amount, exponent - 1, exponent)
+    return 10.0 ** (exponent + 1 - digits)
+
+
+@dataclass
+class LimitsTable:
+    # Lot step, minimum amount and minimum cost per symbol as arrays, with 0
+    # where the exchange does not say, and the steps in integer units. Amounts
+    # of exchanges that count precision in significant digits have no fixed
+    # step; their digits are kept instead (0 elsewhere).
+    rows: Dict[str, int]
+    step: np.ndarray
+    min_amount: np.ndarray
+    min_cost: np.ndarray
+    step_units: np.ndarray
+    scale: np.ndarray
+    digits: np.ndarray
+
+    def take(self, symbols: List[str]) -> np.ndarray:
+        return np.array([self.rows[symbol] for symbol in symbols], dtype=np.intp)
+
+
+def build_limits_table(markets: Dict[str, Dict[str, Any]], precision_mode: int = TICK_SIZE) -> LimitsTable:
+    # Precision is a step in TICK_SIZE mode, a number of decimals in
+    # DECIMAL_PLACES mode and a number of significant digits in
+    # SIGNIFICANT_DIGITS mode
+    if precision_mode not in (TICK_SIZE, DECIMAL_PLACES, SIGNIFICANT_DIGITS):
+        raise ValueError(f"Unsupported precision mode: {precision_mode}")
+    steps, digits, min_amounts, min_costs = [], [], [], []
+    for market in markets.values():
+        precision = (market.get("precision") or {}).get("amount")
+        limits = market.get("limits") or {}
+        if precision is None:
+            steps.append(0.0)
+            digits.append(0)
+        elif precision_mode == SIGNIFICANT_DIGITS:
+            steps.append(0.0)
+            digits.append(int(precision))
+        elif precision_mode == TICK_SIZE:
+            steps.append(float(precision))
+            digits.append(0)
+        else:
+            steps.append(10.0 ** -float(precision))
+            digits.append(0)
+        min_amounts.append(float((limits.get("amount") or {}).get("min") or 0.0))
+        min_costs.append(float((limits.get("cost") or {}).get("min") or 0.0))
+    step = np.array(steps, dtype=np.float64)
+    step_units, scale = get_step_units(step)
+    return LimitsTable(
+        rows={symbol: row for row, symbol in enumerate(markets)},
+        step=step,
+        min_amount=np.array(min_amounts, dtype=np.float64),
+        min_cost=np.array(min_costs, dtype=np.float64),
+        step_units=step_units,
+        scale=scale,
+        digits=np.array(digits, dtype=np.int64),
+    )
+
+
+def round_amounts(limits: LimitsTable, rows: np.ndarray, amount) -> np.ndarray:
+    amount = np.asarray(amount, dtype=np.float64)
+    step_units, scale = limits.step_units[rows], limits.scale[rows]
+    digits = limits.digits[rows]
+    significant = digits > 0
+    if significant.any():
+        significant_units, significant_scale = get_step_units(get_significant_step(amount, np.maximum(digits, 1)))
+        step_units = np.where(significant, significant_units, step_units)
+        scale = np.where(significant, significant_scale, scale)
+    floored = floor_to_units(amount, step_units, scale)
+    return np.where((limits.step[rows] > 0) | significant, floored, amount)
+
+
+def size_orders(limits: LimitsTable, symbols: List[str], budget_quote, prices) -> np.ndarray:
+    # Base amounts that spend budget_quote at the given prices, rounded down to
+    # the lot step and raised to the minimum amount and cost, as
+    # amount_from_budget did with ccxt. Purely local and vectorized across
+    # symbols.
+    rows = limits.take(symbols)
+    min_amount = limits.min_amount[rows]
+    min_cost = limits.min_cost[rows]
+    prices = np.asarray(prices, dtype=np.float64)
+
+    amount = round_amounts(limits, rows, np.asarray(budget_quote, dtype=np.float64) / prices)
+    amount = np.where((min_amount > 0) & (amount < min_amount), min_amount, amount)
+    amount = np.where((min_cost > 0) & (amount * prices < min_cost), min_cost / prices, amount)
+    return round_amounts(limits, rows, amount)
+
+
+class MarketsCache:
+    # Markets and their limits table, loaded once and then refreshed every
+    # ttl_sec in a background thread, so that no trading pass waits for
+    # load_markets(). The refresh runs on its own exchange instance and only
+    # stores its result; apply() hands it to the trading exchange with
+    # set_markets() from the trading loop, between passes, so the markets
+    # never change under an order that is being sized or placed.
+    def __init__(self, ex, refresh_ex=None, ttl_sec: float = 3600.0):
+        self.ex = ex
+        self.refresh_ex = refresh_ex or ex
+        self.ttl_sec = ttl_sec
+        self.markets = self.ex.load_markets()
+        self.limits = build_limits_table(self.markets, getattr(self.ex, "precisionMode", TICK_SIZE))
+        self.loaded_at = time.time()
+        self.lock = threading.Lock()
+        self.pending: Optional[Tuple[Dict[str, Dict[str, Any]], Any, LimitsTable, float]] = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="markets-cache", daemon=True)
+        self.thread.start()
+
+    def refresh(self) -> None:
+        markets = self.refresh_ex.load_markets(reload=True)
+        limits = build_limits_table(markets, getattr(self.refresh_ex, "precisionMode", TICK_SIZE))
+        with self.lock:
+            self.pending = (markets, getattr(self.refresh_ex, "currencies", None), limits, time.time())
+
+    def apply(self) -> bool:
+        # Called by the trading loop; returns whether new markets were applied
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is None:
+            return False
+        markets, currencies, limits, loaded_at = pending
+        if self.refresh_ex is not self.ex:
+            self.ex.set_markets(markets, currencies)
+        self.markets, self.limits, self.loaded_at = markets, limits, loaded_at
+        return True
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.ttl_sec):
+            try:
+                self.refresh()
+            except Exception as exc:
+                # Keep the last good markets; the next refresh gets another try
+                print(f"Markets refresh error: {exc}", file=sys.stderr)
+
+    def is_active(self, symbol: str) -> bool:
+        return bool((self.markets.get(symbol) or {}).get("active"))
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.thread.join()
@@ -17,13 +17,7 @@ except Exception as exc:
     print("Failed to import ccxt. Please install requirements: pip install -r requirements.txt", file=sys.stderr)
     raise
 
-try:
-    from ta.trend import EMAIndicator
-    from ta.momentum import RSIIndicator
-    from ta.volatility import AverageTrueRange
-except Exception as exc:
-    print("Failed to import ta. Please install requirements: pip install -r requirements.txt", file=sys.stderr)
-    raise
+from indicators import compute_indicators
 
 
 def load_config(path: str) -> Dict[str, Any]:
@@ -56,26 +50,6 @@ def fetch_ohlcv_df(exchange, symbol: str, timeframe: str, limit: int) -> pd.Data
     return df
 
 
-def compute_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    close = df["close"].astype(float)
-    high = df["high"].astype(float)
-    low = df["low"].astype(float)
-
-    ema200 = EMAIndicator(close=close, window=200, fillna=False).ema_indicator()
-    ema20 = EMAIndicator(close=close, window=20, fillna=False).ema_indicator()
-    rsi2 = RSIIndicator(close=close, window=2, fillna=False).rsi()
-    atr14 = AverageTrueRange(high=high, low=low, close=close, window=14, fillna=False).average_true_range()
-
-    out = df.copy()
-    out["ema200"] = ema200
-    out["ema20"] = ema20
-    out["rsi2"] = rsi2
-    out["atr14"] = atr14
-    out["roll_high20"] = df["high"].rolling(20, min_periods=20).max()
-    out["roll_low20"] = df["low"].rolling(20, min_periods=20).min()
-    return out
-
-
 def generate_signals(df: pd.DataFrame) -> pd.DataFrame:
     out = df.copy()
     out["trend_up"] = out["close"] > out["ema200"]
@@ -0,0 +1,83 @@
+import concurrent.futures
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manage_repo  # noqa: E402
+
+ADDON_INFO = """<?xml version="1.0" encoding="UTF-8"?>
+<addon id="{addon_id}" name="Test" version="0.0.0" provider-name="test">
+  <requires>
+{imports}
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py"/>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en_GB">Test</summary>
+  </extension>
+</addon>
+"""
+
+
+def git(folder, *args):
+    return subprocess.run(
+        ['git', '-C', str(folder)] + list(args), check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+
+def release(folder, tag):
+    # Commit a change to the add-on and tag it as a new version.
+    with open(str(folder / 'resources' / 'lib' / 'a.py'), 'a') as f:
+        f.write('{}\n'.format(tag))
+    git(folder, 'commit', '-qam', 'Release ' + tag)
+    git(folder, 'tag', tag)
+
+
+def make_addon(folder, addon_id, tags=('v1.0.0',),
+               imports=(('xbmc.python', '2.25.0'),)):
+    # A git add-on folder with one tagged commit per version.
+    folder.mkdir(parents=True)
+    git(folder, 'init', '-q')
+    git(folder, 'config', 'user.email', 'test@example.com')
+    git(folder, 'config', 'user.name', 'Test')
+    (folder / 'addon.xml').write_text(ADDON_INFO.format(
+        addon_id=addon_id, imports='\n'.join(
+            '    <import addon="{}" version="{}"/>'.format(*pair)
+            for pair in imports)))
+    (folder / 'default.py').write_text('print(1)\n')
+    (folder / 'resources' / 'lib').mkdir(parents=True)
+    (folder / 'resources' / 'lib' / 'a.py').write_text('x\n')
+    (folder / '.gitignore').write_text('*.log\n')
+    git(folder, 'add', '--all')
+    git(folder, 'commit', '-qm', 'Initial')
+    git(folder, 'tag', tags[0])
+    for tag in tags[1:]:
+        release(folder, tag)
+    return folder
+
+
+@pytest.fixture
+def addon_factory(tmp_path):
+    def factory(addon_id='plugin.video.test', **kwargs):
+        return make_addon(tmp_path / 'src' / addon_id, addon_id, **kwargs)
+    return factory
+
+
+@pytest.fixture
+def cache_folder(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+class InlineExecutor(concurrent.futures.ThreadPoolExecutor):
+    # Runs the build workers in this process, so that tests can patch them.
+    def __init__(self, max_workers=None):
+        super().__init__(max_workers=1)
+
+
+@pytest.fixture
+def inline_workers(monkeypatch):
+    monkeypatch.setattr(manage_repo.concurrent.futures, 'ProcessPoolExecutor',
+                        InlineExecutor)
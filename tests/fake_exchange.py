@@ -0,0 +1,44 @@
+import asyncio
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class FakeExchange:
+    # Local stand-in for a ccxt.async_support exchange: deterministic random
+    # walk candles, a fixed network latency and a request log.
+    id = "fake"
+    rateLimit = 20
+    api = {"public": {"get": {"klines": {"cost": 5, "byLimit": [[99, 1], [499, 2], [1000, 5]]}}}}
+
+    def __init__(self, latency: float = 0.05, timeframe_ms: int = 15 * 60 * 1000):
+        self.latency = latency
+        self.timeframe_ms = timeframe_ms
+        self.now = 1_700_000_000_000
+        self.requests: List[Tuple[float, str, Optional[int], int]] = []
+
+    @staticmethod
+    def parse_timeframe(timeframe: str) -> int:
+        units = {"m": 60, "h": 3600, "d": 86400}
+        return int(timeframe[:-1]) * units[timeframe[-1]]
+
+    def milliseconds(self) -> int:
+        return self.now
+
+    def _bar(self, symbol: str, ts: int) -> List[float]:
+        rng = np.random.default_rng([zlib.crc32(symbol.encode()), ts])
+        close = 100 + rng.normal()
+        return [ts, close - 0.1, close + 0.5, close - 0.5, close, rng.random() * 1000]
+
+    async def fetch_ohlcv(self, symbol: str, timeframe: str = "15m", since: Optional[int] = None,
+                          limit: Optional[int] = None) -> List[List[float]]:
+        self.requests.append((time.monotonic(), symbol, since, limit))
+        await asyncio.sleep(self.latency)
+        current = self.now // self.timeframe_ms * self.timeframe_ms
+        start = current - (limit - 1) * self.timeframe_ms if since is None else since
+        return [self._bar(symbol, ts) for ts in range(start, current + 1, self.timeframe_ms)][:limit]
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bot
+from indicators import IndicatorEngine
+from market_data import build_limits_table
+
+TIMEFRAME_MS = 15 * 60 * 1000
+
+
+class FakeClockExchange:
+    def __init__(self, offset_ms, has_time=True):
+        self.offset_ms = offset_ms
+        self.has = {"fetchTime": has_time}
+
+    def fetch_time(self):
+        return int(bot.time.time() * 1000 + self.offset_ms)
+
+
+class FakeTradingExchange:
+    # Fills every market order and answers fetch_tickers from a dict.
+    def __init__(self):
+        self.orders = []
+        self.tickers = {}
+
+    def create_order(self, symbol, type, side, amount):
+        self.orders.append((symbol, side, amount))
+        return {"symbol": symbol, "side": side, "amount": amount}
+
+    def fetch_tickers(self, symbols):
+        return {symbol: self.tickers[symbol] for symbol in symbols if symbol in self.tickers}
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    now = [1_700_000_123.456]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    return now
+
+
+def test_bar_clock_follows_the_exchange_clock(frozen_time):
+    clock = bot.BarClock(TIMEFRAME_MS)
+    clock.sync(FakeClockExchange(offset_ms=90_000))
+    assert clock.offset_ms == pytest.approx(90_000, abs=1)
+    assert clock.synced_at is not None
+    now_ms = frozen_time[0] * 1000 + 90_000
+    assert clock.bar_open() == now_ms // TIMEFRAME_MS * TIMEFRAME_MS
+    assert clock.bar_open() % TIMEFRAME_MS == 0
+    assert clock.seconds_until_close() == pytest.approx((clock.bar_open() + TIMEFRAME_MS - now_ms) / 1000)
+
+    # The next bar starts right as the current one closes
+    bar = clock.bar_open()
+    frozen_time[0] += clock.seconds_until_close()
+    assert clock.bar_open() == bar + TIMEFRAME_MS
+    assert clock.seconds_until_close() == pytest.approx(TIMEFRAME_MS / 1000)
+
+
+def test_bar_clock_without_fetch_time_uses_the_local_clock(frozen_time):
+    clock = bot.BarClock(TIMEFRAME_MS)
+    clock.sync(FakeClockExchange(offset_ms=90_000, has_time=False))
+    assert clock.offset_ms == 0
+    assert clock.now_ms() == frozen_time[0] * 1000
+
+
+def uptrend(bars=260):
+    # A steady climb, so the last close breaks the 20-bar high above EMA200
+    close = 100 + np.arange(bars) * 0.1
+    index = pd.date_range("2024-01-01", periods=bars, freq="15min", tz="UTC", name="timestamp")
+    return pd.DataFrame({"open": close - 0.05, "high": close + 0.05, "low": close - 0.1,
+                         "close": close, "volume": 1.0}, index=index)
+
+
+def test_breakout_entry_on_bar_close_then_trailing_stop_on_ticker(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "STATE_PATH", str(tmp_path / "positions.json"))
+    ex = FakeTradingExchange()
+    limits = build_limits_table({"X/USDT": {"precision": {"amount": 0.001},
+                                            "limits": {"amount": {"min": 0.001}, "cost": {"min": 1}}}})
+    params = bot.TradingParams(close_if_below_ema200=False)
+    state = {"positions": {}}
+    engines = {}
+    df = uptrend()
+
+    bot.run_bar_close_pass(ex, {}, state, params, [("X/USDT", df)], engines, limits)
+    price = float(df["close"].iloc[-1])
+    # The order budget, rounded down to the lot step
+    assert ex.orders == [("X/USDT", "buy", pytest.approx(math.floor(5.0 / price * 1000) / 1000))]
+    pos = state["positions"]["X/USDT"]
+    assert pos["qty"] > 0 and pos["highest_close"] == price
+    assert isinstance(engines["X/USDT"], IndicatorEngine)
+
+    # A higher ticker does not move the highest close between bar closes
+    ex.tickers["X/USDT"] = {"last": price + 10}
+    bot.run_ticker_pass(ex, {}, state, params, engines, limits)
+    assert len(ex.orders) == 1 and pos["highest_close"] == price
+
+    atr = engines["X/USDT"].last_closed["atr14"]
+    ex.tickers["X/USDT"] = {"last": price - params.trail_mult * atr - 0.01}
+    bot.run_ticker_pass(ex, {}, state, params, engines, limits)
+    assert ex.orders[-1] == ("X/USDT", "sell", ex.orders[0][2])
+    assert pos["qty"] == 0
@@ -0,0 +1,63 @@
+import math
+
+import numpy as np
+import pytest
+
+import indicators
+from indicators import IndicatorEngine, compute_indicators, random_ohlcv
+
+pytest.importorskip("ta")
+
+COLUMNS = ("ema200", "ema20", "rsi2", "atr14", "roll_high20", "roll_low20")
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_streaming_indicators_match_ta(seed):
+    df = random_ohlcv(1000, seed)
+    expected = indicators.compute_indicators_ta(df)
+    actual = compute_indicators(df)
+    for column in COLUMNS:
+        assert indicators.compare(expected[column], actual[column], 1e-9) == 0.0, column
+
+
+def test_sync_matches_replay():
+    df = random_ohlcv(300, 7)
+    replay = compute_indicators(df)
+    engine = IndicatorEngine()
+    for end in range(1, len(df) + 1):
+        values = engine.sync(df.iloc[:end])
+        for column, value in values.items():
+            reference = replay[column].iloc[end - 1]
+            assert value == reference or (math.isnan(value) and math.isnan(reference)), (end, column)
+
+
+def test_sync_follows_a_sliding_window():
+    # The bot syncs the last 400 bars of its OHLCV ring; only the new bars
+    # are pushed, so the state carries the history before the window.
+    df = random_ohlcv(700, 3)
+    replay = compute_indicators(df)
+    engine = IndicatorEngine()
+    for end in range(400, len(df) + 1, 25):
+        values = engine.sync(df.iloc[end - 400:end])
+    for column, value in values.items():
+        assert value == replay[column].iloc[-1], column
+
+
+def test_ema200_drifts_from_ta_on_the_window():
+    # ta on the last 400 bars seeds EMA200 with the first close of the
+    # window, while the engine has seen every bar since the start. The gap
+    # decays by 1 - 2 / 201 per bar, so it is (199 / 201) ** 400 (about
+    # 1.8%) of the gap between EMA200 and the close at the window start.
+    # The faster indicators agree within floating-point noise.
+    df = random_ohlcv(1000, 11)
+    streaming = compute_indicators(df)
+    window = indicators.compute_indicators_ta(df.iloc[-400:])
+
+    alpha = 2.0 / 201
+    gap = streaming["ema200"].iloc[-401] - df["close"].iloc[-400]
+    expected = (1 - alpha) ** 400 * gap
+    drift = streaming["ema200"].iloc[-1] - window["ema200"].iloc[-1]
+    assert drift != 0.0
+    assert drift == pytest.approx(expected, rel=1e-6)
+    for column in ("ema20", "rsi2", "atr14", "roll_high20", "roll_low20"):
+        assert np.isclose(streaming[column].iloc[-1], window[column].iloc[-1], rtol=1e-9, atol=0), column
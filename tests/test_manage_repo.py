@@ -0,0 +1,832 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import time
+import zipfile
+
+import git
+import pytest
+
+import manage_repo
+
+from conftest import ADDON_INFO, git as run_git, release
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['create_repository.py'] + list(argv))
+    manage_repo.main()
+
+
+def build(addon_locations, data_path, cache_folder, buildvers=('leia',),
+          retention=None, **kwargs):
+    os.makedirs(str(data_path), exist_ok=True)
+    manage_repo.create_repository(
+        [str(location) for location in addon_locations], str(data_path),
+        False, list(buildvers),
+        options=manage_repo.BuildOptions(cache_folder=cache_folder, **kwargs),
+        retention=retention)
+
+
+def count_fetches(monkeypatch, name):
+    calls = []
+    fetch = getattr(manage_repo, name)
+
+    def counting_fetch(addon_location, *args):
+        calls.append(addon_location)
+        return fetch(addon_location, *args)
+
+    monkeypatch.setattr(manage_repo, name, counting_fetch)
+    return calls
+
+
+def count_objects(folder):
+    return run_git(folder, 'count-objects', '-v')
+
+
+def test_worktree_hash_leaves_repository_untouched(addon_factory):
+    folder = addon_factory()
+    repo = git.Repo(str(folder))
+    clean_hash = manage_repo.get_worktree_hash(repo)
+    assert clean_hash == repo.head.commit.tree.hexsha
+
+    # Untracked files are not packaged, so they do not change the hash.
+    (folder / 'resources' / 'lib' / 'b.py').write_text('new\n')
+    (folder / 'debug.log').write_text('ignored\n')
+    assert manage_repo.get_worktree_hash(repo) == clean_hash
+
+    (folder / 'resources' / 'lib' / 'a.py').write_text('changed\n')
+    objects = count_objects(folder)
+    status = run_git(folder, 'status', '--porcelain')
+    dirty_hash = manage_repo.get_worktree_hash(repo)
+
+    assert dirty_hash != clean_hash
+    assert count_objects(folder) == objects
+    assert run_git(folder, 'status', '--porcelain') == status
+    run_git(folder, 'add', '--update')
+    assert run_git(folder, 'write-tree') == dirty_hash
+
+
+def test_worktree_hash_sees_racily_clean_files(addon_factory):
+    # An edit that keeps the size and the timestamps of a file, (within the
+    # resolution that git compares), is only seen because the file is no
+    # older than the index, so the index timestamp must be kept.
+    folder = addon_factory()
+    run_git(folder, 'config', 'core.trustctime', 'false')
+    source_path = str(folder / 'default.py')
+    timestamp = time.time() - 60
+    os.utime(source_path, (timestamp, timestamp))
+    run_git(folder, 'update-index', '--refresh')
+    repo = git.Repo(str(folder))
+    clean_hash = manage_repo.get_worktree_hash(repo)
+    with open(source_path, 'w') as source_file:
+        source_file.write('print(2)\n')
+    os.utime(source_path, (timestamp, timestamp))
+    os.utime(repo.index.path, (timestamp, timestamp))
+    assert manage_repo.get_worktree_hash(repo) != clean_hash
+
+
+@pytest.mark.parametrize('argv', [
+    ['-j', '0', 'addon'],
+    ['-j', '-2', 'addon'],
+    ['verify', '-j', '0'],
+])
+def test_jobs_must_be_positive(monkeypatch, capsys, argv):
+    monkeypatch.setattr(sys, 'argv', ['create_repository.py'] + argv)
+    with pytest.raises(SystemExit) as excinfo:
+        manage_repo.main()
+    assert excinfo.value.code == 2
+    assert 'must be a positive integer' in capsys.readouterr().err
+
+
+def test_digests_are_written_and_shake_is_rejected(
+        monkeypatch, capsys, tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    data_path.mkdir()
+    run_main(monkeypatch, str(folder), '-d', str(data_path),
+             '--cachedir', cache_folder, '--digests', 'sha256', 'sha512')
+    archive = data_path / 'leia' / 'plugin.video.test' / \
+        'plugin.video.test-1.0.0_leia.zip'
+    assert os.path.isfile('{}.sha256'.format(archive))
+    assert os.path.isfile('{}.sha512'.format(archive))
+    assert not os.path.isfile('{}.md5'.format(archive))
+
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, str(folder), '--digests', 'shake_128')
+    assert "invalid choice: 'shake_128'" in capsys.readouterr().err
+
+
+def test_compression_threads_are_shared_between_workers(
+        monkeypatch, tmp_path, addon_factory, cache_folder, inline_workers):
+    thread_counts = []
+    compress_members = manage_repo.compress_members
+
+    def record_threads(sources, level, max_workers=None):
+        thread_counts.append(max_workers)
+        return compress_members(sources, level, max_workers)
+
+    monkeypatch.setattr(manage_repo, 'compress_members', record_threads)
+    monkeypatch.setattr(manage_repo.os, 'cpu_count', lambda: 8)
+    folders = [str(addon_factory('plugin.video.test{}'.format(index)))
+               for index in range(3)]
+    manage_repo.create_repository(
+        folders, str(tmp_path), False, ['leia'], jobs=2,
+        options=manage_repo.BuildOptions(cache_folder=cache_folder))
+    assert thread_counts == [4, 4, 4]
+
+
+CUSTOM_CATALOG = b'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<!-- Maintained by hand -->
+<addons>
+    <addon id="repository.other" name="Other" version="1.0.0" />
+    <addon id="script.module.other" name="Module" version="2.0.0" />
+</addons>
+'''
+
+
+@pytest.mark.parametrize('basename', ['addons.xml', 'addons.xml.gz'])
+def test_unchanged_merge_keeps_catalog_bytes(tmp_path, basename):
+    catalog_path = tmp_path / basename
+    if basename.endswith('.gz'):
+        with gzip.open(str(catalog_path), 'wb') as catalog_file:
+            catalog_file.write(CUSTOM_CATALOG)
+    else:
+        catalog_path.write_bytes(CUSTOM_CATALOG)
+    manage_repo.merge_catalog(str(tmp_path), [])
+    assert (tmp_path / 'addons.xml').read_bytes() == CUSTOM_CATALOG
+
+
+def test_rebuild_keeps_catalog_bytes(tmp_path, addon_factory, cache_folder):
+    folder = str(addon_factory())
+    options = manage_repo.BuildOptions(cache_folder=cache_folder)
+    manage_repo.create_repository([folder], str(tmp_path), False, ['leia'],
+                                  options=options)
+    catalog = (tmp_path / 'leia' / 'addons.xml').read_bytes()
+    manage_repo.create_repository([folder], str(tmp_path), False, ['leia'],
+                                  force=True, options=options)
+    assert (tmp_path / 'leia' / 'addons.xml').read_bytes() == catalog
+
+
+def test_unchanged_folders_are_not_rebuilt(
+        monkeypatch, tmp_path, addon_factory, cache_folder, inline_workers):
+    folder = addon_factory()
+    fetches = count_fetches(monkeypatch, 'fetch_addon_from_folder')
+    addon_folder = tmp_path / 'out' / 'leia' / 'plugin.video.test'
+    build([folder], tmp_path / 'out', cache_folder)
+    assert len(fetches) == 1
+    build([folder], tmp_path / 'out', cache_folder)
+    assert len(fetches) == 1
+
+    # Uncommitted changes are part of the source key.
+    (folder / 'default.py').write_text('print(2)\n')
+    build([folder], tmp_path / 'out', cache_folder)
+    assert len(fetches) == 2
+    (folder / 'debug.log').write_text('ignored\n')
+    build([folder], tmp_path / 'out', cache_folder)
+    assert len(fetches) == 2
+
+    run_git(folder, 'commit', '-qam', 'Change output')
+    release(folder, 'v1.1.0')
+    build([folder], tmp_path / 'out', cache_folder)
+    assert len(fetches) == 3
+    assert (addon_folder / 'plugin.video.test-1.1.0_leia.zip').is_file()
+    assert b'version="1.1.0_leia"' in \
+        (tmp_path / 'out' / 'leia' / 'addons.xml').read_bytes()
+
+
+def list_archive(data_path, version='1.0.0_leia', kodi_version='leia',
+                 addon_id='plugin.video.test'):
+    archive_path = os.path.join(
+        str(data_path), kodi_version, addon_id,
+        '{}-{}.zip'.format(addon_id, version))
+    with zipfile.ZipFile(archive_path) as archive:
+        return sorted(archive.namelist())
+
+
+def read_member(data_path, name, version='1.0.0_leia', kodi_version='leia',
+                addon_id='plugin.video.test'):
+    archive_path = os.path.join(
+        str(data_path), kodi_version, addon_id,
+        '{}-{}.zip'.format(addon_id, version))
+    with zipfile.ZipFile(archive_path) as archive:
+        return archive.read('{}/{}'.format(addon_id, name))
+
+
+def get_python_import(info_contents):
+    root = manage_repo.parse_metadata(io.BytesIO(info_contents)).root
+    return [element.get('version') for element in root.iter('import')
+            if element.get('addon') == 'xbmc.python']
+
+
+def test_variants_only_differ_in_addon_xml(
+        tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    build([folder], data_path, cache_folder, buildvers=('leia', 'matrix'))
+    leia_info = read_member(data_path, 'addon.xml')
+    matrix_info = read_member(data_path, 'addon.xml', '1.0.0_matrix',
+                              'matrix')
+    # The Python API is only rewritten for Kodi versions that need one.
+    assert get_python_import(leia_info) == ['2.25.0']
+    assert get_python_import(matrix_info) == ['3.0.0']
+    assert b'version="1.0.0_leia"' in leia_info
+    assert b'version="1.0.0_matrix"' in matrix_info
+    assert (data_path / 'matrix' / 'plugin.video.test' /
+            'addon.xml').read_bytes() == matrix_info
+    assert get_python_import(
+        (folder / 'addon.xml').read_bytes()) == ['2.25.0']
+
+    # Every other member is the same, compressed bytes and all.
+    archives = [
+        zipfile.ZipFile(str(data_path / kodi_version / 'plugin.video.test' /
+                            'plugin.video.test-1.0.0_{}.zip'.format(
+                                kodi_version)))
+        for kodi_version in ('leia', 'matrix')]
+    for (leia_member, matrix_member) in zip(
+            *(archive.infolist() for archive in archives)):
+        assert leia_member.filename == matrix_member.filename
+        if leia_member.filename.endswith('/addon.xml'):
+            continue
+        assert (leia_member.CRC, leia_member.compress_size,
+                leia_member.date_time) == (
+            matrix_member.CRC, matrix_member.compress_size,
+            matrix_member.date_time)
+    for archive in archives:
+        archive.close()
+
+
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_sources_are_read_in_place(
+        tmp_path, addon_factory, cache_folder, snapshot):
+    folder = addon_factory()
+    (folder / 'default.py').write_text('print(2)\n')
+    run_git(folder, 'add', 'default.py')
+    (folder / 'default.py').write_text('print(3)\n')
+    (folder / 'resources' / 'lib' / 'b.py').write_text('untracked\n')
+    run_git(folder, 'add', '--intent-to-add', 'resources/lib/b.py')
+    status = run_git(folder, 'status', '--porcelain')
+
+    data_path = tmp_path / 'out'
+    build([folder], data_path, cache_folder, snapshot=snapshot)
+    # A snapshot packages what is staged, the default the working tree.
+    assert read_member(data_path, 'default.py') == (
+        b'print(2)\n' if snapshot else b'print(3)\n')
+    assert ('plugin.video.test/resources/lib/b.py' in
+            list_archive(data_path)) is not snapshot
+    # Nothing is copied next to the sources or changed in the repository.
+    assert run_git(folder, 'status', '--porcelain') == status
+    assert sorted(os.listdir(str(tmp_path))) == ['cache', 'out', 'src']
+
+
+def test_members_are_stored_or_deflated(tmp_path, addon_factory,
+                                        cache_folder):
+    folder = addon_factory()
+    text = b'x = 1\n' * 1000
+    (folder / 'icon.png').write_bytes(text)
+    (folder / 'resources' / 'noise.bin').write_bytes(os.urandom(4096))
+    (folder / 'resources' / 'lib' / 'big.py').write_bytes(text)
+    run_git(folder, 'add', '--all')
+    run_git(folder, 'commit', '-qm', 'Add assets')
+    run_git(folder, 'tag', '-f', 'v1.0.0')
+
+    def get_compress_types(data_path):
+        with zipfile.ZipFile(os.path.join(
+                str(data_path), 'leia', 'plugin.video.test',
+                'plugin.video.test-1.0.0_leia.zip')) as archive:
+            return dict((info.filename.split('/', 1)[1], info.compress_type)
+                        for info in archive.infolist())
+
+    build([folder], tmp_path / 'out', cache_folder, compression_threads=4)
+    types = get_compress_types(tmp_path / 'out')
+    # Images are stored even when deflate would shrink them, and so is
+    # anything that deflate cannot shrink.
+    assert types['icon.png'] == zipfile.ZIP_STORED
+    assert types['resources/noise.bin'] == zipfile.ZIP_STORED
+    assert types['resources/lib/big.py'] == zipfile.ZIP_DEFLATED
+
+    # The thread count does not change the archive.
+    build([folder], tmp_path / 'serial', cache_folder, compression_threads=1)
+    assert read_member(tmp_path / 'serial', 'resources/lib/big.py') == text
+    archive_path = os.path.join('leia', 'plugin.video.test',
+                                'plugin.video.test-1.0.0_leia.zip')
+    assert (tmp_path / 'serial' / archive_path).read_bytes() == \
+        (tmp_path / 'out' / archive_path).read_bytes()
+
+    build([folder], tmp_path / 'stored', cache_folder, compression_level=0)
+    assert set(get_compress_types(tmp_path / 'stored').values()) == {
+        zipfile.ZIP_STORED}
+
+
+def test_rebuilds_are_identical_and_deduplicated(
+        tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    (folder / 'icon.png').write_bytes(b'png')
+    run_git(folder, 'add', '--all')
+    run_git(folder, 'commit', '-qm', 'Add an icon')
+    run_git(folder, 'tag', '-f', 'v1.0.0')
+    archive_path = os.path.join('plugin.video.test',
+                                'plugin.video.test-1.0.0_leia.zip')
+
+    data_paths = [tmp_path / 'first', tmp_path / 'second']
+    for data_path in data_paths:
+        if data_path != data_paths[0]:
+            # File times and the build time do not leak into the archive.
+            os.utime(str(folder / 'default.py'), (0, 0))
+            time.sleep(1)
+        build([folder], data_path, cache_folder, buildvers=('leia', 'matrix'),
+              blob_folder=str(data_path / manage_repo.BLOB_FOLDER_BASENAME))
+    assert (data_paths[0] / 'leia' / archive_path).read_bytes() == \
+        (data_paths[1] / 'leia' / archive_path).read_bytes()
+
+    # Identical files of both Kodi versions share one inode with the blob.
+    leia_folder = data_paths[0] / 'leia' / 'plugin.video.test'
+    matrix_folder = data_paths[0] / 'matrix' / 'plugin.video.test'
+    icon = os.stat(str(leia_folder / 'icon.png'))
+    assert icon.st_ino == os.stat(str(matrix_folder / 'icon.png')).st_ino
+    assert icon.st_nlink == 3
+    blob_path = manage_repo.get_blob_path(
+        str(data_paths[0] / manage_repo.BLOB_FOLDER_BASENAME),
+        hashlib.sha256(b'png').hexdigest())
+    assert os.path.samefile(blob_path, str(leia_folder / 'icon.png'))
+    archive = os.stat(str(data_paths[0] / 'leia' / archive_path))
+    assert archive.st_nlink == 2
+
+    # Without a blob store, nothing is linked.
+    build([folder], tmp_path / 'plain', cache_folder,
+          buildvers=('leia', 'matrix'))
+    assert os.stat(str(tmp_path / 'plain' / 'leia' / 'plugin.video.test' /
+                       'icon.png')).st_nlink == 1
+
+
+def test_only_indexed_files_are_packaged(tmp_path, addon_factory,
+                                         cache_folder):
+    folder = addon_factory()
+    (folder / '.gitattributes').write_text('docs/** export-ignore\n')
+    (folder / 'docs').mkdir()
+    (folder / 'docs' / 'notes.txt').write_text('internal\n')
+    (folder / 'tests').mkdir()
+    (folder / 'tests' / 'test_a.py').write_text('pass\n')
+    run_git(folder, 'add', '--all')
+    run_git(folder, 'commit', '-qm', 'Add docs and tests')
+    run_git(folder, 'tag', '-f', 'v1.0.0')
+    # Untracked files are left out even when .gitignore does not match them.
+    (folder / 'notes-untracked.txt').write_text('draft\n')
+    (folder / 'addons.xml').write_text('<addons/>\n')
+    (folder / '.build-manifest.json').write_text('{}\n')
+    (folder / 'debug.log').write_text('ignored\n')
+
+    build([folder], tmp_path / 'out', cache_folder)
+    assert list_archive(tmp_path / 'out') == [
+        'plugin.video.test/addon.xml',
+        'plugin.video.test/changelog.txt',
+        'plugin.video.test/default.py',
+        'plugin.video.test/resources/lib/a.py',
+    ]
+
+
+class StopWatching(BaseException):
+    pass
+
+
+def test_watch_rebuilds_only_changed_addons(
+        monkeypatch, tmp_path, addon_factory, cache_folder):
+    changed = addon_factory('plugin.video.changed')
+    unchanged = addon_factory('plugin.video.unchanged')
+    data_path = tmp_path / 'out'
+    os.makedirs(str(data_path))
+    builds = []
+    create_repository = manage_repo.create_repository
+
+    def record_build(addon_locations, *args, **kwargs):
+        builds.append(sorted(addon_locations))
+        return create_repository(addon_locations, *args, **kwargs)
+
+    changes = [lambda: release(changed, 'v1.1.0'), lambda: None]
+
+    def wait_for_changes(watcher, watches, interval):
+        # Poll every local add-on, with one change before the first poll.
+        if not changes:
+            raise StopWatching()
+        changes.pop(0)()
+        return None
+
+    monkeypatch.setattr(manage_repo, 'inotify_simple', None)
+    monkeypatch.setattr(manage_repo, 'create_repository', record_build)
+    monkeypatch.setattr(manage_repo, 'wait_for_changes', wait_for_changes)
+    with pytest.raises(StopWatching):
+        manage_repo.watch_repository(
+            [str(changed), str(unchanged)], str(data_path), False, ['leia'],
+            options=manage_repo.BuildOptions(cache_folder=cache_folder))
+
+    # The initial build, then one for the changed add-on only.
+    assert builds == [sorted([str(changed), str(unchanged)]), [str(changed)]]
+    catalog = (data_path / 'leia' / 'addons.xml').read_bytes()
+    assert b'id="plugin.video.changed" name="Test" version="1.1.0_leia"' \
+        in catalog
+    assert b'id="plugin.video.unchanged" name="Test" version="1.0.0_leia"' \
+        in catalog
+
+
+def make_monorepo(folder, addon_ids):
+    # One git repository with an add-on in a subfolder per ID.
+    folder.mkdir()
+    run_git(folder, 'init', '-q')
+    run_git(folder, 'config', 'user.email', 'test@example.com')
+    run_git(folder, 'config', 'user.name', 'Test')
+    for addon_id in addon_ids:
+        (folder / addon_id).mkdir()
+        (folder / addon_id / 'addon.xml').write_text(ADDON_INFO.format(
+            addon_id=addon_id, imports='').replace('0.0.0', '1.0.0'))
+        (folder / addon_id / 'default.py').write_text('print(1)\n')
+    run_git(folder, 'add', '--all')
+    run_git(folder, 'commit', '-qm', 'Initial')
+    return folder
+
+
+def test_git_sources_share_a_mirror(
+        monkeypatch, tmp_path, cache_folder, inline_workers):
+    upstream = make_monorepo(tmp_path / 'upstream', ['plugin.a', 'plugin.b'])
+    locations = ['file://{}:{}'.format(upstream, addon_id)
+                 for addon_id in ('plugin.a', 'plugin.b')]
+    fetches = count_fetches(monkeypatch, 'fetch_addon_from_mirror')
+    data_path = tmp_path / 'out'
+    build(locations, data_path, cache_folder)
+    assert len(fetches) == 2
+    mirrors = os.listdir(os.path.join(
+        cache_folder, manage_repo.MIRROR_FOLDER_BASENAME))
+    assert len([name for name in mirrors if name.endswith('.git')]) == 1
+    for addon_id in ('plugin.a', 'plugin.b'):
+        archive = data_path / 'leia' / addon_id / '{}-1.0.0.zip'.format(
+            addon_id)
+        with zipfile.ZipFile(str(archive)) as archive_file:
+            assert sorted(name for name in archive_file.namelist()
+                          if not name.endswith('/')) == [
+                '{}/addon.xml'.format(addon_id),
+                '{}/default.py'.format(addon_id)]
+
+    # The remote refs are the source key, so nothing is fetched until the
+    # branch moves.
+    build(locations, data_path, cache_folder)
+    assert len(fetches) == 2
+    info_path = upstream / 'plugin.b' / 'addon.xml'
+    info_path.write_text(info_path.read_text().replace('1.0.0', '1.1.0'))
+    run_git(upstream, 'commit', '-qam', 'Release plugin.b 1.1.0')
+    build(locations, data_path, cache_folder)
+    assert len(fetches) == 4
+    assert (data_path / 'leia' / 'plugin.b' / 'plugin.b-1.1.0.zip').is_file()
+
+
+def test_profile_reports_one_key_per_addon(
+        tmp_path, cache_folder, inline_workers):
+    upstream = make_monorepo(tmp_path / 'upstream', ['plugin.a'])
+    location = 'file://{}#{}:plugin.a'.format(
+        upstream, run_git(upstream, 'rev-parse', '--abbrev-ref', 'HEAD'))
+    profile_path = tmp_path / 'profile.json'
+    os.makedirs(str(tmp_path / 'out'))
+    manage_repo.create_repository(
+        [location], str(tmp_path / 'out'), False, ['leia'],
+        options=manage_repo.BuildOptions(cache_folder=cache_folder),
+        profile_path=str(profile_path))
+    stages = json.loads(profile_path.read_text())['stages']
+    assert set(stage['addon'] for stage in stages) == {None, location}
+    assert set(stage['stage'] for stage in stages if stage['addon']) == {
+        'source key', 'git fetch', 'archive', 'metadata'}
+
+
+@pytest.mark.skipif(not manage_repo.reset_peak_rss(),
+                    reason='The peak RSS cannot be reset')
+def test_profile_peak_rss_is_per_stage():
+    del manage_repo.stage_records[:]
+    size = 256 * 1048576
+    with manage_repo.profile_stage(None, 'outer'):
+        with manage_repo.profile_stage(None, 'large'):
+            buffer = bytearray(size)
+            buffer[::4096] = b'x' * len(buffer[::4096])
+            del buffer
+        with manage_repo.profile_stage(None, 'small'):
+            pass
+    peaks = dict((record.stage, record.peak_rss)
+                 for record in manage_repo.stage_records)
+    # A later stage in the same process does not inherit an earlier peak,
+    # but the enclosing stage includes the peaks of the stages inside it.
+    assert peaks['large'] - peaks['small'] >= size // 2
+    assert peaks['outer'] >= peaks['large']
+
+
+def test_query_lists_the_inventory(tmp_path, addon_factory, cache_folder):
+    module = addon_factory('script.module.test', tags=('v1.0.0', 'v1.2.0'))
+    plugin = addon_factory(imports=(('xbmc.python', '2.25.0'),
+                                    ('script.module.test', '1.0.0')))
+    data_path = tmp_path / 'out'
+    build([module, plugin], data_path, cache_folder)
+    run_git(module, 'checkout', '-q', 'v1.0.0')
+    build([module], data_path, cache_folder)
+
+    rows = manage_repo.query_inventory(str(data_path), ['leia'])
+    assert [(row['id'], row['version']) for row in rows] == [
+        ('plugin.video.test', '1.0.0_leia'),
+        ('script.module.test', '1.0.0_leia'),
+        ('script.module.test', '1.2.0_leia')]
+    rows = manage_repo.query_inventory(str(data_path), None, 'script.*',
+                                       latest=True)
+    assert [row['version'] for row in rows] == ['1.2.0_leia']
+    rows = manage_repo.query_inventory(
+        str(data_path), None, required_by='script.module.test')
+    assert [row['id'] for row in rows] == ['plugin.video.test']
+    assert rows[0]['requires'][1] == {
+        'id': 'xbmc.python', 'version': '2.25.0', 'optional': False}
+
+
+def write_with_checksums(path, contents, algorithms):
+    path.write_bytes(contents)
+    for algorithm in algorithms:
+        checksum_path = '{}.{}'.format(path, algorithm)
+        with open(checksum_path, 'w') as checksum_file:
+            checksum_file.write(hashlib.new(algorithm, contents).hexdigest())
+
+
+def test_verify_checks_every_catalog_copy(
+        tmp_path, addon_factory, cache_folder):
+    zstandard = pytest.importorskip('zstandard')
+    pytest.importorskip('brotli')
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    build([folder], data_path, cache_folder,
+          digests=('sha256', 'sha512'), catalog_encodings=('gz', 'zst', 'br'))
+    assert manage_repo.verify_repository(str(data_path), ['leia']) == []
+
+    target_folder = data_path / 'leia'
+    catalog_path = target_folder / 'addons.xml'
+    archive_path = target_folder / 'plugin.video.test' / \
+        'plugin.video.test-1.0.0_leia.zip'
+    (target_folder / 'addons.xml.br.sha512').write_text('0' * 128)
+    stale = zstandard.ZstdCompressor().compress(b'<addons></addons>')
+    write_with_checksums(target_folder / 'addons.xml.zst', stale,
+                         ('md5', 'sha256', 'sha512'))
+    write_with_checksums(target_folder / 'addons.xml.gz', b'not gzip',
+                         ('md5', 'sha256', 'sha512'))
+    with open(str(archive_path), 'ab') as archive_file:
+        archive_file.write(b'\0')
+    os.remove('{}.md5'.format(catalog_path))
+
+    problems = manage_repo.verify_repository(str(data_path), ['leia'])
+    assert sorted(problems) == sorted([
+        '{}: No checksum file found: md5'.format(catalog_path),
+        '{}.br: Checksum mismatch: sha512'.format(catalog_path),
+        '{}.zst: Contents differ from addons.xml'.format(catalog_path),
+        "{}.gz: Not a gzipped file (b'no')".format(catalog_path),
+        '{}: Checksum mismatch: sha256'.format(archive_path),
+        '{}: Checksum mismatch: sha512'.format(archive_path),
+        '{}: Size of archive {} does not match'.format(
+            data_path / manage_repo.INVENTORY_BASENAME,
+            os.path.relpath(str(archive_path), str(data_path)))])
+
+
+def test_verify_fails_without_catalogs(
+        monkeypatch, capsys, tmp_path, addon_factory, cache_folder):
+    data_path = tmp_path / 'out'
+    build([addon_factory()], data_path, cache_folder)
+    run_main(monkeypatch, 'verify', '-d', str(data_path))
+    # A folder without any catalog, (such as the parent of the data
+    # folder), fails rather than passing with nothing checked.
+    for folder in (tmp_path, data_path / 'leia' / 'plugin.video.test'):
+        with pytest.raises(SystemExit) as excinfo:
+            run_main(monkeypatch, 'verify', '-d', str(folder))
+        assert excinfo.value.code == 1
+        assert 'No addons.xml found' in capsys.readouterr().err
+
+
+def test_catalog_copies_and_manifest_are_published(
+        tmp_path, addon_factory, cache_folder):
+    zstandard = pytest.importorskip('zstandard')
+    brotli = pytest.importorskip('brotli')
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    build([folder], data_path, cache_folder, digests=('md5', 'sha256'),
+          catalog_encodings=('gz', 'zst', 'br'))
+    catalog_path = data_path / 'leia' / 'addons.xml'
+    contents = catalog_path.read_bytes()
+    decoders = {
+        'gz': gzip.decompress,
+        'zst': lambda data: zstandard.ZstdDecompressor().decompress(
+            data, max_output_size=len(contents)),
+        'br': brotli.decompress,
+    }
+    for (encoding, decode) in decoders.items():
+        copy = data_path / 'leia' / 'addons.xml.{}'.format(encoding)
+        data = copy.read_bytes()
+        assert decode(data) == contents
+        for algorithm in ('md5', 'sha256'):
+            with open('{}.{}'.format(copy, algorithm)) as checksum_file:
+                assert checksum_file.read().split()[0] == \
+                    hashlib.new(algorithm, data).hexdigest()
+
+    def read_manifest():
+        with open(str(data_path / manage_repo.PUBLISH_MANIFEST_BASENAME),
+                  'rb') as manifest_file:
+            return json.loads(manifest_file.read().decode('utf-8'))['files']
+
+    files = read_manifest()
+    assert 'leia/addons.xml.zst' in files
+    assert 'leia/addons.xml.zst.sha256' in files
+    assert ('leia/plugin.video.test/plugin.video.test-1.0.0_leia.zip'
+            in files)
+    for (relpath, entry) in files.items():
+        with open(str(data_path / relpath), 'rb') as published_file:
+            data = published_file.read()
+        assert entry == {'size': len(data),
+                         'sha256': hashlib.sha256(data).hexdigest()}
+
+    # Copies that are no longer asked for are removed with their checksums,
+    # and leave the manifest.
+    build([folder], data_path, cache_folder, digests=('md5', 'sha256'),
+          catalog_encodings=('gz', 'br'))
+    assert [name for name in os.listdir(str(data_path / 'leia'))
+            if name.startswith('addons.xml.zst')] == []
+    assert [relpath for relpath in read_manifest()
+            if relpath.startswith('leia/addons.xml.zst')] == []
+
+
+def build_releases(folder, data_path, cache_folder, tags, **kwargs):
+    for tag in tags:
+        release(folder, tag)
+        build([folder], data_path, cache_folder, **kwargs)
+
+
+def list_versions(addon_folder):
+    return sorted(manage_repo.get_versioned_files(
+        str(addon_folder), addon_folder.name))
+
+
+def test_keep_prunes_old_versions_but_not_pinned_ones(
+        capsys, tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    blob_folder = str(data_path / manage_repo.BLOB_FOLDER_BASENAME)
+    build([folder], data_path, cache_folder, blob_folder=blob_folder)
+    build_releases(folder, data_path, cache_folder,
+                   ['v1.1.0', 'v1.2.0', 'v1.3.0'], blob_folder=blob_folder)
+    addon_folder = data_path / 'leia' / 'plugin.video.test'
+    pinned = (('plugin.video.test', '1.0.0'), ('plugin.video.test', '9.9.9'))
+    retention = manage_repo.RetentionPolicy(2, pinned, dry_run=True)
+    build([folder], data_path, cache_folder, blob_folder=blob_folder,
+          retention=retention)
+    (out, err) = capsys.readouterr()
+    assert sorted(line for line in out.splitlines()
+                  if str(addon_folder) in line) == [
+        'Would remove {}'.format(addon_folder / basename)
+        for basename in ('changelog-1.1.0_leia.txt',
+                         'plugin.video.test-1.1.0_leia.zip',
+                         'plugin.video.test-1.1.0_leia.zip.md5')]
+    assert 'Warning: --pin plugin.video.test=9.9.9 matches no published ' \
+        'version' in err
+    assert len(list_versions(addon_folder)) == 4
+
+    retention = retention._replace(keep=1, dry_run=False)
+    build([folder], data_path, cache_folder, blob_folder=blob_folder,
+          retention=retention)
+    assert list_versions(addon_folder) == ['1.0.0_leia', '1.3.0_leia']
+    # Blobs that nothing links to any more are removed along with them.
+    for (root, dirs, files) in os.walk(blob_folder):
+        for name in files:
+            assert os.stat(os.path.join(root, name)).st_nlink > 1
+    rows = manage_repo.query_inventory(str(data_path), ['leia'])
+    assert [row['version'] for row in rows] == ['1.0.0_leia', '1.3.0_leia']
+    assert manage_repo.verify_repository(str(data_path), ['leia']) == []
+
+
+def test_dry_run_needs_keep(monkeypatch, capsys, addon_factory):
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, str(addon_factory()), '--dry-run')
+    assert '--dry-run only applies to --keep' in capsys.readouterr().err
+
+
+def test_zip_sources_are_ingested_without_reading_them(
+        monkeypatch, tmp_path, addon_factory, cache_folder, inline_workers):
+    build([addon_factory()], tmp_path / 'built', cache_folder)
+    source_path = str(tmp_path / 'plugin.video.test-1.0.0_leia.zip')
+    shutil.copy(str(tmp_path / 'built' / 'leia' / 'plugin.video.test' /
+                    'plugin.video.test-1.0.0_leia.zip'), source_path)
+    with open(source_path, 'rb') as source_file:
+        contents = source_file.read()
+    clones = count_fetches(monkeypatch, 'clone_file')
+    hashes = count_fetches(monkeypatch, 'hash_file')
+    fetches = count_fetches(monkeypatch, 'fetch_addon_from_zip')
+
+    data_path = tmp_path / 'out'
+    blob_folder = str(data_path / manage_repo.BLOB_FOLDER_BASENAME)
+    build([source_path], data_path, cache_folder, blob_folder=blob_folder)
+    archive_path = str(data_path / 'leia' / 'plugin.video.test' /
+                       'plugin.video.test-1.0.0_leia.zip')
+    with open(archive_path, 'rb') as archive_file:
+        assert archive_file.read() == contents
+    assert (data_path / 'leia' / 'plugin.video.test' /
+            'addon.xml').is_file()
+    # The source is hashed once, copied by the kernel and never linked.
+    assert hashes.count(source_path) == 1
+    assert clones == [source_path]
+    assert not os.path.samefile(source_path, archive_path)
+    assert os.path.samefile(archive_path, manage_repo.get_blob_path(
+        blob_folder, hashlib.sha256(contents).hexdigest()))
+
+    # An unchanged zip is neither hashed nor fetched again.
+    build([source_path], data_path, cache_folder, blob_folder=blob_folder)
+    assert hashes.count(source_path) == 1
+    assert len(fetches) == 1
+    # A forced rebuild links the archive from the blob store.
+    os.remove(archive_path)
+    manage_repo.create_repository(
+        [source_path], str(data_path), False, ['leia'], force=True,
+        options=manage_repo.BuildOptions(cache_folder=cache_folder,
+                                         blob_folder=blob_folder))
+    assert clones == [source_path]
+    assert os.path.samefile(archive_path, manage_repo.get_blob_path(
+        blob_folder, hashlib.sha256(contents).hexdigest()))
+
+
+def test_digest_cache_only_keeps_existing_files(
+        tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    data_path = tmp_path / 'out'
+    digest_folder = os.path.join(
+        cache_folder, manage_repo.DIGEST_CACHE_FOLDER_BASENAME)
+    build([folder], data_path, cache_folder)
+    with open(os.path.join(digest_folder, 'old.json'), 'w') as cache_file:
+        cache_file.write('{"md5": "0"}')
+    retention = manage_repo.RetentionPolicy(1)
+    build_releases(folder, data_path, cache_folder, ['v1.1.0', 'v1.2.0'],
+                   retention=retention)
+
+    paths = []
+    for basename in os.listdir(digest_folder):
+        with open(os.path.join(digest_folder, basename)) as cache_file:
+            paths.append(json.load(cache_file)['path'])
+    assert all(os.path.isfile(path) for path in paths)
+    assert str(data_path / 'leia' / 'plugin.video.test' /
+               'plugin.video.test-1.2.0_leia.zip') in paths
+    assert len(paths) == len(set(paths))
+
+
+def test_unresolved_imports_are_reported_once_per_addon():
+    entries = [
+        ('plugin.a', '1.0.0', [('xbmc.python', '2.25.0', False),
+                               ('xbmc.gui', '5.0.0', False),
+                               ('kodi.resource', None, False),
+                               ('script.module.b', '2.0.0', False),
+                               ('script.module.c', None, False),
+                               ('script.module.d', None, False),
+                               ('script.module.e', None, True),
+                               ('script.module.ext', None, False)]),
+        ('script.module.b', '1.0.0', []),
+        ('plugin.f', '1.0.0', [('script.module.b', '1.0.0', False)])]
+    assert manage_repo.find_unresolved_requirements(
+        'matrix', entries, ['script.module.ext']) == [
+        'plugin.a 1.0.0 requires xbmc.python 2.25.0, but Kodi matrix '
+        'provides 3.0.0; script.module.b 2.0.0, but the catalog has 1.0.0; '
+        'script.module.c, script.module.d, which are not in the catalog']
+
+
+def test_strict_requires_publishes_nothing(
+        tmp_path, addon_factory, cache_folder):
+    folder = addon_factory(imports=(('xbmc.python', '2.25.0'),
+                                    ('script.module.missing', '1.0.0')))
+    with pytest.raises(RuntimeError):
+        build([folder], tmp_path, cache_folder, strict_requires=True)
+    # Neither the archives nor the build manifest are written.
+    assert os.listdir(str(tmp_path / 'leia')) == []
+    build([folder], tmp_path, cache_folder, strict_requires=True,
+          external_addons=('script.module.*',))
+    assert (tmp_path / 'leia' / 'addons.xml').is_file()
+    assert (tmp_path / 'leia' / 'plugin.video.test' /
+            'plugin.video.test-1.0.0_leia.zip').is_file()
+    assert not [name for name in os.listdir(str(tmp_path))
+                if name.startswith(manage_repo.STAGING_FOLDER_BASENAME)]
+
+
+def test_requires_check_reuses_unchanged_catalogs(
+        monkeypatch, tmp_path, addon_factory, cache_folder):
+    folder = addon_factory()
+    build([folder], tmp_path, cache_folder)
+    target_folder = str(tmp_path / 'leia')
+    metadata = [manage_repo.parse_metadata(
+        os.path.join(target_folder, 'plugin.video.test', 'addon.xml'))]
+    options = manage_repo.BuildOptions(cache_folder=cache_folder)
+    parsed = count_fetches(monkeypatch, 'merge_catalog_entries')
+    manage_repo.requirement_checks.clear()
+    assert manage_repo.check_requirements(
+        target_folder, 'leia', metadata, options) == []
+    assert len(parsed) == 1
+    # The hash is taken from the bytes of the catalog, so an unchanged
+    # catalog is not parsed again, even by a new process.
+    manage_repo.requirement_checks.clear()
+    assert manage_repo.check_requirements(
+        target_folder, 'leia', metadata, options) == []
+    assert len(parsed) == 1
+    with open(os.path.join(target_folder, 'addons.xml'), 'ab') as catalog:
+        catalog.write(b'\n')
+    manage_repo.check_requirements(target_folder, 'leia', metadata, options)
+    assert len(parsed) == 2
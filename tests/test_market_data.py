@@ -0,0 +1,242 @@
+import numpy as np
+import pytest
+
+import bot
+import market_data
+from fake_exchange import FakeExchange
+from market_data import AsyncMarketData, OHLCVRing
+
+TIMEFRAME_MS = 15 * 60 * 1000
+
+
+class SyncFakeExchange:
+    # Synchronous fetch_ohlcv over deterministic bars. The last bar is still
+    # forming, so its values change with the clock.
+    def __init__(self):
+        self.now = 1_700_000_000_000 // TIMEFRAME_MS * TIMEFRAME_MS + 5000
+        self.requests = []
+
+    parse_timeframe = staticmethod(FakeExchange.parse_timeframe)
+
+    def milliseconds(self):
+        return self.now
+
+    def _bar(self, ts):
+        current = self.now // TIMEFRAME_MS * TIMEFRAME_MS
+        r = ((ts * 7919 + (self.now if ts == current else 0)) % 1000) / 1000
+        return [ts, 1 + r, 2 + r, r, 1.5 + r, 10 * r]
+
+    def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None):
+        current = self.now // TIMEFRAME_MS * TIMEFRAME_MS
+        start = current - (limit - 1) * TIMEFRAME_MS if since is None else since
+        bars = [self._bar(ts) for ts in range(start, current + TIMEFRAME_MS, TIMEFRAME_MS)][:limit]
+        self.requests.append((since, limit, len(bars)))
+        return bars
+
+
+def test_ring_top_up_matches_full_fetch():
+    ex = SyncFakeExchange()
+    cache = {}
+    for step in range(60):
+        ex.now += 7 * 60 * 1000
+        if step == 30:
+            # A pause longer than a top-up can bridge
+            ex.now += 500 * TIMEFRAME_MS
+        df = bot.fetch_ohlcv_df(ex, "X/USDT", "15m", 400, cache)
+        expected = bot.fetch_ohlcv_df(ex, "X/USDT", "15m", 400)
+        ex.requests.pop()
+        assert df.equals(expected.astype(float)), step
+    # Two full fetches (first pass and after the pause); the rest are top-ups
+    assert sum(1 for since, _, _ in ex.requests if since is None) == 2
+    assert sum(bars for _, _, bars in ex.requests) < 1000
+
+
+def test_ring_merge_rejects_gaps():
+    ring = OHLCVRing(4, TIMEFRAME_MS)
+    ring.seed([[ts * TIMEFRAME_MS, 1, 2, 0, 1, 1] for ts in range(6)])
+    assert ring.size == 4 and ring.last_timestamp == 5 * TIMEFRAME_MS
+    assert ring.merge([[6 * TIMEFRAME_MS, 1, 2, 0, 1.5, 1]])
+    assert not ring.merge([[8 * TIMEFRAME_MS, 1, 2, 0, 1, 1]])
+    assert list(ring.to_frame()["close"]) == [1, 1, 1, 1.5]
+    assert market_data.get_top_up(ring, 4, TIMEFRAME_MS, 6 * TIMEFRAME_MS + 1) == (6 * TIMEFRAME_MS, 2)
+    assert market_data.get_top_up(ring, 4, TIMEFRAME_MS, 9 * TIMEFRAME_MS) is None
+
+
+def test_async_fetch_shares_the_ring_cache():
+    ex = FakeExchange(latency=0.0)
+    cache = {}
+    fetcher = AsyncMarketData(ex, ohlcv_cost=1.0, cache=cache)
+    symbols = [f"C{i}/USDT" for i in range(5)]
+    try:
+        for _ in range(3):
+            frames = dict(fetcher.iter_ohlcv(symbols, "15m", 400))
+            ex.now += 7 * 60 * 1000
+    finally:
+        fetcher.close()
+    assert fetcher.cache is cache and sorted(cache) == symbols
+    # Only the first pass fetches full history
+    assert [since is None for _, _, since, _ in ex.requests].count(True) == len(symbols)
+    for symbol in symbols:
+        assert len(frames[symbol]) == 400
+        assert frames[symbol].equals(cache[symbol].to_frame())
+
+
+class FakeClock:
+    # Monotonic clock and async sleep for a TokenBucket; sleeping only moves
+    # the clock forward.
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_async_fetch_is_paced_by_the_token_bucket(monkeypatch):
+    # Fetch a universe twice (seed and top-up) and check the waits of the
+    # token bucket against the weights of the requests, which depend on
+    # their limits.
+    monkeypatch.setitem(market_data.OHLCV_ENDPOINTS, "fake", ("public", "klines"))
+    ex = FakeExchange(latency=0.0)
+    clock = FakeClock()
+    bucket = market_data.TokenBucket(10.0, 8.0, clock=clock, sleep=clock.sleep)
+    fetcher = AsyncMarketData(ex, bucket)
+    symbols = [f"C{i}/USDT" for i in range(12)]
+    try:
+        for cost in (2.0, 1.0):
+            ex.requests.clear()
+            clock.slept.clear()
+            clock.now += 60  # a full bucket
+            frames = dict(fetcher.iter_ohlcv(symbols, "15m", 400))
+            assert [len(frames[symbol]) for symbol in symbols] == [400] * len(symbols)
+            assert [fetcher.ohlcv_cost(limit) for _, _, _, limit in ex.requests] == [cost] * len(symbols)
+            # Only the weight beyond the initial burst waits for a refill
+            spent = cost * len(symbols)
+            assert sum(clock.slept) == pytest.approx((spent - bucket.capacity) / bucket.rate)
+            ex.now += 7 * 60 * 1000
+    finally:
+        fetcher.close()
+
+
+def test_endpoint_cost_follows_the_limit_tiers():
+    ex = FakeExchange()
+    assert market_data.get_endpoint_cost(ex, "klines") == 5
+    assert market_data.get_endpoint_cost(ex, "klines", 400) == 2
+    assert market_data.get_endpoint_cost(ex, "klines", 5000) == 5
+    assert market_data.get_endpoint_cost(ex, "missing", 400) == 1
+
+    ccxt = pytest.importorskip("ccxt")
+    binance = ccxt.binance()
+    assert market_data.get_endpoint_cost(binance, "klines", 400, "fapiPublic") == 2
+    api, endpoint = market_data.OHLCV_ENDPOINTS["binance"]
+    # The spot API is looked up, never the futures tiers of the same endpoint
+    for limit in (10, 400, 1000):
+        expected = binance.calculate_rate_limiter_cost(
+            api, "GET", endpoint, {"limit": limit}, binance.api[api]["get"][endpoint])
+        assert market_data.get_endpoint_cost(binance, endpoint, limit, api) == expected
+
+
+def amount_from_budget_ccxt(ex, market, budget, price):
+    # How bot.amount_from_budget sized orders with ccxt before the limits table
+    amount = float(ex.amount_to_precision(market["symbol"], budget / price))
+    limits = market.get("limits", {})
+    min_amount = (limits.get("amount") or {}).get("min")
+    min_cost = (limits.get("cost") or {}).get("min")
+    if min_amount and amount < min_amount:
+        amount = min_amount
+    if min_cost and amount * price < min_cost:
+        amount = min_cost / price
+    return float(ex.amount_to_precision(market["symbol"], amount))
+
+
+PRECISIONS = {
+    "TICK_SIZE": [1e-8, 1e-6, 0.001, 0.01, 0.1, 1, 10, 0.5, 0.25, 0.0005, 5e-7],
+    "DECIMAL_PLACES": [0, 1, 2, 3, 4, 6, 8],
+    "SIGNIFICANT_DIGITS": [1, 2, 3, 4, 5, 6, 8],
+}
+
+
+@pytest.mark.parametrize("mode", sorted(PRECISIONS))
+def test_size_orders_matches_ccxt(mode):
+    ccxt = pytest.importorskip("ccxt")
+    from ccxt.base import decimal_to_precision
+
+    ex = ccxt.bybit()
+    ex.precisionMode = getattr(decimal_to_precision, mode)
+    markets = []
+    for i, precision in enumerate(PRECISIONS[mode]):
+        min_amount = None
+        if i % 2:
+            min_amount = 3 * (precision if mode == "TICK_SIZE" else 10.0 ** -precision)
+        markets.append({
+            "id": f"C{i}USDT", "symbol": f"C{i}/USDT", "base": f"C{i}", "quote": "USDT", "baseId": f"C{i}",
+            "quoteId": "USDT", "type": "spot", "spot": True, "active": True,
+            "precision": {"amount": precision, "price": 0.01},
+            "limits": {"amount": {"min": min_amount}, "cost": {"min": 5 if i % 3 else None}},
+        })
+    ex.set_markets(markets)
+    limits = market_data.build_limits_table(ex.markets, ex.precisionMode)
+
+    rng = np.random.default_rng(0)
+    symbols = list(ex.markets)
+    compared = 0
+    for _ in range(3000):
+        symbol = symbols[rng.integers(len(symbols))]
+        price = float(10 ** rng.uniform(-4, 5))
+        budget = float(rng.choice([5, 7.5, 25, 100, 1234.5, 0.29, 0.3]))
+        try:
+            expected = amount_from_budget_ccxt(ex, ex.markets[symbol], budget, price)
+        except ccxt.InvalidOrder:
+            # ccxt refuses amounts that round to zero
+            continue
+        compared += 1
+        assert bot.amount_from_budget(limits, symbol, budget, price) == expected, (symbol, budget, price)
+    assert compared > 1000
+
+
+def test_build_limits_table_rejects_unknown_precision_modes():
+    with pytest.raises(ValueError):
+        market_data.build_limits_table({}, precision_mode=99)
+
+
+class SyncExchange:
+    precisionMode = market_data.TICK_SIZE
+
+    def __init__(self, step):
+        self.step = step
+        self.currencies = {"USDT": {"code": "USDT"}}
+        self.markets = None
+        self.set_calls = []
+
+    def load_markets(self, reload=False):
+        self.markets = {"BTC/USDT": {
+            "symbol": "BTC/USDT", "active": True, "precision": {"amount": self.step},
+            "limits": {"amount": {"min": None}, "cost": {"min": None}},
+        }}
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.set_calls.append((markets, currencies))
+        self.markets = markets
+
+
+def test_markets_cache_applies_refresh_from_the_trading_loop():
+    ex, refresh_ex = SyncExchange(0.01), SyncExchange(0.1)
+    cache = market_data.MarketsCache(ex, refresh_ex, ttl_sec=3600)
+    try:
+        assert not cache.apply()
+        cache.refresh()
+        # The refresh only stores its result until the loop applies it
+        assert ex.set_calls == []
+        assert bot.amount_from_budget(cache.limits, "BTC/USDT", 10, 3) == 3.33
+        assert cache.apply()
+        assert ex.set_calls == [(refresh_ex.markets, refresh_ex.currencies)]
+        assert cache.markets is refresh_ex.markets
+        assert bot.amount_from_budget(cache.limits, "BTC/USDT", 10, 3) == 3.3
+        assert not cache.apply()
+    finally:
+        cache.close()